@@ -2,3 +2,15 @@ BUCKET_NAME = "yotam-finel"  # Replace with your actual bucket name
 AWS_REGION = "us-east-1"          # Replace with your desired region
 # Log group and stream names
 log_group_name = 'yotam-finel-log-group'
+
+# S3 upload tuning
+UPLOAD_WORKERS = 16  # concurrent file uploads (1 = one file at a time)
+S3_MAX_POOL_CONNECTIONS = 64  # shared client connection pool, keep >= UPLOAD_WORKERS * MULTIPART_CONCURRENCY
+MULTIPART_THRESHOLD_MB = 64  # files above this size are sent as multipart uploads
+MULTIPART_CHUNKSIZE_MB = 16
+MULTIPART_CONCURRENCY = 4  # parts uploaded in parallel for a single large file
+UPLOAD_QUEUE_SIZE = 64  # tiles waiting for upload before the tiler blocks, keeps disk and memory flat
+
+# CloudWatch log shipping
+LOG_FLUSH_INTERVAL_SECONDS = 5  # queued log events are sent in one batch at this interval
+LOG_MAX_QUEUED_EVENTS = 10000  # events beyond this are dropped instead of blocking the caller
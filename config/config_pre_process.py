@@ -1,5 +1,6 @@
 DEBUG = True
 from pathlib import Path
+import os
 
 # Get project root directory
 PROJECT_ROOT = Path(__file__).parent.parent
@@ -9,6 +10,10 @@ INPUT_FOLDER_PATH = PROJECT_ROOT / "data" / "input"
 SPLIT_FOLDER = PROJECT_ROOT / "data" / "processed_images" / "splited_images"
 OFSETS_FOLDER = PROJECT_ROOT / "data" / "ofsets"
 INPUT_PROCESSED_FOLDER_PATH = PROJECT_ROOT / "data" / "processed_images" / "input_preprocessed"
+# Input files that kept failing in watch mode, moved out of INPUT_FOLDER_PATH (copy one back to retry it)
+INPUT_QUARANTINE_FOLDER_PATH = PROJECT_ROOT / "data" / "processed_images" / "input_quarantine"
+# Ledger of processed sources and uploaded tiles, kept on the processed_images volume so it survives restarts
+LEDGER_PATH = PROJECT_ROOT / "data" / "processed_images" / "ledger.sqlite3"
 # INPUT_FOLDER_PATH = '/data/input'
 # PNG_FOLDER = '/data/processed_images/png'
 # SPLIT_FOLDER = '/data/processed_images/splited_images'
@@ -19,5 +24,30 @@ OUTPUT_PNG_SPLIT = f'images_split'
 OUTPUT_DSM_SPLIT = f'dsm_split'
 IMAGE_NAME_PREFIX = "img"
 IMAGE_SIZE = 1600
+# Overlap margin (pixels) read around every tile, the model predicts on it and keeps only the tile itself,
+# so the texture features near the tile edges see real neighbours (0 = hard-edged tiles)
+TILE_HALO = 0
+DELETE_UPLOADED_TILES = True  # remove local tiles once their upload is confirmed
+SKIP_EMPTY_TILES = True  # skip tiles that are all nodata (or all zero when the TIF has no mask)
+TILE_OUTPUT = 'bundle'  # 'bundle': one indexed object per TIF, 'png': one S3 object per tile
+META_KEY = '__meta__'  # reserved key in the per-TIF offsets dict, holds the bundle index
 TIME_ZONE = 'Asia/Jerusalem'
-RUN_H = 12
\ No newline at end of file
+RUN_H = 12
+# 'watch': process each TIF as soon as it lands in INPUT_FOLDER_PATH (inotify), 'schedule': daily batch at RUN_H
+INGEST_MODE = 'watch'
+INGEST_DEBOUNCE_SECONDS = 30  # quiet period before a new file is considered fully written
+INGEST_MAX_CONCURRENT = 2  # files processed at the same time in watch mode
+INGEST_RETRY_SECONDS = 300  # a file still in the input folder after its run (failed, not uploaded) is retried after this,
+# doubled after every failed retry
+INGEST_MAX_RETRIES = 5  # then the file is moved to INPUT_QUARANTINE_FOLDER_PATH
+# Row blocks of tif_to_png (block-wise conversion, used by the validator) and of the empty-tile scan,
+# keeps memory bounded on BigTIFF inputs
+BLOCK_WISE_CONVERSION = True
+BLOCK_ROWS = 1024  # rows processed at a time, aligned to the TIF's internal blocks/strips
+# ceiling for those row buffers + GDAL block cache, per process (on top of the ~150MB interpreter baseline).
+# The tiles are read one at a time and not counted, the tiling pool takes up to PRE_PROCESS_WORKERS times this
+MAX_MEMORY_MB = 512
+GDAL_CACHE_MB = 64
+
+# Process pool for tiling, fans out across input TIFs and tile rows (1 = serial)
+PRE_PROCESS_WORKERS = os.cpu_count() or 1
@@ -0,0 +1,77 @@
+### compare the per-point georeferencing loop with the vectorized georeference() on a dense synthetic mask
+### run it in the model environment (src/model_image/requirements_model.txt)
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+from affine import Affine
+from shapely.geometry import Polygon
+
+project_root = str(Path(__file__).parent.parent.parent)
+sys.path.insert(0, str(Path(project_root) / 'src' / 'model_image'))
+
+from src.model_functions import create_polygons, georeference
+
+TILE_SIZE = 1600
+OFFSET = (3200, 4800)
+TRANSFORM = Affine(0.1, 0.0, 178000.0, 0.0, -0.1, 665000.0)
+
+
+def dense_mask(size: int = TILE_SIZE, crowns: int = 4000, seed: int = 0):
+    """
+    Draws random disk-shaped tree crowns (some with holes) on a size x size 0/255 mask.
+
+    Args:
+        size: int, width and height in pixels
+        crowns: int, number of crowns
+        seed: int, random seed
+
+    Returns:
+        numpy array: the mask
+    """
+    rng = np.random.default_rng(seed)
+    rows, cols = np.ogrid[:size, :size]
+    mask = np.zeros((size, size), dtype=np.uint8)
+    for _ in range(crowns):
+        row, col = rng.integers(0, size, 2)
+        radius = rng.integers(4, 12)
+        window = (slice(max(row - radius, 0), row + radius + 1), slice(max(col - radius, 0), col + radius + 1))
+        distance = (rows[window[0]] - row) ** 2 + (cols[:, window[1]] - col) ** 2
+        mask[window][distance <= radius ** 2] = 255
+        if radius > 9:
+            mask[window][distance <= 4] = 0  # gap in the canopy
+    return mask
+
+
+def georeference_loop(polygons, offset, transform):
+    """The original per-point implementation of process_image."""
+    adjusted_polygons = []
+    for polygon in polygons:
+        exterior_coords = [(x + offset[0], y + offset[1]) for x, y in polygon.exterior.coords]
+        interiors = [[(x + offset[0], y + offset[1]) for x, y in interior.coords] for interior in polygon.interiors]
+        exterior_coords = [transform * (x, y) for x, y in exterior_coords]
+        interiors = [[transform * (x, y) for x, y in interior] for interior in interiors]
+        adjusted_polygons.append(Polygon(exterior_coords, interiors))
+    return adjusted_polygons
+
+
+def best_of(function, repeat: int = 5):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        times.append(time.perf_counter() - start)
+    return min(times), result
+
+
+if __name__ == "__main__":
+    polygons = create_polygons(dense_mask())
+    points = sum(len(polygon.exterior.coords) + sum(len(ring.coords) for ring in polygon.interiors)
+                 for polygon in polygons)
+    loop_seconds, expected = best_of(lambda: georeference_loop(polygons, OFFSET, TRANSFORM))
+    vector_seconds, result = best_of(lambda: georeference(polygons, OFFSET, TRANSFORM))
+    identical = all(a.equals_exact(b, 0) for a, b in zip(expected, result)) and len(expected) == len(result)
+    print(f"{len(polygons)} polygons, {points} points")
+    print(f"loop:       {loop_seconds * 1000:8.1f} ms")
+    print(f"vectorized: {vector_seconds * 1000:8.1f} ms  ({loop_seconds / vector_seconds:.0f}x), identical: {identical}")
@@ -0,0 +1,74 @@
+### compare the mask-to-polygon engines of the model (speed, polygon count and IoU) on synthetic canopy masks
+### run it in the model environment (src/model_image/requirements_model.txt)
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+from rasterio.features import rasterize
+from scipy import ndimage
+from shapely.affinity import translate
+from shapely.ops import unary_union
+
+project_root = str(Path(__file__).parent.parent.parent)
+sys.path.insert(0, str(Path(project_root) / 'src' / 'model_image'))
+
+from src.model_functions import POLYGON_ENGINES
+
+TILE_SIZE = 1600
+COVERS = [0.1, 0.3, 0.5, 0.8]  # share of the tile covered by canopy
+
+
+def canopy_mask(cover: float, size: int = TILE_SIZE, smoothing: float = 6, seed: int = 0):
+    """
+    Thresholds smoothed noise into a 0/255 canopy-like mask (blobs of crowns with gaps and holes).
+
+    Args:
+        cover: float, share of the pixels set
+        size: int, width and height in pixels
+        smoothing: float, gaussian sigma, larger = bigger crowns
+        seed: int, random seed
+
+    Returns:
+        numpy array: the mask
+    """
+    noise = ndimage.gaussian_filter(np.random.default_rng(seed).standard_normal((size, size)), smoothing)
+    return np.where(noise > np.quantile(noise, 1 - cover), 255, 0)
+
+
+def iou(a, b):
+    union = a.union(b).area
+    return a.intersection(b).area / union if union else 1.0
+
+
+def mask_iou(polygons, mask):
+    """IoU of the polygons (pixel-center coordinates) rasterized back on the pixel grid, against the mask."""
+    shifted = [translate(polygon, 0.5, 0.5) for polygon in polygons]
+    raster = rasterize(shifted, out_shape=mask.shape, fill=0, default_value=1, dtype='uint8') if shifted \
+        else np.zeros(mask.shape, dtype=np.uint8)
+    canopy = mask > 0
+    union = np.logical_or(raster, canopy).sum()
+    return np.logical_and(raster, canopy).sum() / union if union else 1.0
+
+
+def timed(function, repeat: int = 3):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        times.append(time.perf_counter() - start)
+    return min(times), result
+
+
+if __name__ == "__main__":
+    print(f"{'cover':>6} {'engine':>9} {'seconds':>8} {'polygons':>9} {'IoU vs contours':>16} {'IoU vs mask':>12}")
+    for cover in COVERS:
+        mask = canopy_mask(cover)
+        reference = None
+        for engine, create in POLYGON_ENGINES.items():
+            seconds, polygons = timed(lambda: create(mask))
+            merged = unary_union(polygons)
+            if reference is None:
+                reference = merged
+            print(f"{cover:>6.1f} {engine:>9} {seconds:>8.2f} {len(polygons):>9} "
+                  f"{iou(merged, reference):>16.3f} {mask_iou(polygons, mask):>12.3f}")
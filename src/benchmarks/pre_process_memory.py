@@ -0,0 +1,76 @@
+### measure peak memory vs image size, to size the pre-processing container and the validator Lambda:
+### tif_to_png with a full read ('png') and block-wise ('blocks'), and the tiling read straight from the TIF ('tiles')
+import json
+import os
+import subprocess
+import sys
+import tempfile
+from pathlib import Path
+
+import numpy as np
+import rasterio as rio
+from rasterio.transform import from_origin
+
+project_root = str(Path(__file__).parent.parent.parent)
+sys.path.insert(0, project_root)
+
+SIZES = [2000, 5000, 10000, 20000]
+
+
+def make_tif(path, size: int, block_rows: int = 256):
+    """
+    Writes a synthetic striped RGB GeoTIFF of size x size pixels, block_rows rows at a time.
+
+    Args:
+        path: str, destination TIF path
+        size: int, width and height in pixels
+        block_rows: int, rows written per step (also the strip height)
+    """
+    rng = np.random.default_rng(0)
+    with rio.open(path, 'w', driver='GTiff', height=size, width=size, count=3, dtype='uint8',
+                  transform=from_origin(0, 0, 1, 1), BIGTIFF='IF_SAFER',
+                  blockysize=block_rows) as dst:
+        for row in range(0, size, block_rows):
+            height = min(block_rows, size - row)
+            data = rng.integers(0, 255, (3, height, size), dtype=np.uint8)
+            dst.write(data, window=rio.windows.Window(0, row, size, height))
+
+
+MODES = {
+    'png': "ok = tif_to_png(%r, %r, 'out.png', block_wise=False)\n",
+    'blocks': "ok = tif_to_png(%r, %r, 'out.png', block_wise=True)\n",
+    'tiles': "os.makedirs(%r + '/tiles', exist_ok=True)\n"
+             "ok = bool(split_image(%r, %r + '/tiles', IMAGE_SIZE, skip_empty=True, workers=1))\n",
+}
+
+
+def measure(tif_path, mode: str):
+    """
+    Runs one mode of MODES on the TIF in a fresh interpreter and returns its peak RSS in MB.
+    A subprocess is used because ru_maxrss never goes down within a process.
+    """
+    folder = os.path.dirname(tif_path)
+    run = MODES[mode] % ((tif_path, folder) if mode != 'tiles' else (folder, tif_path, folder))
+    code = (
+        "import os, sys, json; sys.path.insert(0, %r)\n"
+        "from src.pre_process import tif_to_png, split_image, peak_rss_mb\n"
+        "from config.config_pre_process import IMAGE_SIZE\n"
+        "baseline = peak_rss_mb()\n"
+        "%s"
+        "print(json.dumps({'ok': ok, 'baseline': baseline, 'peak': peak_rss_mb()}))\n"
+    ) % (project_root, run)
+    out = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, check=True)
+    return json.loads(out.stdout.strip().splitlines()[-1])
+
+
+if __name__ == "__main__":
+    sizes = [int(s) for s in sys.argv[1:]] or SIZES
+    print(f"{'size':>8} {'raw MB':>8} {'mode':>10} {'baseline MB':>12} {'peak MB':>8}")
+    for size in sizes:
+        with tempfile.TemporaryDirectory() as tmpdir:
+            tif_path = os.path.join(tmpdir, 'bench.tif')
+            make_tif(tif_path, size)
+            raw_mb = size * size * 3 / 1024 / 1024
+            for mode in MODES:
+                result = measure(tif_path, mode)
+                print(f"{size:>8} {raw_mb:>8.0f} {mode:>10} {result['baseline']:>12.0f} {result['peak']:>8.0f}")
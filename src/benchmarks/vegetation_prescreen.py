@@ -0,0 +1,110 @@
+### tune the vegetation pre-screen of the model (PRESCREEN_* in config_model): for each excess green threshold and
+### minimum vegetation cover,
+### the share of tiles that skip the classifier, the classifier time saved and the canopy recall kept
+### usage: python vegetation_prescreen.py [tiles folder] [validation pickle]
+### the validation pickle maps tile names to 0/255 canopy masks (the validator's format); without it the classifier
+### output is the reference, without arguments synthetic tiles with known canopy are used
+### run it in the model environment (src/model_image/requirements_model.txt)
+import os
+import pickle
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+from PIL import Image
+
+project_root = str(Path(__file__).parent.parent.parent)
+sys.path.insert(0, str(Path(project_root) / 'src' / 'model_image'))
+
+from src.model_functions import get_model, vegetation_cover
+from src.config_model import PRESCREEN_EXG_THRESHOLD,PRESCREEN_MIN_COVER
+
+EXG_THRESHOLDS = sorted({0.05, PRESCREEN_EXG_THRESHOLD, 0.15, 0.2})
+MIN_COVERS = sorted({0.0005, 0.001, PRESCREEN_MIN_COVER, 0.005, 0.01, 0.02})
+TILE_SIZE = 400
+# ground cover of the synthetic tiles, with or without tree crowns on top
+SURFACES = {'roof': (150, 140, 135), 'road': (90, 90, 95), 'water': (40, 70, 110), 'soil': (140, 115, 80),
+            'grass': (95, 125, 60)}
+
+
+def synthetic_tiles(folder, count: int = 24, size: int = TILE_SIZE, seed: int = 0):
+    """
+    Writes aerial-like tiles: a noisy surface (roof, road, water, bare soil or grass) with green tree crowns
+    drawn on half of them, and returns their canopy masks.
+
+    Args:
+        folder: str, where the PNGs are written
+        count: int, number of tiles
+        size: int, width and height in pixels
+        seed: int, random seed
+
+    Returns:
+        dict: tile name -> 0/255 canopy mask
+    """
+    rng = np.random.default_rng(seed)
+    rows, cols = np.ogrid[:size, :size]
+    masks = {}
+    for k in range(count):
+        surface = list(SURFACES)[k % len(SURFACES)]
+        image = np.clip(np.array(SURFACES[surface]) + rng.normal(0, 12, (size, size, 3)), 0, 255)
+        mask = np.zeros((size, size), dtype=np.uint8)
+        crowns = rng.integers(1, 40) if k % 2 else 0
+        for _ in range(crowns):
+            row, col = rng.integers(0, size, 2)
+            mask[(rows - row) ** 2 + (cols - col) ** 2 <= rng.integers(5, 25) ** 2] = 255
+        shade = rng.uniform(0.6, 1.0, (size, size, 1))  # crowns are darker on one side
+        image = np.where(mask[..., None] > 0, np.array([45, 95, 40]) * shade + rng.normal(0, 8, (size, size, 3)), image)
+        name = f"{surface}_{k}.png"
+        Image.fromarray(np.clip(image, 0, 255).astype(np.uint8), 'RGB').save(os.path.join(folder, name))
+        masks[name] = mask
+    return masks
+
+
+def measure(folder, masks=None):
+    """
+    Times the classifier and the pre-screen on every tile of folder.
+
+    Returns:
+        list: (tile name, classifier seconds, pre-screen seconds, dict exg threshold -> vegetation cover,
+        canopy pixels of the reference)
+    """
+    model, _, _ = get_model()
+    results = []
+    for path in sorted(Path(folder).glob("*.png")):
+        start = time.perf_counter()
+        prediction = model.predict_img(str(path))
+        classifier_seconds = time.perf_counter() - start
+        start = time.perf_counter()
+        cover = {threshold: vegetation_cover(str(path), exg_threshold=threshold) for threshold in EXG_THRESHOLDS}
+        prescreen_seconds = (time.perf_counter() - start) / len(EXG_THRESHOLDS)
+        reference = masks[path.name] == 255 if masks is not None else prediction != 0
+        results.append((path.name, classifier_seconds, prescreen_seconds, cover, int(reference.sum())))
+    return results
+
+
+if __name__ == "__main__":
+    masks = None
+    with tempfile.TemporaryDirectory() as temp_dir:
+        if len(sys.argv) > 1:
+            folder = sys.argv[1]
+            if len(sys.argv) > 2:
+                masks = pickle.load(open(sys.argv[2], 'rb'))
+        else:
+            folder = temp_dir
+            masks = synthetic_tiles(folder)
+        results = measure(folder, masks)
+
+    classifier_total = sum(seconds for _, seconds, _, _, _ in results)
+    prescreen_total = sum(seconds for _, _, seconds, _, _ in results)
+    canopy_total = sum(canopy for _, _, _, _, canopy in results) or 1
+    print(f"{len(results)} tiles, classifier {classifier_total:.1f}s, pre-screen {prescreen_total:.2f}s, reference: "
+          f"{'validation masks' if masks is not None else 'classifier output'}")
+    print(f"{'exg':>5} {'min cover':>10} {'skipped':>8} {'time saved':>11} {'recall':>7}")
+    for threshold in EXG_THRESHOLDS:
+        for min_cover in MIN_COVERS:
+            skipped = [(seconds, canopy) for _, seconds, _, cover, canopy in results if cover[threshold] < min_cover]
+            saved = sum(seconds for seconds, _ in skipped) - prescreen_total  # the pre-screen runs on every tile
+            print(f"{threshold:>5.2f} {min_cover:>10.4f} {len(skipped) / len(results):>8.0%} "
+                  f"{saved / classifier_total:>11.0%} {1 - sum(canopy for _, canopy in skipped) / canopy_total:>7.1%}")
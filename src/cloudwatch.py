@@ -7,7 +7,7 @@ import os
 project_root = str(Path(__file__).parent.parent)
 sys.path.insert(0, project_root)
 
-from config.config_aws import AWS_REGION, log_group_name
+from config.config_aws import AWS_REGION, log_group_name, LOG_FLUSH_INTERVAL_SECONDS, LOG_MAX_QUEUED_EVENTS
 import dotenv
 dotenv.load_dotenv()
 
@@ -27,27 +27,19 @@ try:
 except logs_client.exceptions.ResourceAlreadyExistsException:
     pass
 
+from src.log_shipper import CloudWatchShipper,get_shipper,flush_logs,log_stats
 
 
 def log_to_cloudwatch(logs_client, message):
     """
-    Sends a log message to AWS CloudWatch with current timestamp.
+    Queues a log message for AWS CloudWatch with current timestamp.
+    The message is shipped in a batch by a background thread (or by flush_logs).
     Args:
         logs_client: boto3 CloudWatch logs client
         message: str, message to be logged
-        
+
     Returns:
-        dict: AWS CloudWatch API response
+        bool: False if the message was dropped because the buffer is full
     """
-    timestamp = int(datetime.now().timestamp() * 1000) # Current time.
-    log_event = {
-    'logGroupName': log_group_name,
-    'logStreamName': log_stream_name,
-    'logEvents': [
-        {
-            'timestamp': timestamp,
-            'message': message
-        }
-    ]}
-    response = logs_client.put_log_events(**log_event)
-    return response
\ No newline at end of file
+    return get_shipper(logs_client, log_group_name, log_stream_name, LOG_FLUSH_INTERVAL_SECONDS,
+                       LOG_MAX_QUEUED_EVENTS).put_nowait(message)
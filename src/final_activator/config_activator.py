@@ -0,0 +1,20 @@
+META_KEY = "__meta__"  # reserved key in the per-TIF offsets dict (bundle index, tile size, parts, generation), see pre_process
+
+# Cost model of one model Lambda invocation, used to pack the tiles into offsets files
+TILE_SECONDS = 20.0  # time of one worker on a tile of REFERENCE_TILE_SIZE pixels (scaled by the tile area)
+TILE_MEMORY_MB = 2.0  # polygons held in memory per tile until the result is uploaded
+REFERENCE_TILE_SIZE = 1600
+INVOCATION_OVERHEAD_SECONDS = 30.0  # cold start, merging and uploading the results
+INVOCATION_BASE_MEMORY_MB = 700.0  # interpreter and model, shared with the forked workers
+# The model Lambda runs its tiles on MODEL_WORKERS forked workers (os.cpu_count(), 2 vCPUs at TARGET_MEMORY_MB),
+# keep this in line with it
+MODEL_WORKERS = 2
+WORKER_MEMORY_MB = 400.0  # per worker: the tile in flight, its pixel features and prediction (scaled by the tile area)
+
+# Targets per invocation, below the model Lambda timeout (900s) and memory size, the rest is margin
+TARGET_SECONDS = 600.0
+TARGET_MEMORY_MB = 3008.0
+
+# Fan-out of the offsets file
+READ_CHUNK_KB = 256  # the offsets file is parsed while it streams from S3, this much at a time
+PUT_CONCURRENCY = 16  # offsets files written to S3 at the same time
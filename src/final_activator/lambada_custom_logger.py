@@ -6,6 +6,8 @@ import os
 log_group_name = 'yotam-finel-log-group'
 BUCKET_NAME = "yotam-finel"  # Replace with your actual bucket name
 AWS_REGION = "us-east-1"          # Replace with your desired region
+LOG_FLUSH_INTERVAL_SECONDS = 5  # queued log events are sent in one batch at this interval
+LOG_MAX_QUEUED_EVENTS = 10000  # events beyond this are dropped instead of blocking the caller
 
 # Add test mode flag
 is_test_mode = os.getenv('TEST_MODE', 'false').lower() == 'true'
@@ -32,16 +34,20 @@ else:
     logs_client = MagicMock()
     log_stream_name = f'lambada-activator-{datetime.now().strftime("%Y-%m-%d")}'
 
+# log_shipper.py is copied here from src/ when the Lambda is packaged, see deploy-lambda.yml
+from log_shipper import CloudWatchShipper,get_shipper,flush_logs,log_stats,flush_logs_after
+
+
 def log_to_cloudwatch(logs_client, message):
-    timestamp = int(datetime.now().timestamp() * 1000) # Current time.
-    log_event = {
-    'logGroupName': log_group_name,
-    'logStreamName': log_stream_name,
-    'logEvents': [
-        {
-            'timestamp': timestamp,
-            'message': message
-        }
-    ]}
-    response = logs_client.put_log_events(**log_event)
-    return response
\ No newline at end of file
+    """
+    Queues a log message for AWS CloudWatch with current timestamp.
+    The message is shipped in a batch by a background thread (or by flush_logs).
+    Args:
+        logs_client: boto3 CloudWatch logs client
+        message: str, message to be logged
+
+    Returns:
+        bool: False if the message was dropped because the buffer is full
+    """
+    return get_shipper(logs_client, log_group_name, log_stream_name, LOG_FLUSH_INTERVAL_SECONDS,
+                       LOG_MAX_QUEUED_EVENTS).put_nowait(message)
@@ -1,14 +1,207 @@
 import json
+import math
+import time
+import uuid
+import codecs
 import boto3
 import logging
 import os
+from datetime import datetime, timezone
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 # Set up logging
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
-from lambada_custom_logger import log_to_cloudwatch,logs_client
+from lambada_custom_logger import log_to_cloudwatch,logs_client,flush_logs_after
+from config_activator import META_KEY,TILE_SECONDS,TILE_MEMORY_MB,REFERENCE_TILE_SIZE,INVOCATION_OVERHEAD_SECONDS
+from config_activator import INVOCATION_BASE_MEMORY_MB,TARGET_SECONDS,TARGET_MEMORY_MB,READ_CHUNK_KB,PUT_CONCURRENCY
+from config_activator import MODEL_WORKERS,WORKER_MEMORY_MB
 aws_access_key_id = os.environ['aws_access_key_id']
 aws_secret_access_key = os.environ['aws_secret_access_key']
 
+def tiles_per_invocation(tile_size=REFERENCE_TILE_SIZE, halo=0, workers=MODEL_WORKERS):
+    """
+    Number of tiles a model invocation takes within TARGET_SECONDS and TARGET_MEMORY_MB, see config_activator.
+
+    Args:
+        tile_size: int, size of the tiles in pixels
+        halo: int, overlap margin around the tiles, the model predicts on it too
+        workers: int, tile workers of the model invocation, each processes a tile at a time
+
+    Returns:
+        int: tiles per invocation, at least 1
+    """
+    scale = ((tile_size + 2 * halo) / REFERENCE_TILE_SIZE) ** 2
+    by_time = workers * (TARGET_SECONDS - INVOCATION_OVERHEAD_SECONDS) / (TILE_SECONDS * scale)
+    by_memory = (TARGET_MEMORY_MB - INVOCATION_BASE_MEMORY_MB - workers * WORKER_MEMORY_MB * scale) / TILE_MEMORY_MB
+    return max(1, int(min(by_time, by_memory)))
+
+def tile_names(offsets):
+    return [name for name in offsets if name != META_KEY]
+
+def split_tif(offsets, max_tiles):
+    """
+    Splits the tiles of a TIF into ceil(tiles / max_tiles) chunks of balanced size, in tile order.
+    Each chunk is marked as a part of the TIF (part id, total tiles and the generation of the split in its meta),
+    the model saves the parts under the generation and merges them once all the tiles of the TIF are processed.
+
+    Args:
+        offsets: dict, offsets of the TIF as written by pre_process
+        max_tiles: int, largest chunk
+
+    Returns:
+        list: offsets dicts of the chunks, [offsets] when the TIF fits in one chunk
+    """
+    names = tile_names(offsets)
+    count = -(-len(names) // max_tiles)
+    if count <= 1:
+        return [offsets]
+    meta = offsets.get(META_KEY, {})
+    size, extra = divmod(len(names), count)
+    # parts left by an earlier split of the TIF (a reprocess or another chunk size) are not merged with these
+    generation = uuid.uuid4().hex
+    chunks = []
+    start = 0
+    for part in range(count):
+        end = start + size + (part < extra)
+        chunk = {name: offsets[name] for name in names[start:end]}
+        chunk[META_KEY] = {**meta, 'part': str(part), 'total_tiles': len(names), 'generation': generation}
+        if 'bundle' in meta:
+            # only the byte ranges of the chunk's tiles
+            chunk[META_KEY]['bundle'] = {**meta['bundle'],
+                                         'index': {name: meta['bundle']['index'][name] for name in names[start:end]}}
+        chunks.append(chunk)
+        start = end
+    return chunks
+
+class OffsetsReader:
+    """
+    Parses an offsets file ({tif name: offsets, ...}) while it streams from S3, one TIF at a time,
+    instead of reading and decoding the whole document first.
+    """
+
+    def __init__(self, body, chunk_size=READ_CHUNK_KB * 1024):
+        self.body = body
+        self.chunk_size = chunk_size
+        self.decoder = json.JSONDecoder()
+        self.utf8 = codecs.getincrementaldecoder('utf-8')()
+        self.buffer = ''
+        self.position = 0
+        self.eof = False
+
+    def _fill(self, minimum=1):
+        """Reads until at least minimum more characters are buffered (or the body ends)."""
+        self.buffer = self.buffer[self.position:]
+        self.position = 0
+        target = len(self.buffer) + minimum
+        while len(self.buffer) < target and not self.eof:
+            data = self.body.read(self.chunk_size)
+            self.eof = not data
+            self.buffer += self.utf8.decode(data, final=self.eof)
+
+    def _peek(self):
+        while True:
+            while self.position < len(self.buffer) and self.buffer[self.position].isspace():
+                self.position += 1
+            if self.position < len(self.buffer):
+                return self.buffer[self.position]
+            if self.eof:
+                raise ValueError("offsets file ends early")
+            self._fill()
+
+    def _expect(self, char):
+        if self._peek() != char:
+            raise ValueError(f"expected {char!r} in the offsets file, got {self.buffer[self.position]!r}")
+        self.position += 1
+
+    def _value(self):
+        self._peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.position)
+                if end < len(self.buffer) or self.eof:
+                    self.position = end
+                    return value
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            # the value is not complete yet, double the buffer so a large value is decoded O(1) times
+            self._fill(max(self.chunk_size, len(self.buffer) - self.position))
+
+    def __iter__(self):
+        self._expect('{')
+        if self._peek() == '}':
+            return
+        while True:
+            tif_file = self._value()
+            self._expect(':')
+            yield tif_file, self._value()
+            if self._peek() == '}':
+                return
+            self._expect(',')
+
+def tif_pieces(offsets):
+    """
+    Splits a TIF with split_tif at its tiles_per_invocation.
+
+    Returns:
+        list: (estimated load, offsets dict of the chunk), load 1.0 = a full invocation
+    """
+    meta = offsets.get(META_KEY, {})
+    max_tiles = tiles_per_invocation(meta.get('tile_size', REFERENCE_TILE_SIZE), meta.get('halo', 0))
+    return [(len(tile_names(chunk)) / max_tiles, chunk) for chunk in split_tif(offsets, max_tiles)]
+
+def plan_chunks(tifs):
+    """
+    Packs the tiles of the TIFs into offsets files, one per model invocation.
+    The cost of a tile is the share of an invocation it takes (1 / tiles_per_invocation for its tile size).
+    Large TIFs are split with split_tif, and their parts over half an invocation are yielded as soon as
+    the TIF is read. The smaller chunks are packed at the end, largest first into the least loaded file
+    they fit in, so the files are evenly loaded and small TIFs share an invocation.
+
+    Args:
+        tifs: iterable of (TIF name, offsets), e.g. an OffsetsReader
+
+    Yields:
+        tuple: (estimated load, offsets dict of the file)
+    """
+    pieces = []
+    for order, (tif_file, offsets) in enumerate(tifs):
+        for load, chunk in tif_pieces(offsets):
+            if load > 0.5:
+                yield load, {tif_file: chunk}
+            else:
+                pieces.append((load, order, tif_file, chunk))
+    if not pieces:
+        return
+
+    bins = [[0.0, {}] for _ in range(max(1, math.ceil(sum(piece[0] for piece in pieces) - 1e-9)))]
+    for load, order, tif_file, chunk in sorted(pieces, key=lambda piece: (-piece[0], piece[1])):
+        fits = [b for b in bins if b[0] + load <= 1.0 + 1e-9 and tif_file not in b[1]]
+        if not fits:
+            bins.append([0.0, {}])
+            fits = bins[-1:]
+        target = min(fits, key=lambda b: b[0])
+        target[0] += load
+        target[1][tif_file] = (order, chunk)
+    # inside a file the TIFs keep the order of the offsets file
+    for load, files in bins:
+        if files:
+            yield load, {tif_file: chunk for tif_file, (_, chunk) in sorted(files.items(), key=lambda item: item[1][0])}
+
+def put_chunk(s3, bucket, file_name, load, chunk_offsets):
+    s3.put_object(Bucket=bucket,Key=file_name,Body=bytes(json.dumps(chunk_offsets).encode('UTF-8')))
+    tiles = sum(len(tile_names(offsets)) for offsets in chunk_offsets.values())
+    message = f"{file_name}: {tiles} tiles of {', '.join(chunk_offsets)}, estimated at {load:.0%} of an invocation"
+    logger.info(message)
+    log_to_cloudwatch(logs_client=logs_client,message=message)
+
+def seconds_since(event_time):
+    """Seconds from an S3 event time ("2024-01-28T12:00:00.000Z") to now, None when it is missing."""
+    if not event_time:
+        return None
+    return (datetime.now(timezone.utc) - datetime.fromisoformat(event_time.replace('Z', '+00:00'))).total_seconds()
+
+@flush_logs_after
 def lambda_handler(event, context):
     # TODO implement
     bucket = event['Records'][0]['s3']['bucket']['name']
@@ -17,24 +210,34 @@ def lambda_handler(event, context):
                       aws_secret_access_key=aws_secret_access_key)
 
 
+    start = time.perf_counter()
     response = s3.get_object(Bucket=bucket, Key=json_key)
-    json_data = response['Body'].read()
-    offsets_dict = json.loads(json_data)
 
     logger.info(f"Processing new file: {json_key} from bucket: {bucket}")
     log_to_cloudwatch(logs_client=logs_client,message=f"Processing new file: {json_key} from bucket: {bucket}")
-    #In the future, additional aggregation should be examined according to calculation power and lambda costs
-    i=0
-    for tif_file, png_dict in offsets_dict.items():
-        temp_offsets = {}
-        temp_offsets[tif_file] = offsets_dict[tif_file] 
-        upload_byte_stream = bytes(json.dumps(temp_offsets).encode('UTF-8'))
-        file_name = f"small_offsets/{json_key[json_key.find('/')+1:json_key.find('.json')]}/offsets_{i}.json"
-        s3.put_object(Bucket=bucket,Key=file_name,Body = upload_byte_stream)
-        logger.info(f'{tif_file} offsets uploaded')
-        log_to_cloudwatch(logs_client=logs_client,message=f'{tif_file} offsets uploaded')
-        i+=1
-    
+    # one offsets file per model invocation, sized by the cost model in config_activator, written while
+    # the rest of the offsets file is still being read, at most 2 * PUT_CONCURRENCY files in flight
+    count = 0
+    with ThreadPoolExecutor(max_workers=PUT_CONCURRENCY) as executor:
+        pending = set()
+        for load, chunk_offsets in plan_chunks(OffsetsReader(response['Body'])):
+            if len(pending) >= 2 * PUT_CONCURRENCY:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    future.result()
+            file_name = f"small_offsets/{json_key[json_key.find('/')+1:json_key.find('.json')]}/offsets_{count}.json"
+            pending.add(executor.submit(put_chunk, s3, bucket, file_name, load, chunk_offsets))
+            count += 1
+        for future in pending:
+            future.result()
+
+    since_upload = seconds_since(event['Records'][0].get('eventTime'))
+    message = f"{json_key}: {count} offsets files written in {time.perf_counter() - start:.2f}s"
+    if since_upload is not None:
+        message += f", {since_upload:.2f}s after the offsets file was uploaded"
+    logger.info(message)
+    log_to_cloudwatch(logs_client=logs_client,message=message)
+
     return {
         'statusCode': 200,
         'body': json.dumps(f"{json_key} is processed")
@@ -0,0 +1,164 @@
+import os
+import shutil
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from watchdog.events import FileSystemEventHandler
+from watchdog.observers import Observer
+
+project_root = str(Path(__file__).parent.parent)
+sys.path.insert(0, project_root)
+
+from src.logger import Logger
+from config.config_pre_process import INGEST_DEBOUNCE_SECONDS, INGEST_MAX_CONCURRENT, INGEST_RETRY_SECONDS
+from config.config_pre_process import INGEST_MAX_RETRIES, INPUT_QUARANTINE_FOLDER_PATH
+
+logger = Logger(logger_name='pre-process',logs_dir=os.path.join(project_root,'logs'),log_mode='DEBUG')
+
+PARTIAL_SUFFIXES = ('.part', '.tmp', '.crdownload', '.filepart')
+
+
+class IngestWatcher(FileSystemEventHandler):
+    """
+    Feeds new input files to a handler as soon as they arrive, driven by filesystem events
+    (inotify on Linux) instead of polling the folder once a day.
+    A file is handed over once it had no event for debounce_seconds and its size and mtime did not
+    change between two checks, so partially written/copied files are not picked up.
+    At most max_concurrent files are processed at the same time.
+    The handler moves a file out of the folder once it is done, a file still there after its run (the run
+    failed or its upload did not go through) is handed over again retry_seconds later, twice as late after
+    every failed retry. After max_retries failed retries it is moved to quarantine_folder, so a broken file
+    is not hashed and tiled again forever. A file written again starts over.
+    """
+
+    def __init__(self, folder, handle_file, debounce_seconds=INGEST_DEBOUNCE_SECONDS,
+                 max_concurrent=INGEST_MAX_CONCURRENT, retry_seconds=INGEST_RETRY_SECONDS,
+                 max_retries=INGEST_MAX_RETRIES, quarantine_folder=INPUT_QUARANTINE_FOLDER_PATH):
+        super().__init__()
+        self.folder = str(folder)
+        self.handle_file = handle_file
+        self.debounce_seconds = debounce_seconds
+        self.retry_seconds = retry_seconds
+        self.max_retries = max_retries
+        self.quarantine_folder = str(quarantine_folder)
+        self.failures = {}  # path -> runs in a row that left the file in the folder
+        self.executor = ThreadPoolExecutor(max_workers=max(1, max_concurrent))
+        self.lock = threading.Lock()
+        self.pending = {}  # path -> [time of the last event, (size, mtime) at the last check]
+        self.in_flight = set()
+        self.stop_event = threading.Event()
+
+    @staticmethod
+    def is_candidate(path):
+        name = os.path.basename(path)
+        return not name.startswith('.') and not name.endswith(PARTIAL_SUFFIXES)
+
+    def touch(self, path):
+        """Registers activity on a file, restarting its quiet period."""
+        if not self.is_candidate(path):
+            return
+        with self.lock:
+            if path not in self.in_flight:
+                self.pending[path] = [time.monotonic(), None]
+                self.failures.pop(path, None)
+
+    def on_created(self, event):
+        if not event.is_directory:
+            self.touch(event.src_path)
+
+    def on_modified(self, event):
+        if not event.is_directory:
+            self.touch(event.src_path)
+
+    def on_closed(self, event):
+        if not event.is_directory:
+            self.touch(event.src_path)
+
+    def on_moved(self, event):
+        if not event.is_directory and os.path.dirname(event.dest_path) == self.folder.rstrip(os.sep):
+            self.touch(event.dest_path)
+
+    def poll(self):
+        """
+        Hands over the files that are done being written.
+
+        Returns:
+            list: paths submitted to the handler
+        """
+        now = time.monotonic()
+        ready = []
+        with self.lock:
+            for path, state in list(self.pending.items()):
+                if now - state[0] < self.debounce_seconds:
+                    continue
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    del self.pending[path]
+                    continue
+                signature = (stat.st_size, stat.st_mtime_ns)
+                if state[1] != signature:
+                    state[1] = signature  # still changing (or first check), look again next poll
+                    continue
+                del self.pending[path]
+                self.in_flight.add(path)
+                ready.append(path)
+        for path in ready:
+            logger.info(f"{path} is ready, sending it to the pipeline")
+            self.executor.submit(self._run, path)
+        return ready
+
+    def _run(self, path):
+        try:
+            self.handle_file(path)
+        except Exception as e:
+            logger.error(f"failed to process {path}: {str(e)}")
+        finally:
+            quarantine = False
+            with self.lock:
+                self.in_flight.discard(path)
+                failures = self.failures.pop(path, 0) + 1
+                if os.path.exists(path) and failures > self.max_retries:
+                    quarantine = True
+                elif os.path.exists(path):
+                    self.failures[path] = failures
+                    # the quiet period of the retry ends retry_seconds (doubled after each failed retry) from now
+                    delay = self.retry_seconds * 2 ** (failures - 1)
+                    self.pending[path] = [time.monotonic() + delay - self.debounce_seconds, None]
+                    logger.warning(f"{path} is still in {self.folder} after {failures} run(s), retrying in {delay}s")
+            if quarantine:
+                self.quarantine(path)
+
+    def quarantine(self, path):
+        """Moves a file that kept failing out of the watched folder."""
+        try:
+            os.makedirs(self.quarantine_folder, exist_ok=True)
+            shutil.move(path, os.path.join(self.quarantine_folder, os.path.basename(path)))
+            logger.error(f"{path} failed {self.max_retries + 1} times, moved to {self.quarantine_folder}")
+        except OSError as e:
+            logger.error(f"failed to move {path} to {self.quarantine_folder}: {str(e)}")
+
+    def run(self, poll_interval=1.0):
+        """
+        Watches the folder until stop() is called. Files already in the folder are picked up too.
+        """
+        observer = Observer()
+        observer.schedule(self, self.folder, recursive=False)
+        observer.start()
+        for name in os.listdir(self.folder):
+            if os.path.isfile(os.path.join(self.folder, name)):
+                self.touch(os.path.join(self.folder, name))
+        logger.info(f"Watching {self.folder} for new files")
+        try:
+            while not self.stop_event.wait(poll_interval):
+                self.poll()
+        finally:
+            observer.stop()
+            observer.join()
+            self.executor.shutdown(wait=True)
+
+    def stop(self):
+        self.stop_event.set()
@@ -0,0 +1,96 @@
+import hashlib
+import json
+import sqlite3
+import sys
+import threading
+from datetime import datetime
+from pathlib import Path
+
+project_root = str(Path(__file__).parent.parent)
+sys.path.insert(0, project_root)
+
+from config.config_pre_process import LEDGER_PATH
+
+
+def file_hash(file_path, chunk_size: int = 8 * 1024 * 1024):
+    """
+    Computes the SHA-256 of a file, reading it in chunks.
+
+    Args:
+        file_path: str, path of the file
+        chunk_size: int, bytes read at a time
+
+    Returns:
+        str: hex digest
+    """
+    sha = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+class ProcessingLedger:
+    """
+    Persistent SQLite ledger of the pre-processing work.
+    Keeps the content hash, offsets and status of every source file and the content hash of every
+    uploaded tile, so re-runs and crash restarts skip what is already done.
+    Safe to share between the upload threads.
+    """
+
+    def __init__(self, db_path=LEDGER_PATH):
+        Path(db_path).parent.mkdir(parents=True, exist_ok=True)
+        self.connection = sqlite3.connect(str(db_path), check_same_thread=False)
+        self.lock = threading.Lock()
+        with self.lock, self.connection:
+            self.connection.execute("""CREATE TABLE IF NOT EXISTS sources (
+                name TEXT, sha256 TEXT, status TEXT, run_date TEXT, offsets TEXT, updated_at TEXT,
+                PRIMARY KEY (name, sha256))""")
+            self.connection.execute("""CREATE TABLE IF NOT EXISTS uploads (
+                name TEXT, sha256 TEXT, s3_key TEXT, uploaded_at TEXT,
+                PRIMARY KEY (name, sha256, s3_key))""")
+
+    def source(self, name, sha256):
+        """
+        Looks up a source file by name and content hash.
+
+        Returns:
+            dict: status ('split' or 'done'), run_date and offsets, or None if never seen
+        """
+        with self.lock:
+            row = self.connection.execute("SELECT status, run_date, offsets FROM sources WHERE name = ? AND sha256 = ?",
+                                          (name, sha256)).fetchone()
+        if row is None:
+            return None
+        return {'status': row[0], 'run_date': row[1], 'offsets': json.loads(row[2])}
+
+    def record_source(self, name, sha256, status, run_date, offsets):
+        """Stores the offsets and status ('split' once tiled, 'done' once its offsets are in S3) of a source file."""
+        with self.lock, self.connection:
+            self.connection.execute("INSERT OR REPLACE INTO sources VALUES (?, ?, ?, ?, ?, ?)",
+                                    (name, sha256, status, run_date, json.dumps(offsets), datetime.now().isoformat()))
+
+    def is_uploaded(self, name, sha256=None, s3_key=None):
+        """
+        Checks whether a tile with this name was uploaded, with this content and to s3_key when given.
+        Without a hash, tiles of an unchanged source (same source hash) are identical, so the name is enough.
+        """
+        query = "SELECT 1 FROM uploads WHERE name = ?"
+        params = (name,)
+        if sha256 is not None:
+            query += " AND sha256 = ?"
+            params += (sha256,)
+        if s3_key is not None:
+            query += " AND s3_key = ?"
+            params += (s3_key,)
+        with self.lock:
+            return self.connection.execute(query, params).fetchone() is not None
+
+    def record_upload(self, name, sha256, s3_key):
+        """Marks a tile as uploaded."""
+        with self.lock, self.connection:
+            self.connection.execute("INSERT OR REPLACE INTO uploads VALUES (?, ?, ?, ?)",
+                                    (name, sha256, s3_key, datetime.now().isoformat()))
+
+    def close(self):
+        self.connection.close()
@@ -0,0 +1,170 @@
+### batched, non-blocking CloudWatch log shipping, shared by the pre-process and the Lambdas
+### this file is the only copy in the repository, the deploy workflow copies it into the Lambda packages
+### (src/final_activator and src/model_image/src) before they are built, edit it here
+import atexit
+from datetime import datetime
+import functools
+import logging
+import os
+import queue
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+MAX_BATCH_EVENTS = 10000  # put_log_events limits
+MAX_BATCH_BYTES = 1048576
+EVENT_OVERHEAD_BYTES = 26  # counted by CloudWatch on top of every message
+MAX_EVENT_BYTES = 256 * 1024 - EVENT_OVERHEAD_BYTES
+MAX_BATCH_SPAN_MS = 24 * 60 * 60 * 1000
+
+FLUSH_INTERVAL_SECONDS = 5  # queued log events are sent in one batch at this interval
+MAX_QUEUED_EVENTS = 10000  # events beyond this are dropped instead of blocking the caller
+
+
+class CloudWatchShipper:
+    """
+    Buffers log events in memory and ships them to CloudWatch in batches from a background thread,
+    so logging never waits for the network.
+    Events that don't fit in the buffer, or whose batch failed to send, are counted as dropped.
+    """
+
+    def __init__(self, logs_client, log_group_name, log_stream_name, flush_interval=FLUSH_INTERVAL_SECONDS,
+                 max_queued=MAX_QUEUED_EVENTS):
+        self.logs_client = logs_client
+        self.log_group_name = log_group_name
+        self.log_stream_name = log_stream_name
+        self.flush_interval = flush_interval
+        self.queue = queue.Queue(maxsize=max_queued)
+        self.lock = threading.Lock()
+        self.send_lock = threading.Lock()
+        self.sent = 0
+        self.dropped = 0
+        self.thread = None
+
+    def put_nowait(self, message):
+        """
+        Queues a message with the current timestamp, without blocking.
+
+        Returns:
+            bool: False if the buffer is full and the message was dropped
+        """
+        message = str(message)
+        if len(message.encode('utf-8')) > MAX_EVENT_BYTES:
+            message = message.encode('utf-8')[:MAX_EVENT_BYTES].decode('utf-8', errors='ignore')
+        event = {'timestamp': int(datetime.now().timestamp() * 1000), 'message': message}
+        try:
+            self.queue.put_nowait(event)
+        except queue.Full:
+            with self.lock:
+                self.dropped += 1
+            return False
+        with self.lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self._run, daemon=True)
+                self.thread.start()
+        return True
+
+    def _run(self):
+        while True:
+            time.sleep(self.flush_interval)
+            self.flush()
+
+    @staticmethod
+    def batches(events):
+        """Splits time-ordered events into batches within the put_log_events count, size and time-span limits."""
+        batch, size = [], 0
+        for event in events:
+            event_size = len(event['message'].encode('utf-8')) + EVENT_OVERHEAD_BYTES
+            if batch and (len(batch) == MAX_BATCH_EVENTS or size + event_size > MAX_BATCH_BYTES
+                          or event['timestamp'] - batch[0]['timestamp'] >= MAX_BATCH_SPAN_MS):
+                yield batch
+                batch, size = [], 0
+            batch.append(event)
+            size += event_size
+        if batch:
+            yield batch
+
+    def flush(self):
+        """
+        Sends the events queued so far.
+
+        Returns:
+            int: number of events sent
+        """
+        with self.send_lock:
+            events = []
+            for _ in range(self.queue.qsize()):
+                try:
+                    events.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            events.sort(key=lambda event: event['timestamp'])
+            sent = 0
+            for batch in self.batches(events):
+                try:
+                    self.logs_client.put_log_events(logGroupName=self.log_group_name,
+                                                    logStreamName=self.log_stream_name, logEvents=batch)
+                    sent += len(batch)
+                except Exception as e:
+                    logger.warning(f"failed to send {len(batch)} log events to CloudWatch: {str(e)}")
+                    with self.lock:
+                        self.dropped += len(batch)
+            with self.lock:
+                self.sent += sent
+        return sent
+
+
+shippers = {}
+shippers_lock = threading.Lock()
+
+
+def get_shipper(logs_client, log_group_name, log_stream_name, flush_interval=FLUSH_INTERVAL_SECONDS,
+                max_queued=MAX_QUEUED_EVENTS):
+    """Returns the shipper of a logs client, creating it on first use."""
+    with shippers_lock:
+        shipper = shippers.get(id(logs_client))
+        if shipper is None or shipper.logs_client is not logs_client:
+            shipper = CloudWatchShipper(logs_client, log_group_name, log_stream_name, flush_interval, max_queued)
+            shippers[id(logs_client)] = shipper
+        return shipper
+
+
+def _reset_after_fork():
+    # a forked child must not re-send its parent's queued events or wait on locks held by its threads
+    global shippers_lock
+    shippers.clear()
+    shippers_lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def flush_logs():
+    """Ships every queued log event now, call it before the process (or Lambda invocation) ends."""
+    for shipper in list(shippers.values()):
+        shipper.flush()
+
+
+def log_stats():
+    """
+    Returns:
+        dict: number of log events sent and dropped so far
+    """
+    shipper_list = list(shippers.values())
+    return {'sent': sum(shipper.sent for shipper in shipper_list),
+            'dropped': sum(shipper.dropped for shipper in shipper_list)}
+
+
+def flush_logs_after(handler):
+    """Wraps a Lambda handler so the queued logs are shipped before the invocation ends (the sandbox is frozen after it)."""
+    @functools.wraps(handler)
+    def wrapper(event, context):
+        try:
+            return handler(event, context)
+        finally:
+            flush_logs()
+    return wrapper
+
+
+atexit.register(flush_logs)
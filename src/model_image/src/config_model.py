@@ -1,3 +1,4 @@
+import os
 from pathlib import Path
 
 # Get project root directory
@@ -9,6 +10,58 @@ MODEL_PATH = PROJECT_ROOT / "models" / "v1"/ "tree_model_new"
 SPLIT_FOLDER = PROJECT_ROOT / "data" / "processed_images" / "splited_images"
 OUTPUT_FOLDER = PROJECT_ROOT / "data"  / "output"
 OUTPUT_FOLDER_S3 =  "output"
+OFFSETS_FOLDER_S3 = "small_offsets"  # offsets files that trigger this Lambda (continuations are written here too)
+PARTIALS_FOLDER_S3 = "partials"  # polygons of a TIF processed over several invocations, merged when complete
+META_KEY = "__meta__"  # reserved key in the per-TIF offsets dict (bundle index, written by pre_process)
+
+# Tile bundles: neighbouring byte ranges are fetched with a single ranged GET
+BUNDLE_COALESCE_MAX_MB = 64  # upper bound of one GET, also the memory held per GET
+BUNDLE_COALESCE_MAX_GAP_KB = 512  # ranges further apart than this are fetched separately
+
+# Tiles up to this size are decoded from memory, larger ones are streamed to /tmp first
+IN_MEMORY_MAX_MB = 128
+
+# Tiles downloaded ahead while the current one is processed (0 = download one at a time)
+PREFETCH_DEPTH = 4
+PREFETCH_MAX_MB = 256  # cap on downloaded tiles held in memory ahead of the model
+
+# Tile inference processes, the vCPUs of the Lambda grow with its memory size (1 = serial, in the handler process)
+MODEL_WORKERS = os.cpu_count() or 1
+MODEL_THREADS_PER_WORKER = None  # LightGBM/OpenCV threads per worker, None = vCPUs / MODEL_WORKERS
+
+# Stop taking new tiles when the invocation has less than this (plus the slowest tile so far) left,
+# the rest continues in a new invocation
+DEADLINE_RESERVE_SECONDS = 60
+
+# Polygons within this distance (pixels) of a tile edge are checked against the next tile and merged across the seam
+SEAM_TOLERANCE_PX = 1.0
+
+# Tile result cache: the polygons of a tile are reused when the tile bytes, the model file and the polygon
+# parameters did not change (e.g. a date reprocessed after a failure). None = off,
+# 'local' = TILE_CACHE_DIR with least recently used eviction, 's3' = TILE_CACHE_FOLDER_S3 (nothing is evicted,
+# add a lifecycle rule expiring the prefix on the bucket first).
+# Off by default: on a first run every tile pays a sha256, a missed GET and a PUT, it only pays off when reprocessing
+TILE_CACHE = None
+TILE_CACHE_DIR = '/tmp/tile_cache'
+TILE_CACHE_MAX_MB = 512
+TILE_CACHE_FOLDER_S3 = "tile_cache"
+TILE_CACHE_VERSION = 1  # bump when the mask to polygons code changes, the cached results are then ignored
+
+# Vegetation pre-screen: tiles where almost no pixel is green enough (excess green 2g - r - b on the chromatic
+# coordinates, computed on a downsampled read) skip the classifier. Tune with src/benchmarks/vegetation_prescreen.py
+PRESCREEN = False
+PRESCREEN_DOWNSAMPLE = 4  # the tile is read at 1/PRESCREEN_DOWNSAMPLE of its size
+PRESCREEN_EXG_THRESHOLD = 0.1  # excess green above which a pixel counts as vegetation
+PRESCREEN_MIN_COVER = 0.002  # share of vegetation pixels under which the tile is skipped
+
+# Result file per TIF: 'shp' (shapefile written to /tmp, .shp/.shx/.dbf/... uploaded one by one, what the consumers of
+# output/ read), or 'parquet' (GeoParquet) / 'fgb' (FlatGeobuf), serialized in memory and uploaded as one object
+OUTPUT_FORMAT = 'shp'
+OUTPUT_MULTIPART_THRESHOLD_MB = 64  # larger results are uploaded with a multipart upload
+OUTPUT_MULTIPART_CHUNK_MB = 16
+
+# Mask to polygons: 'contours' (find_contours + buffer + union) or 'shapes' (rasterio.features.shapes on the mask)
+POLYGON_ENGINE = 'contours'
 
 simplification_tolerance = 1.0
 min_polygon_points = 3
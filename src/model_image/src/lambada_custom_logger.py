@@ -5,6 +5,8 @@ import os
 log_group_name = 'yotam-finel-log-group'
 BUCKET_NAME = "yotam-finel"  # Replace with your actual bucket name
 AWS_REGION = "us-east-1"          # Replace with your desired region
+LOG_FLUSH_INTERVAL_SECONDS = 5  # queued log events are sent in one batch at this interval
+LOG_MAX_QUEUED_EVENTS = 10000  # events beyond this are dropped instead of blocking the caller
 aws_access_key_id = os.environ['aws_access_key_id']
 aws_secret_access_key = os.environ['aws_secret_access_key']
 
@@ -28,28 +30,20 @@ except logs_client.exceptions.ResourceAlreadyExistsException:
 # if upload_sequence_token:
 #     log_event['sequenceToken'] = upload_sequence_token
 
+# log_shipper.py is copied here from src/ when the image is built, see deploy-lambda.yml
+from src.log_shipper import CloudWatchShipper,get_shipper,flush_logs,log_stats,flush_logs_after
 
 
 def log_to_cloudwatch(logs_client, message):
     """
-    Sends a log message to AWS CloudWatch.
-
+    Queues a log message for AWS CloudWatch with current timestamp.
+    The message is shipped in a batch by a background thread (or by flush_logs).
     Args:
-        logs_client: Boto3 CloudWatch logs client
-        message: Log message to be recorded
+        logs_client: boto3 CloudWatch logs client
+        message: str, message to be logged
 
     Returns:
-        dict: CloudWatch API response
+        bool: False if the message was dropped because the buffer is full
     """
-    timestamp = int(datetime.now().timestamp() * 1000) # Current time.
-    log_event = {
-    'logGroupName': log_group_name,
-    'logStreamName': log_stream_name,
-    'logEvents': [
-        {
-            'timestamp': timestamp,
-            'message': message
-        }
-    ]}
-    response = logs_client.put_log_events(**log_event)
-    return response
\ No newline at end of file
+    return get_shipper(logs_client, log_group_name, log_stream_name, LOG_FLUSH_INTERVAL_SECONDS,
+                       LOG_MAX_QUEUED_EVENTS).put_nowait(message)
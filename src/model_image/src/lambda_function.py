@@ -1,34 +1,162 @@
+import time
+init_start = time.perf_counter()  # start of the Lambda init phase
+import importlib
 import json
+import uuid
 import boto3
 import logging
 import os
+
+print("load packges to lambada_functions")
+# import the heavy packages once per sandbox, and time them (cold start budget)
+import_seconds = {}
+for module_name in ('numpy', 'shapely', 'skimage.measure', 'detectree', 'geopandas'):
+    module_start = time.perf_counter()
+    importlib.import_module(module_name)
+    import_seconds[module_name] = round(time.perf_counter() - module_start, 3)
+
 from affine import Affine
+import geopandas as gpd
+import tempfile
+import io
+from boto3.s3.transfer import TransferConfig
 
-from src.model_functions import process_image,load_model,load_image,delete_temp_image
-from src.lambada_custom_logger import log_to_cloudwatch,logs_client
-from src.config_model import MODEL_PATH,OUTPUT_FOLDER_S3
+from src.model_functions import get_model,fetch_image,BundleReader,TilePrefetcher,process_tiles
+from src.model_functions import Deadline,partial_key,write_partial,read_partials,delete_partials,continuation_key,merge_seams
+from src.model_functions import claim_merge,release_merge,is_merged
+from src.model_functions import make_tile_cache
+from src.lambada_custom_logger import log_to_cloudwatch,logs_client,flush_logs_after
+from src.config_model import MODEL_PATH,OUTPUT_FOLDER_S3,META_KEY
+from src.config_model import OUTPUT_FORMAT,OUTPUT_MULTIPART_THRESHOLD_MB,OUTPUT_MULTIPART_CHUNK_MB
 from src.config_sns import TOPIC_ARN,subject_failure,subject_success
 
-print("load packges to lambada_functions")
-
 # Set up logging
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 aws_access_key_id = os.environ['aws_access_key_id']
 aws_secret_access_key = os.environ['aws_secret_access_key']
-import geopandas as gpd
-import tempfile
+
+# load the classifier during init, warm invocations reuse it (get_model reloads it only if the file changed)
+_, init_model_load_seconds, _ = get_model(MODEL_PATH)
+init_seconds = time.perf_counter() - init_start
+cold_start = True
 print("finish to load packges to lambada_functions")
 
 
+def upload_shapefile(s3, bucket, polygons, output_shp_key):
+    """
+    Writes polygons as a shapefile and uploads all its files (.shp, .shx, .dbf, ...) to S3.
+
+    Args:
+        s3: Boto3 S3 client
+        bucket: Name of S3 bucket
+        polygons: list of georeferenced polygons
+        output_shp_key: S3 key of the .shp file, the other files get the same name
+
+    Returns:
+        list: uploaded S3 keys
+    """
+    uploded = []
+    gdf = gpd.GeoDataFrame({'geometry': polygons})
+        # Create a temporary directory
+    with tempfile.TemporaryDirectory() as tmpdir:
+        # Define temporary file path
+        temp_shp_path = os.path.join(tmpdir, 'temp.shp')
+        
+        # Save GeoDataFrame to temporary file
+        gdf.to_file(temp_shp_path)
+        print( "we finish gdf")
+        # Upload all related files (.shp, .shx, .dbf, .prj)
+        temp_files = []
+        for file in os.listdir(tmpdir):
+            if file.startswith('temp'):
+                # Get file extension
+                _, ext = os.path.splitext(file)
+                
+                # Create corresponding S3 key with original name
+                s3_key = output_shp_key.replace('.shp', ext)
+                file_path = os.path.join(tmpdir, file)
+                temp_files.append(file_path)
+
+                # Upload file to S3
+                with open(os.path.join(tmpdir, file), 'rb') as f:
+                    s3.upload_fileobj(f, bucket, s3_key)
+                    log_to_cloudwatch(logs_client=logs_client,message=f"Uploaded {s3_key} to S3")
+                    logger.info(f"Uploaded {s3_key} to S3")
+                    uploded.append(s3_key)
+            # Explicitly delete temporary files
+        for file_path in temp_files:
+            try:
+                os.remove(file_path)
+                logger.info(f"Deleted temporary file: {file_path}")
+            except OSError as e:
+                logger.warning(f"Error deleting {file_path}: {e}")
+                log_to_cloudwatch(logs_client=logs_client,message=f"Error deleting {file_path}: {e}")
+    return uploded
+
+# name of the result object of a TIF, after "<tif name>"
+OUTPUT_SUFFIXES = {'shp': '_shapefile.shp', 'parquet': '.parquet', 'fgb': '.fgb'}
+
+def serialize_polygons(polygons, output_format):
+    """
+    Serializes polygons to an in-memory GeoParquet or FlatGeobuf file, nothing is written to /tmp.
+
+    Args:
+        polygons: list of georeferenced polygons
+        output_format: 'parquet' or 'fgb'
+
+    Returns:
+        io.BytesIO: the file, positioned at the start
+    """
+    gdf = gpd.GeoDataFrame(geometry=gpd.GeoSeries(polygons))
+    buffer = io.BytesIO()
+    if output_format == 'parquet':
+        gdf.to_parquet(buffer, index=False)
+    elif output_format == 'fgb':
+        # written with its packed R-tree, the features come back in index order. Only pyogrio writes to a
+        # file object (pinned in requirements_model.txt), fiona would be picked first when installed
+        gdf.to_file(buffer, driver='FlatGeobuf', engine='pyogrio')
+    else:
+        raise ValueError(f"unknown output format {output_format}")
+    buffer.seek(0)
+    return buffer
+
+def upload_polygons(s3, bucket, polygons, output_key, output_format=OUTPUT_FORMAT):
+    """
+    Uploads the polygons of a TIF in output_format, see OUTPUT_FORMAT.
+    GeoParquet/FlatGeobuf are uploaded as a single object, with a multipart upload above
+    OUTPUT_MULTIPART_THRESHOLD_MB.
+
+    Args:
+        s3: Boto3 S3 client
+        bucket: Name of S3 bucket
+        polygons: list of georeferenced polygons
+        output_key: S3 key of the result (of the .shp file for shapefiles)
+        output_format: 'parquet', 'fgb' or 'shp'
+
+    Returns:
+        list: uploaded S3 keys
+    """
+    if output_format == 'shp':
+        return upload_shapefile(s3, bucket, polygons, output_key)
+    buffer = serialize_polygons(polygons, output_format)
+    s3.upload_fileobj(buffer, bucket, output_key,
+                      Config=TransferConfig(multipart_threshold=OUTPUT_MULTIPART_THRESHOLD_MB * 1024 * 1024,
+                                            multipart_chunksize=OUTPUT_MULTIPART_CHUNK_MB * 1024 * 1024))
+    log_to_cloudwatch(logs_client=logs_client,message=f"Uploaded {output_key} to S3 ({buffer.getbuffer().nbytes} bytes)")
+    logger.info(f"Uploaded {output_key} to S3")
+    return [output_key]
+
+
 #input - json with dicts for diffrent photos and sliced, output - triger diffrent lamdas and give them:
 # (1)an ofset file (2)rellevant information for finding the images in the bucket
 # i need to do same test on how mach can be done in one lambada, and aggragate base on this (/split more in the earlyer stages)
+@flush_logs_after
 def lambda_handler(event, context):
     """
     AWS Lambda handler that processes tree detection on images stored in S3.
     Loads images based on offset data from a JSON file, runs detection model,
-    and saves results as shapefiles back to S3.
+    and saves the results back to S3 in OUTPUT_FORMAT (shapefiles by default).
 
     Args:
         event: AWS Lambda event containing S3 trigger information
@@ -37,7 +165,10 @@ def lambda_handler(event, context):
     Returns:
         dict: Response with status code and processing confirmation message
     """
-
+    global cold_start
+    handler_start = time.perf_counter()
+    first_tile_seconds = None
+    fetch_seconds, fetch_wait_seconds, process_seconds = 0.0, 0.0, 0.0
     bucket = event['Records'][0]['s3']['bucket']['name']
     json_key = event['Records'][0]['s3']['object']['key']
     print(json_key)
@@ -55,71 +186,116 @@ def lambda_handler(event, context):
 
     transform = Affine(1.0, 0.0, 0.0,
        0.0, 1.0, 0.0)
-    model = load_model(MODEL_PATH)
+    model, model_load_seconds, model_sha256 = get_model(MODEL_PATH)
+    # tiles already processed with the same model and parameters (a date run again) are not run again
+    tile_cache = make_tile_cache(bucket, model_sha256,
+                                 lambda: boto3.client('s3', aws_access_key_id=aws_access_key_id,
+                                                      aws_secret_access_key=aws_secret_access_key))
     # crs = None
-    folder = f"images/{json_key[json_key.find('/')+1:][:json_key[json_key.find('/')+1:].find('/')]}"
+    run_id = json_key[json_key.find('/')+1:][:json_key[json_key.find('/')+1:].find('/')]
+    # offsets of a single ingested file are named "<date>_<file>", the tiles are still under images/<date>
+    folder = f"images/{run_id.split('_')[0]}"
     uploded = ['']
     not_uploded = ['']
+    deadline = Deadline(context)
+    continuation = {}  # offsets of the tiles left for the next invocation, per TIF
     for tif_file, png_dict in offsets_dict.items(): #now there is only one tif per offset, but in the futer maybe more
-        polygons_info = []
+        if deadline.expired:
+            continuation[tif_file] = png_dict
+            continue
         IMAGE_NAME = tif_file
         offsets = png_dict
+        meta = offsets.get(META_KEY, {})
+        if meta.get('generation') and is_merged(s3, bucket, run_id, tif_file, meta['generation']):
+            # a retried part of a TIF that is already merged, its partial would never be read
+            log_to_cloudwatch(logs_client=logs_client,message=f"{tif_file}: generation {meta['generation']} is already merged, skipping")
+            continue
+        bundle = meta.get('bundle')
+        png_names = [name for name in offsets.keys() if '.png' in name]
+        if bundle:
+            # all tiles of the TIF live in one object, read them with (coalesced) ranged GETs
+            bundle_reader = BundleReader(s3_client=s3, BUCKET_NAME=bucket, bundle_key=f"{folder}/{bundle['file']}",
+                                         index=bundle['index'], names=png_names)
+            fetch = bundle_reader.read
+        else:
+            fetch = lambda png_image: fetch_image(s3_client=s3,BUCKET_NAME=bucket,image_path=os.path.join(folder, png_image))
+        # the next tiles are downloaded while the current one is in the model
+        prefetcher = TilePrefetcher(fetch, png_names)
+        tile_polygons = {}
+        for png_image, polygons, error, seconds in process_tiles(deadline.tiles(prefetcher), model, transform, offsets,
+                                                                  halo=meta.get('halo', 0), cache=tile_cache):
+            if error is not None:
+                log_to_cloudwatch(logs_client=logs_client,message=f"failed to process {png_image}: {str(error)}")
+                not_uploded.append(png_image)
+                continue
+            print(f" activate the model on {png_image}")
+            log_to_cloudwatch(logs_client=logs_client,message=f"activate the model on {png_image}")
+            process_seconds += seconds
+            deadline.record(seconds)
+            tile_polygons[png_image] = polygons
+            if first_tile_seconds is None:
+                first_tile_seconds = time.perf_counter() - handler_start
+        # tiles finish out of order on the workers, keep the serial order of the output
+        tile_polygons = {png_image: tile_polygons[png_image] for png_image in png_names if png_image in tile_polygons}
+        tile_offsets = offsets
+        fetch_seconds += prefetcher.fetch_seconds
+        fetch_wait_seconds += prefetcher.wait_seconds
+
+        remaining = png_names[len(deadline.taken):]
+        generation = None
+        if remaining or 'total_tiles' in meta:
+            # the TIF is processed over several invocations: save this part, the last one merges them
+            part, part_continuation = meta.get('part', '0'), meta.get('continuation', 0)
+            total_tiles = meta.get('total_tiles', len(png_names))
+            # set by the activator when it splits the TIF, a TIF left unfinished by one invocation starts its own
+            generation = meta.get('generation') or uuid.uuid4().hex
+            write_partial(s3, bucket, partial_key(run_id, tif_file, generation, part, part_continuation), tile_polygons,
+                          offsets, tiles=len(deadline.taken))
+            if remaining:
+                continuation[tif_file] = {name: offsets[name] for name in remaining}
+                continuation[tif_file][META_KEY] = {**meta, 'part': part, 'continuation': part_continuation + 1,
+                                                    'total_tiles': total_tiles, 'generation': generation}
+                log_to_cloudwatch(logs_client=logs_client,message=f"{tif_file}: time is running out, {len(remaining)} tiles left for the next invocation")
+            tiles_done, tile_polygons, tile_offsets = read_partials(s3, bucket, run_id, tif_file, generation)
+            if tiles_done < total_tiles:
+                continue
+            if not claim_merge(s3, bucket, run_id, tif_file, generation):
+                # parts that finished at the same time, the other invocation merges them
+                log_to_cloudwatch(logs_client=logs_client,message=f"{tif_file}: the parts are merged by another invocation")
+                continue
+            log_to_cloudwatch(logs_client=logs_client,message=f"{tif_file}: all {total_tiles} tiles processed, merging the parts")
+        output_key = f'{OUTPUT_FOLDER_S3}/{run_id}/{IMAGE_NAME}{OUTPUT_SUFFIXES[OUTPUT_FORMAT]}'
+        try:
+            # crowns cut by a tile edge come out as one polygon
+            polygons_info = merge_seams(tile_polygons, tile_offsets, meta.get('tile_size'), transform)
+            uploded.extend(upload_polygons(s3, bucket, polygons_info, output_key))
+        except Exception:
+            if generation is not None:
+                release_merge(s3, bucket, run_id, tif_file, generation)
+            raise
+        if generation is not None:
+            # the merged result is uploaded, a later run of the TIF must not count these parts
+            deleted = delete_partials(s3, bucket, run_id, tif_file, generation)
+            log_to_cloudwatch(logs_client=logs_client,message=f"{tif_file}: {deleted} partial results deleted")
 
-        for png_image in offsets.keys():
-            log_to_cloudwatch(logs_client=logs_client,message=f"start procceding {png_image}")
-            if '.png' in png_image: 
-                image_path = os.path.join(folder, png_image)
-                print(f"loading {png_image}")
-                log_to_cloudwatch(logs_client=logs_client,message=f"loading {png_image}")
-                try:
-                    temp_image= load_image(s3_client=s3,BUCKET_NAME=bucket,image_path=image_path) # i chackted this part in lambada and it is working :) 
-                    print(f" {png_image} loaded")
-                    log_to_cloudwatch(logs_client=logs_client,message=f"{png_image} loaded")
-                    polygons = process_image(png_image, temp_image_path=temp_image, transform=transform, offsets=offsets,model=model) #TODO chack on lambada
-                    print(f" activate the model on {png_image}")
-                    log_to_cloudwatch(logs_client=logs_client,message=f"activate the model on {png_image}")
-                    polygons_info.extend(polygons)
-                    delete_temp_image(temp_image)
-                except:
-                    not_uploded.append(png_image)
-
-        gdf = gpd.GeoDataFrame({'geometry': polygons_info})
-
-        output_shp_key = f'{OUTPUT_FOLDER_S3}/{json_key[json_key.find('/')+1:][:json_key[json_key.find('/')+1:].find('/')]}/{IMAGE_NAME}_shapefile.shp'
-            # Create a temporary directory
-        with tempfile.TemporaryDirectory() as tmpdir:
-            # Define temporary file path
-            temp_shp_path = os.path.join(tmpdir, 'temp.shp')
-            
-            # Save GeoDataFrame to temporary file
-            gdf.to_file(temp_shp_path)
-            print( "we finish gdf")
-            # Upload all related files (.shp, .shx, .dbf, .prj)
-            temp_files = []
-            for file in os.listdir(tmpdir):
-                if file.startswith('temp'):
-                    # Get file extension
-                    _, ext = os.path.splitext(file)
-                    
-                    # Create corresponding S3 key with original name
-                    s3_key = output_shp_key.replace('.shp', ext)
-                    file_path = os.path.join(tmpdir, file)
-                    temp_files.append(file_path)
-
-                    # Upload file to S3
-                    with open(os.path.join(tmpdir, file), 'rb') as f:
-                        s3.upload_fileobj(f, bucket, s3_key)
-                        log_to_cloudwatch(logs_client=logs_client,message=f"Uploaded {s3_key} to S3")
-                        logger.info(f"Uploaded {s3_key} to S3")
-                        uploded.append(s3_key)
-                # Explicitly delete temporary files
-            for file_path in temp_files:
-                try:
-                    os.remove(file_path)
-                    logger.info(f"Deleted temporary file: {file_path}")
-                except OSError as e:
-                    logger.warning(f"Error deleting {file_path}: {e}")
-                    log_to_cloudwatch(logs_client=logs_client,message=f"Error deleting {file_path}: {e}")
+    if continuation:
+        # triggers this function again on the tiles left
+        next_key = continuation_key(json_key)
+        s3.put_object(Bucket=bucket, Key=next_key, Body=bytes(json.dumps(continuation).encode('UTF-8')))
+        log_to_cloudwatch(logs_client=logs_client,message=f"continuation offsets uploaded to {next_key}")
+    timings = {'cold_start': cold_start,
+               'model_load_seconds': round(model_load_seconds + (init_model_load_seconds if cold_start else 0.0), 3),
+               'first_tile_seconds': None if first_tile_seconds is None else round(first_tile_seconds, 3),
+               'fetch_seconds': round(fetch_seconds, 3),
+               'fetch_wait_seconds': round(fetch_wait_seconds, 3),  # download time not hidden behind the model
+               'hidden_fetch_seconds': round(max(fetch_seconds - fetch_wait_seconds, 0.0), 3),
+               'process_seconds': round(process_seconds, 3)}
+    if cold_start:
+        timings['init_seconds'] = round(init_seconds, 3)
+        timings['import_seconds'] = import_seconds
+    cold_start = False
+    logger.info(f"timings: {json.dumps(timings)}")
+    log_to_cloudwatch(logs_client=logs_client,message=f"timings: {json.dumps(timings)}")
     email_body = f"""the following file uploded to s3: {' \n '.join(uploded)},
                      the following image not processed: {' \n '.join(not_uploded)} """
     message = {
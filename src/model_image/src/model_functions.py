@@ -1,40 +1,237 @@
 import numpy as np
 import detectree as dtr
+import hashlib
+import json
+import logging
+import multiprocessing
 import os
 import pickle
+import re
+import threading
+import time
+import shapely
+import rasterio
+from scipy import ndimage
 from skimage.measure import find_contours
+from rasterio.features import shapes
 import geopandas as gpd
 from shapely.ops import unary_union
+from shapely.strtree import STRtree
 from shapely.geometry import Polygon, MultiPolygon, GeometryCollection
-from shapely.geometry import JOIN_STYLE
+from shapely.geometry import JOIN_STYLE, box, shape
 from src.config_model import MODEL_PATH,OUTPUT_FOLDER, simplification_tolerance,min_polygon_points,min_contour_points,join_mitre_leange,contours_level,min_area
+from src.config_model import BUNDLE_COALESCE_MAX_MB,BUNDLE_COALESCE_MAX_GAP_KB,IN_MEMORY_MAX_MB,PREFETCH_DEPTH,PREFETCH_MAX_MB
+from src.config_model import MODEL_WORKERS,MODEL_THREADS_PER_WORKER
+from src.config_model import DEADLINE_RESERVE_SECONDS,PARTIALS_FOLDER_S3,OFFSETS_FOLDER_S3,POLYGON_ENGINE,SEAM_TOLERANCE_PX
+from src.config_model import TILE_CACHE,TILE_CACHE_DIR,TILE_CACHE_MAX_MB,TILE_CACHE_FOLDER_S3,TILE_CACHE_VERSION
+from src.config_model import PRESCREEN,PRESCREEN_DOWNSAMPLE,PRESCREEN_EXG_THRESHOLD,PRESCREEN_MIN_COVER
 
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from multiprocessing.connection import wait
+from rasterio.io import MemoryFile
+from rasterio.windows import Window
+from rasterio.enums import Resampling
 from tempfile import NamedTemporaryFile
+from botocore.exceptions import ClientError
+
+logger = logging.getLogger(__name__)
 
 # TODO - צריך דרך לעדכן את הקונפיג מבחוץ בקלות, אולי להוסיף שלב של משיכה של קובץ קונפיג מאס3
 
-def load_image(s3_client,BUCKET_NAME,image_path):
+def fetch_image(s3_client, BUCKET_NAME, image_path, max_in_memory=IN_MEMORY_MAX_MB * 1024 * 1024):
     """
-    Downloads an image from S3 to a temporary local file.
+    Reads an image from S3 into memory, or streams it to a temporary local file when it is larger than max_in_memory.
 
     Args:
         s3_client: Boto3 S3 client
         BUCKET_NAME: Name of S3 bucket
         image_path: Path to image in S3
+        max_in_memory: int, largest image (bytes) kept in memory
 
     Returns:
-        str: Path to temporary local image file
+        bytes of the encoded image, or str path of the temporary local file
     """
+    response = s3_client.get_object(Bucket=BUCKET_NAME, Key=image_path)
+    if response['ContentLength'] <= max_in_memory:
+        return response['Body'].read()
     with NamedTemporaryFile(suffix='.png', delete=False) as temp_file:
-            temp_image_path = temp_file.name
-            
-            # Download the file from S3 to the temporary file
-            s3_client.download_file(
-                Bucket=BUCKET_NAME,
-                Key=image_path,
-                Filename=temp_image_path
-            )
-    return temp_image_path
+        for chunk in iter(lambda: response['Body'].read(8 * 1024 * 1024), b''):
+            temp_file.write(chunk)
+    return temp_file.name
+
+@contextmanager
+def local_image(image):
+    """
+    Gives the model a path it can open for an image returned by fetch_image (or read from a bundle).
+    Bytes are exposed as a GDAL in-memory file (/vsimem), so they are decoded without touching the disk;
+    a temporary local file is used as is and deleted afterwards.
+
+    Args:
+        image: bytes of the encoded image, or str path of a temporary local file
+
+    Yields:
+        str: path to pass to model.predict_img
+    """
+    if isinstance(image, str):
+        try:
+            yield image
+        finally:
+            delete_temp_image(image)
+    else:
+        with MemoryFile(image, ext='.png') as memory_file:
+            yield memory_file.name
+
+def plan_bundle_reads(index, names, max_bytes=BUNDLE_COALESCE_MAX_MB * 1024 * 1024,
+                      max_gap=BUNDLE_COALESCE_MAX_GAP_KB * 1024):
+    """
+    Groups the byte ranges of the requested tiles into as few GETs as possible.
+    Ranges are merged while the gap to the next one is at most max_gap and the group stays under max_bytes.
+
+    Args:
+        index: dict, tile name -> [byte start, byte length] in the bundle
+        names: list of tile names to read
+        max_bytes: int, maximum size of one GET
+        max_gap: int, maximum number of unused bytes fetched between two tiles
+
+    Returns:
+        list: (start, end, tile names) per GET, end exclusive
+    """
+    groups = []
+    for name in sorted(names, key=lambda name: index[name][0]):
+        start, length = index[name]
+        end = start + length
+        if groups and start - groups[-1][1] <= max_gap and end - groups[-1][0] <= max_bytes:
+            groups[-1][1] = max(groups[-1][1], end)
+            groups[-1][2].append(name)
+        else:
+            groups.append([start, end, [name]])
+    return [tuple(group) for group in groups]
+
+class BundleReader:
+    """
+    Reads tiles out of a tile bundle in S3 with ranged GETs.
+    Neighbouring tiles are coalesced (see plan_bundle_reads) and only the current GET is kept in memory.
+    Safe to call from the prefetch threads.
+    """
+
+    def __init__(self, s3_client, BUCKET_NAME, bundle_key, index, names,
+                 max_bytes=BUNDLE_COALESCE_MAX_MB * 1024 * 1024, max_gap=BUNDLE_COALESCE_MAX_GAP_KB * 1024):
+        self.s3_client = s3_client
+        self.bucket_name = BUCKET_NAME
+        self.bundle_key = bundle_key
+        self.index = index
+        self.groups = plan_bundle_reads(index, names, max_bytes, max_gap)
+        self.group_of = {name: g for g, (_, _, group_names) in enumerate(self.groups) for name in group_names}
+        self.loaded_group = None
+        self.loaded_body = None
+        self.gets = 0
+        self.lock = threading.Lock()
+
+    def read(self, name):
+        """
+        Returns the bytes of one tile, fetching its group if it is not the one in memory.
+        """
+        g = self.group_of[name]
+        group_start, group_end, _ = self.groups[g]
+        with self.lock:
+            if self.loaded_group != g:
+                self.loaded_body = None
+                response = self.s3_client.get_object(Bucket=self.bucket_name, Key=self.bundle_key,
+                                                     Range=f"bytes={group_start}-{group_end - 1}")
+                self.loaded_body = response['Body'].read()
+                self.loaded_group = g
+                self.gets += 1
+            body = self.loaded_body
+        start, length = self.index[name]
+        return body[start - group_start:start - group_start + length]
+
+class TilePrefetcher:
+    """
+    Downloads the next tiles in background threads while the current one is processed.
+    At most depth downloads run ahead of the consumer, and no new one starts while the tiles held
+    in memory (downloaded or expected, by the average size so far) would go over max_bytes.
+    Tiles fetched to a temporary file (see fetch_image) don't count against the cap.
+    """
+
+    def __init__(self, fetch, names, depth=PREFETCH_DEPTH, max_bytes=PREFETCH_MAX_MB * 1024 * 1024):
+        """
+        Args:
+            fetch: function, tile name -> image (bytes or temporary file path)
+            names: list of tile names, in processing order
+            depth: int, tiles downloaded ahead (0 = download each tile when it is needed)
+            max_bytes: int, cap on the downloaded bytes held ahead of the consumer
+        """
+        self.fetch = fetch
+        self.names = list(names)
+        self.depth = depth
+        self.max_bytes = max_bytes
+        self.fetched_bytes = 0
+        self.fetched = 0
+        self.fetch_seconds = 0.0  # time spent downloading, summed over the threads
+        self.wait_seconds = 0.0  # time the consumer was blocked on a download
+        self.lock = threading.Lock()
+
+    def _fetch(self, name):
+        start = time.perf_counter()
+        image = self.fetch(name)
+        with self.lock:
+            self.fetch_seconds += time.perf_counter() - start
+            self.fetched += 1
+            self.fetched_bytes += 0 if isinstance(image, str) else len(image)
+        return image
+
+    def _held_bytes(self, pending):
+        held = sum(len(future.result()) for _, future in pending
+                   if future.done() and future.exception() is None and not isinstance(future.result(), str))
+        running = sum(1 for _, future in pending if not future.done())
+        average = self.fetched_bytes / self.fetched if self.fetched else 0
+        return held + running * average
+
+    def __iter__(self):
+        """
+        Yields:
+            tuple: (tile name, image, None) or (tile name, None, exception) when the download failed
+        """
+        if self.depth <= 0:
+            for name in self.names:
+                start = time.perf_counter()
+                try:
+                    image, error = self._fetch(name), None
+                except Exception as e:
+                    image, error = None, e
+                self.wait_seconds += time.perf_counter() - start
+                yield name, image, error
+            return
+        names = iter(self.names)
+        pending = deque()
+        with ThreadPoolExecutor(max_workers=self.depth) as executor:
+            def fill():
+                average = self.fetched_bytes / self.fetched if self.fetched else 0
+                # until a first tile size is known, only one download runs
+                while len(pending) < self.depth and (not pending or (self.fetched and
+                                                                     self._held_bytes(pending) + average <= self.max_bytes)):
+                    name = next(names, None)
+                    if name is None:
+                        return
+                    pending.append((name, executor.submit(self._fetch, name)))
+            try:
+                fill()
+                while pending:
+                    name, future = pending.popleft()
+                    start = time.perf_counter()
+                    error = future.exception()
+                    self.wait_seconds += time.perf_counter() - start
+                    fill()
+                    yield (name, None, error) if error else (name, future.result(), None)
+            finally:
+                # the consumer stopped early: drop what was downloaded ahead
+                for _, future in pending:
+                    future.cancel()
+                for _, future in pending:
+                    if not future.cancelled() and future.exception() is None and isinstance(future.result(), str):
+                        delete_temp_image(future.result())
 
 def delete_temp_image(temp_image_path):
         if os.path.exists(temp_image_path):
@@ -92,15 +289,332 @@ def create_polygons(mask, simplification_tolerance = 1.0,min_polygon_points = 3,
 
     return final_polygons
 
+def create_polygons_shapes(mask, simplification_tolerance = 1.0,min_polygon_points = 3,
+                           min_contour_points = 3,join_mitre_leange = 1,contours_level = 0.5,min_area = 20.0):
+    """
+    Converts a binary mask to simplified polygons by tracing the pixel edges of its connected regions
+    (rasterio.features.shapes), holes included.
+    Nearby areas are joined by dilating the mask by join_mitre_leange pixels, instead of buffering and
+    merging every polygon, and the result is shifted by half a pixel to the pixel-center coordinates of find_contours.
+
+    Args:
+        mask: Binary numpy array representing tree detection mask
+        simplification_tolerance: Tolerance for polygon simplification
+        min_polygon_points: Minimum points required for a valid polygon
+        min_contour_points: Unused, same arguments as create_polygons
+        join_mitre_leange: Dilation (pixels) joining nearby areas
+        contours_level: Unused, same arguments as create_polygons
+        min_area: Minimum area required to keep a polygon
+
+    Returns:
+        list: List of simplified Shapely polygons
+    """
+    canopy = np.asarray(mask) > 0
+    if join_mitre_leange >= 1:
+        size = 2 * int(join_mitre_leange) + 1
+        canopy = ndimage.binary_dilation(canopy, structure=np.ones((size, size), dtype=bool))
+    polygons = [shape(geometry) for geometry, _ in shapes(canopy.astype(np.uint8), mask=canopy, connectivity=8)]
+    if not polygons:
+        return []
+    polygons = shapely.transform(np.asarray(polygons, dtype=object), lambda coords: coords - 0.5)
+    # with 8-connectivity, holes touching at a corner make a polygon invalid, split it into valid parts
+    invalid = ~shapely.is_valid(polygons)
+    if invalid.any():
+        repaired = shapely.get_parts(shapely.buffer(polygons[invalid], 0))
+        polygons = np.concatenate([polygons[~invalid], repaired[shapely.get_type_id(repaired) == 3]])
+
+    filtered_polygons = [polygon for polygon in polygons
+                         if len(polygon.exterior.coords) >= min_polygon_points and polygon.area >= min_area]
+
+    simplified_polygons = [polygon.simplify(simplification_tolerance, preserve_topology=True) for polygon in filtered_polygons]
+
+    return [polygon for polygon in simplified_polygons if not polygon.is_empty and polygon.is_valid]
+
+POLYGON_ENGINES = {'contours': create_polygons, 'shapes': create_polygons_shapes}
+
 def load_model(MODEL_PATH):
     clf = pickle.load(open(MODEL_PATH, 'rb'))
     clf_v1 = dtr.Classifier(clf=clf)
     return clf_v1
 
+model_cache = {}  # model file sha256 -> classifier, lives as long as the (warm) Lambda sandbox
+
+def model_sha256(model_path):
+    with open(model_path, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+def get_model(model_path=MODEL_PATH):
+    """
+    Returns the classifier of model_path, loading it only if the file content changed since the last call.
+
+    Args:
+        model_path: Path to the pickled classifier
+
+    Returns:
+        tuple: (classifier, seconds spent loading it, 0 when it came from the cache, sha256 of the model file)
+    """
+    sha256 = model_sha256(model_path)
+    if sha256 in model_cache:
+        return model_cache[sha256], 0.0, sha256
+    start = time.perf_counter()
+    model = load_model(model_path)
+    model_cache.clear()  # a swapped model replaces the old one
+    model_cache[sha256] = model
+    return model, time.perf_counter() - start, sha256
+
+def image_sha256(image):
+    """sha256 of an image returned by fetch_image (bytes, or the path of a temporary local file)."""
+    if not isinstance(image, str):
+        return hashlib.sha256(image).hexdigest()
+    digest = hashlib.sha256()
+    with open(image, 'rb') as f:
+        for chunk in iter(lambda: f.read(8 * 1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def tile_cache_key(tile_sha256, model_sha256, params):
+    """
+    Key of the polygons of a tile: the tile content, the model file and the mask to polygons parameters.
+
+    Args:
+        tile_sha256: str, sha256 of the encoded tile
+        model_sha256: str, sha256 of the model file
+        params: dict, parameters of process_image that change the polygons
+
+    Returns:
+        str: hex digest
+    """
+    key = json.dumps([TILE_CACHE_VERSION, tile_sha256, model_sha256, params], sort_keys=True, default=str)
+    return hashlib.sha256(key.encode('UTF-8')).hexdigest()
+
+def encode_polygons(polygons):
+    return json.dumps(shapely.to_wkb(polygons, hex=True).tolist() if polygons else []).encode('UTF-8')
+
+def decode_polygons(data):
+    polygons = json.loads(data)
+    return list(shapely.from_wkb(polygons)) if polygons else []
+
+class LocalTileCache:
+    """
+    Tile results (polygons in tile pixel coordinates) stored as files in a local directory.
+    Reads refresh the file mtime, and once max_bytes is exceeded the least recently used files are
+    deleted. The directory is shared by the forked tile workers, files are written atomically.
+    """
+
+    def __init__(self, directory, model_sha256, max_bytes=TILE_CACHE_MAX_MB * 1024 * 1024):
+        self.directory = str(directory)
+        self.model_sha256 = model_sha256
+        self.max_bytes = max_bytes
+        os.makedirs(self.directory, exist_ok=True)
+        self.written = 0
+        self.evict()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key)
+
+    def get(self, key):
+        try:
+            with open(self._path(key), 'rb') as f:
+                data = f.read()
+            os.utime(self._path(key))
+        except FileNotFoundError:
+            return None
+        return decode_polygons(data)
+
+    def put(self, key, polygons):
+        data = encode_polygons(polygons)
+        temp_path = f"{self._path(key)}.{os.getpid()}.tmp"
+        with open(temp_path, 'wb') as f:
+            f.write(data)
+        os.replace(temp_path, self._path(key))
+        self.written += len(data)
+        # the size is checked again after every tenth of max_bytes written by this process
+        if self.written * 10 >= self.max_bytes:
+            self.evict()
+
+    def evict(self):
+        """Deletes the least recently used results until the directory is under max_bytes."""
+        self.written = 0
+        files = []
+        for entry in os.scandir(self.directory):
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+class S3TileCache:
+    """
+    Tile results (polygons in tile pixel coordinates) stored as S3 objects under prefix, they outlive the
+    Lambda sandbox. Nothing is evicted here, expire the prefix with a bucket lifecycle rule.
+    Each process (forked tile workers included) creates its own client with client_factory.
+    """
+
+    def __init__(self, BUCKET_NAME, model_sha256, client_factory, prefix=TILE_CACHE_FOLDER_S3):
+        self.bucket = BUCKET_NAME
+        self.model_sha256 = model_sha256
+        self.client_factory = client_factory
+        self.prefix = prefix
+        self.clients = {}  # pid -> client
+
+    def _client(self):
+        if os.getpid() not in self.clients:
+            self.clients[os.getpid()] = self.client_factory()
+        return self.clients[os.getpid()]
+
+    def get(self, key):
+        try:
+            response = self._client().get_object(Bucket=self.bucket, Key=f"{self.prefix}/{key}")
+        except ClientError as e:
+            if e.response.get('Error', {}).get('Code') in ('NoSuchKey', '404'):
+                return None
+            raise
+        return decode_polygons(response['Body'].read())
+
+    def put(self, key, polygons):
+        self._client().put_object(Bucket=self.bucket, Key=f"{self.prefix}/{key}", Body=encode_polygons(polygons))
+
+def make_tile_cache(BUCKET_NAME, model_sha256, client_factory, kind=TILE_CACHE):
+    """
+    Creates the tile result cache selected in config_model (TILE_CACHE).
+
+    Returns:
+        LocalTileCache, S3TileCache or None when the cache is off
+    """
+    if kind == 'local':
+        return LocalTileCache(TILE_CACHE_DIR, model_sha256)
+    if kind == 's3':
+        return S3TileCache(BUCKET_NAME, model_sha256, client_factory)
+    return None
+
+def georeference(polygons, offset, transform):
+    """
+    Shifts polygons by the tile offset and applies the affine transform, as one array operation
+    over the coordinates of all the polygons (exteriors and holes).
+
+    Args:
+        polygons: list of polygons in tile pixel coordinates
+        offset: (column, row) of the tile in the source image
+        transform: Affine transformation for georeferencing
+
+    Returns:
+        list: georeferenced polygons
+    """
+    if not polygons:
+        return []
+
+    def to_world(coords):
+        x = coords[:, 0] + offset[0]
+        y = coords[:, 1] + offset[1]
+        # same operation order as Affine.__mul__, so the result is identical to transform * (x, y)
+        return np.column_stack((x * transform.a + y * transform.b + transform.c,
+                                x * transform.d + y * transform.e + transform.f))
+
+    return list(shapely.transform(np.asarray(polygons, dtype=object), to_world))
+
+def merge_seams(tile_polygons, offsets, tile_size, transform, tolerance=SEAM_TOLERANCE_PX):
+    """
+    Merges the polygons cut by tile edges (a crown crossing two tiles) back into one polygon.
+    Only the polygons within tolerance of their tile edge are indexed in an STRtree, and intersecting
+    pieces from different tiles are unioned, so the cost grows with the edge polygons, not all the polygons.
+
+    Args:
+        tile_polygons: dict, png name -> georeferenced polygons of the tile, in output order
+        offsets: dict, png name -> (x, y) offset of the tile
+        tile_size: int, size of the tiles in pixels, None to only concatenate the tiles
+        transform: Affine transformation for georeferencing
+        tolerance: float, distance (pixels) from the tile edge of the polygons checked
+
+    Returns:
+        list: the polygons of all the tiles, with the pieces of each cut polygon replaced by their union
+    """
+    polygons = [polygon for tile in tile_polygons.values() for polygon in tile]
+    if not tile_size or not polygons:
+        return polygons
+    distance = tolerance * max(np.hypot(transform.a, transform.d), np.hypot(transform.b, transform.e))
+    tile_edge = box(-0.5, -0.5, tile_size - 0.5, tile_size - 0.5).exterior
+    edge_index, edge_tile = [], []
+    position = 0
+    for t, (png_name, tile) in enumerate(tile_polygons.items()):
+        if tile:
+            edge = georeference([tile_edge], offsets[png_name], transform)[0]
+            near = np.flatnonzero(shapely.dwithin(np.asarray(tile, dtype=object), edge, distance))
+            edge_index.extend(position + near)
+            edge_tile.extend([t] * len(near))
+        position += len(tile)
+    if not edge_index:
+        return polygons
+
+    edge_polygons = [polygons[i] for i in edge_index]
+    parent = list(range(len(edge_polygons)))
+
+    def root(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    for i, j in STRtree(edge_polygons).query(edge_polygons, predicate='intersects').T:
+        if edge_tile[i] != edge_tile[j]:
+            parent[root(i)] = root(j)
+    groups = {}
+    for i in range(len(edge_polygons)):
+        groups.setdefault(root(i), []).append(i)
+
+    # each group takes the place of its first piece
+    replaced = {}
+    for group in groups.values():
+        if len(group) > 1:
+            merged = unary_union([edge_polygons[i] for i in group])
+            replaced[edge_index[group[0]]] = list(merged.geoms) if hasattr(merged, 'geoms') else [merged]
+            for i in group[1:]:
+                replaced[edge_index[i]] = []
+    merged_polygons = []
+    for i, polygon in enumerate(polygons):
+        merged_polygons.extend(replaced.get(i, [polygon]))
+    return merged_polygons
+
+def vegetation_cover(image_path, halo=0, downsample=PRESCREEN_DOWNSAMPLE, exg_threshold=PRESCREEN_EXG_THRESHOLD):
+    """
+    Share of the tile that looks like vegetation, a cheap stand-in for the classifier.
+    The excess green index (2g - r - b on the chromatic coordinates r = R / (R + G + B), ...) is computed
+    on a read of the tile (without its halo) averaged over downsample x downsample blocks, which also
+    smooths the pixel noise of grey surfaces.
+
+    Args:
+        image_path: str, path of the tile (a /vsimem path from local_image works)
+        halo: int, overlap margin (pixels) left out
+        downsample: int, downsampling factor of the read
+        exg_threshold: float, excess green above which a pixel counts as vegetation
+
+    Returns:
+        float: share of the pixels over exg_threshold
+    """
+    with rasterio.open(image_path) as src:
+        width, height = src.width - 2 * halo, src.height - 2 * halo
+        rgb = src.read([1, 2, 3], window=Window(halo, halo, width, height),
+                       out_shape=(3, max(1, height // downsample), max(1, width // downsample)),
+                       resampling=Resampling.average).astype(np.float32)
+    total = rgb.sum(axis=0)
+    total[total == 0] = 1
+    red, green, blue = rgb / total
+    return float(np.mean(2 * green - red - blue > exg_threshold))
+
 def process_image(png_name, transform,temp_image_path, offsets,model,
                   simplification_tolerance=simplification_tolerance,
                   min_polygon_points=min_polygon_points,min_contour_points=min_contour_points,
-                  join_mitre_leange=join_mitre_leange,contours_level=contours_level,min_area=min_area):
+                  join_mitre_leange=join_mitre_leange,contours_level=contours_level,min_area=min_area,
+                  polygon_engine=POLYGON_ENGINE,halo=0,cache=None,tile_sha256=None,
+                  prescreen=PRESCREEN,prescreen_min_cover=PRESCREEN_MIN_COVER):
     """
     Processes a single image through the tree detection model and converts results to georeferenced polygons.
 
@@ -111,35 +625,377 @@ def process_image(png_name, transform,temp_image_path, offsets,model,
         offsets: Dictionary of image offsets
         model: Loaded tree detection model
         **kwargs: Additional parameters for polygon creation
+        polygon_engine: 'contours' or 'shapes', see POLYGON_ENGINES
+        halo: int, overlap margin (pixels) of the tile, predicted on but cropped from the mask
+        cache: LocalTileCache or S3TileCache, on a hit the model is not run. The cache is best-effort,
+            a failed read runs the model and a failed write is only logged
+        tile_sha256: str, sha256 of the tile, needed to use the cache
+        prescreen: bool, skip the classifier on tiles with less than prescreen_min_cover vegetation
+            (see vegetation_cover)
+        prescreen_min_cover: float, share of vegetation pixels under which a tile is skipped
 
     Returns:
         list: List of georeferenced Shapely polygons representing detected trees
     """
     offset = offsets[png_name]
 
-    
-    # Predict models
-    y_pred = model.predict_img(temp_image_path)
+    if prescreen and vegetation_cover(temp_image_path, halo) < prescreen_min_cover:
+        return []
+
+    cache_key = None
+    if cache is not None and tile_sha256:
+        params = dict(simplification_tolerance=simplification_tolerance, min_polygon_points=min_polygon_points,
+                      min_contour_points=min_contour_points, join_mitre_leange=join_mitre_leange,
+                      contours_level=contours_level, min_area=min_area, polygon_engine=polygon_engine, halo=halo)
+        cache_key = tile_cache_key(tile_sha256, cache.model_sha256, params)
+        try:
+            polygons = cache.get(cache_key)
+        except Exception as e:
+            logger.warning(f"tile cache read failed for {png_name}: {str(e)}")
+            polygons = None
+        if polygons is not None:
+            return georeference(polygons, offset, transform) if polygons else []
+
+    polygons = prediction_polygons(model.predict_img(temp_image_path), halo, polygon_engine,
+                                   simplification_tolerance=simplification_tolerance,
+                                   min_polygon_points=min_polygon_points,min_contour_points=min_contour_points,
+                                   join_mitre_leange=join_mitre_leange,contours_level=contours_level,min_area=min_area)
+    if cache_key is not None:
+        try:
+            cache.put(cache_key, polygons)
+        except Exception as e:
+            logger.warning(f"tile cache write failed for {png_name}: {str(e)}")
+    return georeference(polygons, offset, transform) if polygons else []
 
-    # Process results
-    vegetation_mask = np.where(y_pred == 0, 0, 255)
+def prediction_polygons(y_pred, halo, polygon_engine, **kwargs):
+    """
+    Turns the prediction of a tile into polygons in tile pixel coordinates.
+
+    Args:
+        y_pred: prediction of model.predict_img
+        halo: int, overlap margin (pixels) cropped from the prediction
+        polygon_engine: 'contours' or 'shapes', see POLYGON_ENGINES
+        **kwargs: parameters of the polygon engine
+
+    Returns:
+        list: Shapely polygons
+    """
+    if halo:
+        # the margin only gives context to the classifier, the offset is the one of the tile itself
+        y_pred = y_pred[halo:-halo, halo:-halo]
 
-    polygons = create_polygons(vegetation_mask,simplification_tolerance=simplification_tolerance,
-                               min_polygon_points=min_polygon_points,min_contour_points=min_contour_points,
-                               join_mitre_leange=join_mitre_leange,contours_level=contours_level,
-                               min_area=min_area)
+    # Process results, a 0/255 uint8 mask (np.where would make an int64 one, 8x the memory)
+    vegetation_mask = (y_pred != 0).view(np.uint8) * np.uint8(255)
+    if not vegetation_mask.any():
+        return []
+    if vegetation_mask.all():
+        # the whole tile is canopy (find_contours has nothing to trace): one polygon on the tile edges,
+        # in the pixel-center coordinates of the engines
+        height, width = vegetation_mask.shape
+        return [box(-0.5, -0.5, width - 0.5, height - 0.5)]
 
-    adjusted_polygons = []
-    for polygon in polygons:
-        exterior_coords = [(x + offset[0], y + offset[1]) for x, y in polygon.exterior.coords]
-        interiors = []
-        for interior in polygon.interiors:
-            interior_coords = [(x + offset[0], y + offset[1]) for x, y in interior.coords]
-            interiors.append(interior_coords)\
+    return POLYGON_ENGINES[polygon_engine](vegetation_mask, **kwargs)
 
-        exterior_coords = [transform * (x, y) for x, y in exterior_coords]
-        interiors = [[transform * (x, y) for x, y in interior] for interior in interiors]
-        adjusted_polygon = Polygon(exterior_coords, interiors)
-        adjusted_polygons.append(adjusted_polygon)
+def set_model_threads(model, threads):
+    """
+    Limits the threads used by the classifier (LightGBM, OpenMP) and by OpenCV in the pixel features.
+
+    Args:
+        model: Loaded tree detection model
+        threads: int, number of threads
+    """
+    clf = getattr(model, 'clf', None)
+    if clf is not None and hasattr(clf, 'n_jobs'):
+        clf.n_jobs = threads
+    try:
+        import cv2
+        cv2.setNumThreads(threads)
+    except ImportError:
+        pass
 
-    return adjusted_polygons
\ No newline at end of file
+def process_tile(png_name, image, transform, offsets, model, halo=0, cache=None):
+    """
+    Runs process_image on an image returned by fetch_image (or read from a bundle).
+
+    Returns:
+        tuple: (list of georeferenced polygons, seconds spent)
+    """
+    start = time.perf_counter()
+    tile_sha256 = image_sha256(image) if cache is not None else None
+    with local_image(image) as temp_image:
+        polygons = process_image(png_name, temp_image_path=temp_image, transform=transform, offsets=offsets, model=model,
+                                 halo=halo, cache=cache, tile_sha256=tile_sha256)
+    return polygons, time.perf_counter() - start
+
+def _tile_worker(connection, model, threads, cache):
+    set_model_threads(model, threads)
+    while True:
+        task = connection.recv()
+        if task is None:
+            break
+        png_name, image, transform, offsets, halo = task
+        try:
+            polygons, seconds = process_tile(png_name, image, transform, offsets, model, halo, cache)
+            connection.send((png_name, polygons, None, seconds))
+        except Exception as e:
+            connection.send((png_name, None, RuntimeError(f"{type(e).__name__}: {e}"), 0.0))
+
+def _start_tile_worker(context, model, threads, cache):
+    parent_connection, child_connection = context.Pipe()
+    process = context.Process(target=_tile_worker, args=(child_connection, model, threads, cache), daemon=True)
+    process.start()
+    child_connection.close()
+    return process, parent_connection
+
+def process_tiles(tiles, model, transform, offsets, workers=MODEL_WORKERS, threads_per_worker=MODEL_THREADS_PER_WORKER,
+                  halo=0, cache=None):
+    """
+    Runs the model on a stream of tiles, on workers forked processes when workers > 1.
+    The workers are fed through Pipes, Lambda has no /dev/shm so multiprocessing Pool/Queue can't be used.
+    The forked workers share the loaded model, each one limited to threads_per_worker threads.
+    With workers > 1 the model never runs in the handler process, so the workers are not forked
+    from a process with a live OpenMP thread pool.
+
+    Args:
+        tiles: iterable of (png name, image, download error), e.g. a TilePrefetcher
+        model: Loaded tree detection model
+        transform: Affine transformation for georeferencing
+        offsets: Dictionary of image offsets
+        workers: int, number of worker processes (1 = serial, in this process)
+        threads_per_worker: int, classifier threads per worker, None = vCPUs / workers
+        halo: int, overlap margin (pixels) around the tiles, see process_image
+        cache: tile result cache (see make_tile_cache), None = always run the model
+
+    Yields:
+        tuple: (png name, polygons, error, seconds), in completion order
+    """
+    if workers <= 1:
+        for png_name, image, error in tiles:
+            if error is not None:
+                yield png_name, None, error, 0.0
+                continue
+            try:
+                polygons, seconds = process_tile(png_name, image, transform, offsets, model, halo, cache)
+                yield png_name, polygons, None, seconds
+            except Exception as e:
+                yield png_name, None, e, 0.0
+        return
+
+    threads = threads_per_worker or max(1, (os.cpu_count() or 1) // workers)
+    context = multiprocessing.get_context('fork')
+    pool = [_start_tile_worker(context, model, threads, cache) for _ in range(workers)]
+    idle = list(range(workers))
+    busy = {}  # worker -> png name
+    tiles = iter(tiles)
+    exhausted = False
+    try:
+        while True:
+            while idle and not exhausted:
+                tile = next(tiles, None)
+                if tile is None:
+                    exhausted = True
+                    break
+                png_name, image, error = tile
+                if error is not None:
+                    yield png_name, None, error, 0.0
+                    continue
+                worker = idle.pop()
+                pool[worker][1].send((png_name, image, transform, {png_name: offsets[png_name]}, halo))
+                busy[worker] = png_name
+            if not busy:
+                return
+            ready = wait([pool[worker][1] for worker in busy])
+            for worker in [worker for worker in busy if pool[worker][1] in ready]:
+                png_name = busy.pop(worker)
+                try:
+                    result = pool[worker][1].recv()
+                except EOFError:
+                    # the worker died (e.g. out of memory), replace it
+                    pool[worker][0].join()
+                    result = (png_name, None, RuntimeError(f"worker exited with code {pool[worker][0].exitcode}"), 0.0)
+                    pool[worker] = _start_tile_worker(context, model, threads, cache)
+                idle.append(worker)
+                yield result
+    finally:
+        for process, connection in pool:
+            try:
+                connection.send(None)
+            except (BrokenPipeError, OSError):
+                pass
+        for process, connection in pool:
+            process.join(timeout=5)
+            if process.is_alive():
+                process.terminate()
+            connection.close()
+
+class Deadline:
+    """
+    Stops handing out tiles when the invocation is about to run out of time: the time left must cover
+    the tiles already in flight (the slowest tile so far) plus reserve_seconds to save the work done.
+    The first tile of an invocation is always handed out, so a continuation always makes progress.
+    """
+
+    def __init__(self, context, reserve_seconds=DEADLINE_RESERVE_SECONDS):
+        self.context = context
+        self.reserve_seconds = reserve_seconds
+        self.tile_seconds = 0.0
+        self.started = False
+        self.expired = False
+        self.taken = []
+
+    def remaining_seconds(self):
+        if context_has_deadline(self.context):
+            return self.context.get_remaining_time_in_millis() / 1000
+        return float('inf')
+
+    def record(self, seconds):
+        """Records the processing time of a finished tile."""
+        self.tile_seconds = max(self.tile_seconds, seconds)
+
+    def tiles(self, tiles):
+        """
+        Passes tiles through until the deadline, the names handed out are kept in self.taken.
+
+        Args:
+            tiles: iterable of (png name, image, download error), e.g. a TilePrefetcher
+        """
+        self.taken = []
+        iterator = iter(tiles)
+        try:
+            while True:
+                if self.started and self.remaining_seconds() <= self.reserve_seconds + self.tile_seconds:
+                    self.expired = True
+                    return
+                tile = next(iterator, None)
+                if tile is None:
+                    return
+                self.started = True
+                self.taken.append(tile[0])
+                yield tile
+        finally:
+            if hasattr(iterator, 'close'):
+                iterator.close()  # drops the tiles downloaded ahead
+
+def context_has_deadline(context):
+    return context is not None and hasattr(context, 'get_remaining_time_in_millis')
+
+def partials_prefix(run_id, tif_file, generation):
+    # partials are scoped to one split of the TIF, a reprocess or a re-chunk starts a new generation
+    return f"{PARTIALS_FOLDER_S3}/{run_id}/{tif_file}/{generation}/"
+
+def partial_key(run_id, tif_file, generation, part, continuation):
+    return f"{partials_prefix(run_id, tif_file, generation)}{part}_{continuation}.json"
+
+def merged_key(run_id, tif_file, generation):
+    # written by the invocation that merges the generation, it stays as a tombstone once the partials are deleted
+    return f"{partials_prefix(run_id, tif_file, generation)}merged"
+
+def list_partials(s3_client, BUCKET_NAME, prefix):
+    keys = []
+    for page in s3_client.get_paginator('list_objects_v2').paginate(Bucket=BUCKET_NAME, Prefix=prefix):
+        keys.extend(item['Key'] for item in page.get('Contents', []) if item['Key'].endswith('.json'))
+    return keys
+
+def is_missing(error):
+    return error.response.get('Error', {}).get('Code') in ('NoSuchKey', '404', 'NotFound')
+
+def claim_merge(s3_client, BUCKET_NAME, run_id, tif_file, generation):
+    """
+    Makes the calling invocation the only one that merges a generation of a TIF: parts finishing at the
+    same time can all see every partial, only the first conditional write of the merged marker succeeds.
+
+    Returns:
+        bool: True if this invocation merges, False if another one already does
+    """
+    try:
+        s3_client.put_object(Bucket=BUCKET_NAME, Key=merged_key(run_id, tif_file, generation), Body=b'',
+                             IfNoneMatch='*')
+    except ClientError as e:
+        if e.response.get('Error', {}).get('Code') in ('PreconditionFailed', 'ConditionalRequestConflict', '412'):
+            return False
+        raise
+    return True
+
+def release_merge(s3_client, BUCKET_NAME, run_id, tif_file, generation):
+    """Removes the merged marker after a failed merge, so the retry of the invocation can claim it again."""
+    s3_client.delete_object(Bucket=BUCKET_NAME, Key=merged_key(run_id, tif_file, generation))
+
+def is_merged(s3_client, BUCKET_NAME, run_id, tif_file, generation):
+    """Whether a generation of a TIF was already merged, e.g. for a part retried after the merge."""
+    try:
+        s3_client.head_object(Bucket=BUCKET_NAME, Key=merged_key(run_id, tif_file, generation))
+    except ClientError as e:
+        if is_missing(e):
+            return False
+        raise
+    return True
+
+def write_partial(s3_client, BUCKET_NAME, key, tile_polygons, offsets, tiles):
+    """
+    Saves the polygons of part of a TIF to S3, per tile so the seams can be merged with the other parts.
+
+    Args:
+        s3_client: Boto3 S3 client
+        BUCKET_NAME: Name of S3 bucket
+        key: S3 key, see partial_key
+        tile_polygons: dict, png name -> georeferenced polygons of the tile
+        offsets: dict, png name -> offset of the tile
+        tiles: int, number of tiles covered (processed or failed)
+    """
+    body = json.dumps({'tiles': tiles,
+                       'offsets': {png_name: offsets[png_name] for png_name in tile_polygons},
+                       'polygons': {png_name: shapely.to_wkb(polygons, hex=True).tolist() if polygons else []
+                                    for png_name, polygons in tile_polygons.items()}})
+    s3_client.put_object(Bucket=BUCKET_NAME, Key=key, Body=body.encode('UTF-8'))
+
+def read_partials(s3_client, BUCKET_NAME, run_id, tif_file, generation):
+    """
+    Reads every partial result of a generation of a TIF, in part order.
+    A partial deleted between the listing and the read (a merge that just finished) is left out.
+
+    Returns:
+        tuple: (number of tiles covered, dict png name -> polygons, dict png name -> offset)
+    """
+    prefix = partials_prefix(run_id, tif_file, generation)
+    keys = list_partials(s3_client, BUCKET_NAME, prefix)
+    # "<part>_<continuation>.json", numeric order keeps the polygons in the order of a single run
+    keys.sort(key=lambda key: [int(number) for number in re.findall(r'\d+', key[len(prefix):])])
+    tiles, tile_polygons, offsets = 0, {}, {}
+    for key in keys:
+        try:
+            partial = json.loads(s3_client.get_object(Bucket=BUCKET_NAME, Key=key)['Body'].read())
+        except ClientError as e:
+            if is_missing(e):
+                continue
+            raise
+        tiles += partial['tiles']
+        offsets.update(partial['offsets'])
+        for png_name, polygons in partial['polygons'].items():
+            tile_polygons[png_name] = list(shapely.from_wkb(polygons)) if polygons else []
+    return tiles, tile_polygons, offsets
+
+def delete_partials(s3_client, BUCKET_NAME, run_id, tif_file, generation):
+    """
+    Deletes the partial results of a generation of a TIF, once its polygons are uploaded.
+    The merged marker is kept, see merged_key.
+
+    Returns:
+        int: number of deleted objects
+    """
+    keys = list_partials(s3_client, BUCKET_NAME, partials_prefix(run_id, tif_file, generation))
+    for start in range(0, len(keys), 1000):  # delete_objects takes at most 1000 keys
+        s3_client.delete_objects(Bucket=BUCKET_NAME,
+                                 Delete={'Objects': [{'Key': key} for key in keys[start:start + 1000]], 'Quiet': True})
+    return len(keys)
+
+def continuation_key(json_key):
+    """
+    Key of the offsets file that continues json_key.
+    small_offsets/<run>/<name>.json is continued by <name>_c1.json, which is continued by <name>_c2.json, ...
+    """
+    run_folder, name = json_key[len(OFFSETS_FOLDER_S3) + 1:].rsplit('/', 1)
+    name = name[:name.rfind('.json')]
+    match = re.search(r'_c(\d+)$', name)
+    continuation = int(match.group(1)) + 1 if match else 1
+    name = name[:match.start()] if match else name
+    return f"{OFFSETS_FOLDER_S3}/{run_folder}/{name}_c{continuation}.json"
@@ -3,6 +3,9 @@
 import json
 import sys
 import rasterio as rio
+from rasterio.errors import NotGeoreferencedWarning
+from rasterio.windows import Window
+from rasterio.enums import MaskFlags
 import numpy as np
 from PIL import Image
 from pathlib import Path
@@ -10,29 +13,149 @@ import os
 import pytz
 from datetime import datetime, timedelta
 import time
+import warnings
+import struct
+import zlib
+import resource
+import itertools
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
 
 
 project_root = str(Path(__file__).parent.parent)
 sys.path.insert(0, project_root)
 
 from src.logger import Logger  
-from config.config_pre_process import DEBUG,INPUT_FOLDER_PATH,IMAGE_SIZE,SPLIT_FOLDER,OFSETS_FOLDER,INPUT_PROCESSED_FOLDER_PATH,TIME_ZONE,RUN_H
+from config.config_pre_process import DEBUG,INPUT_FOLDER_PATH,IMAGE_SIZE,SPLIT_FOLDER,OFSETS_FOLDER,INPUT_PROCESSED_FOLDER_PATH,TIME_ZONE,RUN_H,INGEST_MODE,INGEST_MAX_CONCURRENT
+from config.config_pre_process import BLOCK_WISE_CONVERSION,BLOCK_ROWS,MAX_MEMORY_MB,GDAL_CACHE_MB,PRE_PROCESS_WORKERS,SKIP_EMPTY_TILES,DELETE_UPLOADED_TILES,TILE_OUTPUT,META_KEY,TILE_HALO
 
 import shutil
 
-from src.s3_upload import upload_to_s3
+from src.s3_upload import S3Uploader, TileUploadPipeline
+from src.ledger import ProcessingLedger, file_hash
+from src.ingest import IngestWatcher
 from config.config_aws import BUCKET_NAME, AWS_REGION
 from src.cloudwatch import logs_client,log_to_cloudwatch
 
 logger = Logger(logger_name='pre-process',logs_dir=os.path.join(project_root,'logs'),log_mode='DEBUG')
-def tif_to_png(tif_path, png_path,image_name):
+# Plain PNG inputs have no geotransform, which is fine for tiling.
+warnings.filterwarnings('ignore', category=NotGeoreferencedWarning)
+
+def peak_rss_mb():
+    """
+    Returns the peak resident memory of the current process in MB (Linux reports KB).
+    """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def block_rows_for(src, block_rows: int = BLOCK_ROWS, max_memory_mb: int = MAX_MEMORY_MB,
+                   gdal_cache_mb: int = GDAL_CACHE_MB, bands: int = 3):
+    """
+    Picks how many rows to process at a time so the working buffers stay under the memory ceiling.
+    The result is aligned to the TIF's internal block/strip height whenever at least one block fits.
+
+    Args:
+        src: open rasterio dataset
+        block_rows: int, requested number of rows per step
+        max_memory_mb: int, memory ceiling for buffers + GDAL block cache
+        gdal_cache_mb: int, memory reserved for the GDAL block cache
+        bands: int, number of bands read per row
+
+    Returns:
+        int: number of rows per step (at least 1)
+    """
+    # read buffer + interleaved copy + filtered PNG rows + GDAL's own interleaving buffers,
+    # measured at ~5x the raw row size with src/benchmarks/pre_process_memory.py, 6x keeps a margin
+    bytes_per_row = src.width * bands * np.dtype(src.dtypes[0]).itemsize * 6
+    budget = (max_memory_mb - gdal_cache_mb) * 1024 * 1024
+    rows = max(1, min(block_rows, budget // bytes_per_row, src.height))
+    block_height = src.block_shapes[0][0]
+    if rows >= block_height:
+        rows -= rows % block_height
+    return rows
+
+
+def iter_row_blocks(src, rows: int, bands=(1, 2, 3)):
+    """
+    Walks the raster top to bottom in full width row blocks.
+    The same buffers are reused for every block, copy a block if you need to keep it.
+
+    Args:
+        src: open rasterio dataset
+        rows: int, number of rows per block
+        bands: tuple, raster bands to read as R, G, B
+
+    Yields:
+        np.ndarray: array of shape (rows, width, len(bands)), the last block may be shorter
+    """
+    read_buffer = np.empty((len(bands), rows, src.width), dtype=src.dtypes[0])
+    rgb_buffer = np.empty((rows, src.width, len(bands)), dtype=src.dtypes[0])
+    for row in range(0, src.height, rows):
+        height = min(rows, src.height - row)
+        data = src.read(list(bands), window=Window(0, row, src.width, height), out=read_buffer[:, :height])
+        rgb = rgb_buffer[:height]
+        np.copyto(rgb, np.moveaxis(data, 0, -1))
+        yield rgb
+
+
+def _png_chunk(tag: bytes, data: bytes):
+    return struct.pack('>I', len(data)) + tag + data + struct.pack('>I', zlib.crc32(tag + data) & 0xffffffff)
+
+
+PNG_BIT_DEPTHS = {np.dtype('uint8'): 8, np.dtype('uint16'): 16}  # band types a PNG stores without loss
+
+
+def write_png_rows(png_file, width: int, height: int, row_blocks, dtype=np.uint8):
+    """
+    Streams an 8 or 16 bit RGB PNG to disk from blocks of rows, using the PNG "Up" filter.
+    Only the current block is held in memory, unlike PIL which needs the whole image
+    (and only writes 8 bit RGB).
+
+    Args:
+        png_file: str, destination PNG path
+        width: int, image width in pixels
+        height: int, image height in pixels
+        row_blocks: iterable of arrays of shape (rows, width, 3), top to bottom
+        dtype: band type of the blocks, uint8 or uint16 (see PNG_BIT_DEPTHS)
+    """
+    dtype = np.dtype(dtype)
+    if dtype not in PNG_BIT_DEPTHS:
+        raise ValueError(f"{dtype} bands can't be written to a PNG, only uint8 and uint16")
+    compressor = zlib.compressobj(6)
+    previous_row = np.zeros(width * 3 * dtype.itemsize, dtype=np.uint8)
+    filtered_buffer = None
+    with open(png_file, 'wb') as f:
+        f.write(b'\x89PNG\r\n\x1a\n')
+        f.write(_png_chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, PNG_BIT_DEPTHS[dtype], 2, 0, 0, 0)))
+        for block in row_blocks:
+            # PNG samples are big-endian, the filter works on their bytes
+            rows = block.astype(dtype.newbyteorder('>'), copy=False).view(np.uint8).reshape(block.shape[0], -1)
+            if filtered_buffer is None or filtered_buffer.shape[0] < rows.shape[0]:
+                filtered_buffer = np.empty((rows.shape[0], rows.shape[1] + 1), dtype=np.uint8)
+            filtered = filtered_buffer[:rows.shape[0]]
+            filtered[:, 0] = 2  # "Up" filter: each byte minus the byte above it
+            np.subtract(rows[0], previous_row, out=filtered[0, 1:])
+            np.subtract(rows[1:], rows[:-1], out=filtered[1:, 1:])
+            previous_row[:] = rows[-1]
+            data = compressor.compress(filtered)
+            if data:
+                f.write(_png_chunk(b'IDAT', data))
+        f.write(_png_chunk(b'IDAT', compressor.flush()))
+        f.write(_png_chunk(b'IEND', b''))
+
+
+def tif_to_png(tif_path, png_path,image_name, block_wise: bool = BLOCK_WISE_CONVERSION):
     """
     Converts a TIF image to PNG format.
+    In block-wise mode the TIF is streamed in row blocks, so peak memory stays under MAX_MEMORY_MB
+    whatever the image size: the validator converts whole orthophotos inside a Lambda.
+    8 bit TIFs give an 8 bit PNG and 16 bit TIFs a 16 bit PNG (always streamed, PIL only writes
+    8 bit RGB), other band types are not converted.
     
     Args:
         tif_path: str, path to source TIF file
         png_path: str, destination directory for PNG
         image_name: str, name for output PNG file
+        block_wise: bool, whether to convert block by block instead of reading the whole image
         
     Returns:
         bool: True if conversion successful, False otherwise
@@ -41,10 +164,21 @@ def tif_to_png(tif_path, png_path,image_name):
     log_to_cloudwatch(logs_client=logs_client,message="Convert tif to png in processing")
     try:
         with rio.open(tif_path) as src:
-            array = src.read([1, 2, 3])  # Read the first three bands (R, G, B)
-            rgb_array = np.dstack(array)  # Stack bands along the third dimension
-            image = Image.fromarray(rgb_array, 'RGB')
-            image.save(os.path.join(png_path,image_name))
+            dtype = np.dtype(src.dtypes[0])
+        if dtype not in PNG_BIT_DEPTHS:
+            raise ValueError(f"{dtype} bands can't be written to a PNG, only uint8 and uint16")
+        if block_wise or dtype != np.uint8:
+            with rio.Env(GDAL_CACHEMAX=GDAL_CACHE_MB), rio.open(tif_path) as src:
+                rows = block_rows_for(src)
+                write_png_rows(os.path.join(png_path,image_name), src.width, src.height,
+                               iter_row_blocks(src, rows), dtype)
+            logger.info(f'Block-wise conversion of {tif_path}: {rows} rows per block, peak RSS {peak_rss_mb():.0f}MB')
+        else:
+            with rio.open(tif_path) as src:
+                array = src.read([1, 2, 3])  # Read the first three bands (R, G, B)
+                rgb_array = np.dstack(array)  # Stack bands along the third dimension
+                image = Image.fromarray(rgb_array, 'RGB')
+                image.save(os.path.join(png_path,image_name))
         logger.info(f'Convert tif to png has been saved to {os.path.join(png_path,image_name)}')
         log_to_cloudwatch(logs_client=logs_client,message=f'Convert tif to png has been saved to {os.path.join(png_path,image_name)}')
 
@@ -57,15 +191,240 @@ def tif_to_png(tif_path, png_path,image_name):
         
 
 
-def split_image(image_path, out_folder, size: int, skip_empty: bool = False):
+def tile_offsets(width, height, size: int):
+    """
+    Lists the top-left offsets of the tile grid covering an image.
+    Columns are the outer loop, matching the order of the offsets files.
+
+    Args:
+        width: int, image width in pixels
+        height: int, image height in pixels
+        size: int, size of the tiles in pixels
+
+    Returns:
+        list: (x, y) offsets of the tiles
+    """
+    return [(i, j) for i in range(0, width, size) for j in range(0, height, size)]
+
+
+def read_tile(src, i, j, size: int, bands=(1, 2, 3), halo: int = 0):
+    """
+    Reads one tile from an open raster through a rasterio window.
+    Tiles crossing the image edges are zero padded to full size, like a PIL crop.
+
+    Args:
+        src: open rasterio dataset
+        i: int, x offset of the tile
+        j: int, y offset of the tile
+        size: int, size of the tile in pixels
+        bands: tuple, raster bands to read as R, G, B
+        halo: int, margin in pixels read around the tile on every side
+
+    Returns:
+        np.ndarray: array of shape (size + 2 * halo, size + 2 * halo, len(bands)), the tile at (halo, halo)
+    """
+    full = size + 2 * halo
+    left, top = max(i - halo, 0), max(j - halo, 0)
+    width = min(i - halo + full, src.width) - left
+    height = min(j - halo + full, src.height) - top
+    data = src.read(list(bands), window=Window(left, top, width, height))
+    tile = np.zeros((full, full, len(bands)), dtype=data.dtype)
+    x, y = left - (i - halo), top - (j - halo)
+    tile[y:y + height, x:x + width] = np.moveaxis(data, 0, -1)
+    return tile
+
+
+def empty_tile_grid(src, size: int, bands=(1, 2, 3)):
     """
-    Splits an image into smaller squares and saves them individually.
+    Finds the empty tiles of the grid in a single pass over the raster, before any tile is cropped.
+    A tile is empty when none of its pixels is valid according to the dataset mask (nodata, alpha
+    band or internal mask). Rasters without a mask fall back to the old rule: all bands equal to zero.
+
+    Args:
+        src: open rasterio dataset
+        size: int, size of the tiles in pixels
+        bands: tuple, raster bands to check
+
+    Returns:
+        np.ndarray: boolean bitmap of shape (n_columns, n_rows), True where the tile at
+        (i * size, j * size) is empty
+    """
+    has_mask = any(MaskFlags.all_valid not in src.mask_flag_enums[band - 1] for band in bands)
+    column_starts = np.arange(0, src.width, size)
+    step = min(size, block_rows_for(src))
+    valid = np.zeros((len(column_starts), len(range(0, src.height, size))), dtype=bool)
+    for r, tile_row in enumerate(range(0, src.height, size)):
+        for row in range(tile_row, min(tile_row + size, src.height), step):
+            window = Window(0, row, src.width, min(row + step, tile_row + size, src.height) - row)
+            if has_mask:
+                data = src.read_masks(list(bands), window=window)
+            else:
+                data = src.read(list(bands), window=window)
+            columns_valid = data.any(axis=(0, 1))
+            valid[:, r] |= np.logical_or.reduceat(columns_valid, column_starts)
+    return ~valid
+
+
+def iter_tiles(image_path, size: int, bands=(1, 2, 3), skip_empty: bool = False, halo: int = 0):
+    """
+    Iterates over the tiles of a raster, reading each one directly from the source file.
+    Only one tile is held in memory at a time, no intermediate PNG is created.
+
+    Args:
+        image_path: str, path to source image (TIF or anything else GDAL can read)
+        size: int, size of the tiles in pixels
+        bands: tuple, raster bands to read as R, G, B
+        skip_empty: bool, whether to leave out empty tiles (see empty_tile_grid) without reading them
+        halo: int, margin in pixels read around every tile (see read_tile)
+
+    Yields:
+        tuple: ((x, y) offset of the tile without the halo, np.ndarray tile of shape (size + 2 * halo, size + 2 * halo, 3))
+    """
+    with rio.Env(GDAL_CACHEMAX=GDAL_CACHE_MB), rio.open(image_path) as src:
+        empty = empty_tile_grid(src, size, bands) if skip_empty else None
+        for i, j in tile_offsets(src.width, src.height, size):
+            if empty is not None and empty[i // size, j // size]:
+                continue
+            yield (i, j), read_tile(src, i, j, size, bands, halo)
+
+
+def save_tile(tile, image_name, i, j, out_folder):
+    """
+    Encodes one tile to PNG in the split folder.
+
+    Args:
+        tile: np.ndarray, RGB tile
+        image_name: str, name of the source image, used as the tile name prefix
+        i: int, x offset of the tile
+        j: int, y offset of the tile
+        out_folder: str, output directory for split images
+
+    Returns:
+        str: tile file name
+    """
+    crop_filename = f"{image_name}_{i}_{j}.png" #IMAGE_NAME_PREFIX
+    Image.fromarray(tile, 'RGB').save(os.path.join(out_folder, crop_filename))
+    return crop_filename
+
+
+def _split_tile_row(image_path, out_folder, size: int, j: int, columns, halo: int = 0):
+    """
+    Process pool worker: tiles and encodes the given tiles of one row of the grid (y == j).
+
+    Returns:
+        dict: Mapping of split image filenames to their offset coordinates
+    """
+    image_name = Path(image_path).name
+    offsets = {}
+    with rio.Env(GDAL_CACHEMAX=GDAL_CACHE_MB), rio.open(image_path) as src:
+        for i in columns:
+            crop_filename = save_tile(read_tile(src, i, j, size, halo=halo), image_name, i, j, out_folder)
+            offsets[crop_filename] = (i, j)
+    return offsets
+
+
+def _split_parallel(image_paths, out_folder, size: int, skip_empty: bool, workers: int, on_tile=None, halo: int = 0,
+                    on_image=None):
+    """
+    Fans the tile rows of all images out over one process pool.
+    The grid of an image (and its empty tiles) is planned in the parent just before its rows are queued,
+    while the pool works on the rows of the images before it. Empty tiles are never sent to the workers.
+    At most 2 rows per worker are in flight, so a slow on_tile consumer also slows the tiling down.
+    The offsets of every image are put back in the serial (column major) order.
+    on_image is called with (image path, offsets) as soon as the last row of an image is done.
+
+    Returns:
+        tuple: (dict of image name -> offsets, dict of image name -> exception)
+    """
+    grids = {}
+    errors = {}
+    row_results = {}
+    rows_left = {}
+
+    def ordered_offsets(image_path):
+        by_offset = {tuple(offset): name for row_offsets in row_results[image_path] for name, offset in row_offsets.items()}
+        return {by_offset[offset]: offset for offset in grids[image_path] if offset in by_offset}
+
+    def row_tasks():
+        for image_path in image_paths:
+            try:
+                with rio.Env(GDAL_CACHEMAX=GDAL_CACHE_MB), rio.open(image_path) as src:
+                    grid = tile_offsets(src.width, src.height, size)
+                    if skip_empty:
+                        empty = empty_tile_grid(src, size)
+                        grid = [(i, j) for i, j in grid if not empty[i // size, j // size]]
+            except Exception as e:
+                errors[Path(image_path).name] = e
+                continue
+            grids[image_path] = grid
+            row_results[image_path] = []
+            rows = {}
+            for i, j in grid:
+                rows.setdefault(j, []).append(i)
+            rows_left[image_path] = len(rows)
+            if on_image and not rows:
+                on_image(image_path, {})  # every tile is empty
+            for j, columns in sorted(rows.items()):
+                yield image_path, j, columns
+
+    tasks = row_tasks()
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        pending = {}
+        while True:
+            for image_path, j, columns in itertools.islice(tasks, 2 * workers - len(pending)):
+                pending[executor.submit(_split_tile_row, image_path, out_folder, size, j, columns, halo)] = image_path
+            if not pending:
+                break
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                image_path = pending.pop(future)
+                rows_left[image_path] -= 1
+                try:
+                    row_offsets = future.result()
+                except Exception as e:
+                    errors[Path(image_path).name] = e
+                    continue
+                row_results[image_path].append(row_offsets)
+                if on_tile:
+                    for crop_filename in row_offsets:
+                        on_tile(os.path.join(out_folder, crop_filename))
+                if on_image and not rows_left[image_path] and Path(image_path).name not in errors:
+                    on_image(image_path, ordered_offsets(image_path))
+
+    results = {}
+    for image_path in grids:
+        if Path(image_path).name not in errors:
+            results[Path(image_path).name] = ordered_offsets(image_path)
+    return results, errors
+
+
+def report_skipped(image_path, size: int, offsets):
+    """
+    Logs how many empty tiles were skipped for an image.
+
+    Returns:
+        int: number of skipped tiles
+    """
+    with rio.open(image_path) as src:
+        skipped = len(tile_offsets(src.width, src.height, size)) - len(offsets)
+    logger.info(f'{image_path}: skipped {skipped} empty tiles')
+    log_to_cloudwatch(logs_client=logs_client,message=f'{image_path}: skipped {skipped} empty tiles')
+    return skipped
+
+
+def split_image(image_path, out_folder, size: int, skip_empty: bool = False, workers: int = 1, on_tile=None,
+                halo: int = 0):
+    """
+    Splits an image into smaller squares and saves them individually as PNG.
     
     Args:
-        image_path: str, path to source image
+        image_path: str, path to source image (TIF or PNG)
         out_folder: str, output directory for split images
         size: int, size of split squares in pixels
         skip_empty: bool, whether to skip empty image sections
+        workers: int, number of processes encoding tile rows in parallel (1 = serial)
+        on_tile: callable, called with the path of every tile as soon as it is written
+        halo: int, overlap margin in pixels added around every tile, the offsets stay those of the tile itself
         
     Returns:
         dict: Mapping of split image filenames to their offset coordinates
@@ -76,66 +435,365 @@ def split_image(image_path, out_folder, size: int, skip_empty: bool = False):
         Path(out_folder).mkdir(parents=True, exist_ok=True)
 
     image_name = Path(image_path).name
-    offsets = {}  # Dictionary to track offsets
-    with Image.open(image_path) as img:
-        width, height = img.size
-
-        for i in range(0, width, size):
-            for j in range(0, height, size):
-                box = (i, j, i + size, j + size)
-                crop = img.crop(box)
-                if skip_empty and np.sum(np.array(crop)) == 0:
-                    continue
-                crop_filename = f"{image_name}_{i}_{j}.png" #IMAGE_NAME_PREFIX
-                crop.save(os.path.join(out_folder, crop_filename))
-                offsets[crop_filename] = (i, j)  # Track the offset
+    if workers > 1:
+        results, errors = _split_parallel([image_path], out_folder, size, skip_empty, workers, on_tile, halo)
+        if errors:
+            raise errors[image_name]
+        offsets = results[image_name]
+    else:
+        offsets = {}  # Dictionary to track offsets
+        for (i, j), tile in iter_tiles(image_path, size, skip_empty=skip_empty, halo=halo):
+            crop_filename = save_tile(tile, image_name, i, j, out_folder)
+            offsets[crop_filename] = (i, j)  # Track the offset
+            if on_tile:
+                on_tile(os.path.join(out_folder, crop_filename))
+    if skip_empty:
+        report_skipped(image_path, size, offsets)
     logger.info(f'{image_path} splited images have been saved to {out_folder}')
     log_to_cloudwatch(logs_client=logs_client,message=f'{image_path} splited images have been saved to {out_folder}')
     return offsets  # Return the offsets for further use
 
-if __name__ == "__main__":
-    while True: #runs every day.
-        israel_tz = pytz.timezone(TIME_ZONE)
-        israel_time = datetime.now(israel_tz)
-        if israel_time.hour == RUN_H or DEBUG:# and israel_time.minute == 00:
-            if len(os.listdir(INPUT_FOLDER_PATH)):
-                offsets_dict = {}
-                for file_name in os.listdir(INPUT_FOLDER_PATH):
-                    file_path = os.path.join(INPUT_FOLDER_PATH, file_name)
-                    tif_to_png(tif_path=file_path,png_path=INPUT_FOLDER_PATH,image_name=file_name)
-                    try:
-                        offsets = split_image(image_path=os.path.join(INPUT_FOLDER_PATH,file_name),out_folder=SPLIT_FOLDER,size=IMAGE_SIZE)
-                        offsets_dict[file_name] = offsets
-                        # Create preprocessed folder path
-                        preprocessed_path = os.path.join(INPUT_PROCESSED_FOLDER_PATH, file_name)
-                        # Copy the original file to preprocessed folder
-                        shutil.copy2(file_path, preprocessed_path)
-                        # Remove the original file
-                        os.remove(file_path)
-                    except Exception as e:
-                        logger.error(f"got this exaption: {str(e)}")
-                        log_to_cloudwatch(logs_client=logs_client,message=f"got this exaption: {str(e)}")
-                # Generate the file name with the current date
-                current_date = datetime.now().strftime("%Y-%m-%d")  # Format: YYYY-MM-DD
-                json_name = f"{current_date}.json"
-                json_path = os.path.join(OFSETS_FOLDER, json_name)
-                with open(json_path, "w") as json_file:
-                    json.dump(offsets_dict, json_file, indent=4)  # `indent` makes the JSON more readable
+
+def write_bundle(tiles_folder, offsets, bundle_path):
+    """
+    Concatenates tile PNGs into one bundle file, in offsets order.
+
+    Args:
+        tiles_folder: str, folder holding the tile PNGs
+        offsets: dict, tile names to offsets as returned by split_image
+        bundle_path: str, destination bundle file
+
+    Returns:
+        dict: Mapping of tile names to [byte start, byte length] inside the bundle
+    """
+    index = {}
+    position = 0
+    with open(bundle_path, 'wb') as bundle:
+        for crop_filename in offsets:
+            with open(os.path.join(tiles_folder, crop_filename), 'rb') as tile:
+                shutil.copyfileobj(tile, bundle)
+            length = bundle.tell() - position
+            index[crop_filename] = [position, length]
+            position += length
+    return index
+
+
+def bundle_image(image_path, out_folder, size: int, skip_empty: bool = False, workers: int = 1, halo: int = 0):
+    """
+    Splits an image and packs all its tiles into a single indexed bundle ("<image name>.bundle"),
+    so the model fetches tiles with ranged GETs instead of one S3 object per tile.
+
+    Args:
+        image_path: str, path to source image (TIF or PNG)
+        out_folder: str, output directory for the bundle
+        size: int, size of split squares in pixels
+        skip_empty: bool, whether to skip empty image sections
+        workers: int, number of processes encoding tile rows in parallel (1 = serial)
+        halo: int, overlap margin in pixels added around every tile
+
+    Returns:
+        tuple: (offsets dict as returned by split_image, bundle path, bundle index)
+    """
+    image_name = Path(image_path).name
+    tiles_folder = os.path.join(out_folder, f".{image_name}_tiles")
+    bundle_path = os.path.join(out_folder, f"{image_name}.bundle")
+    try:
+        offsets = split_image(image_path, tiles_folder, size, skip_empty, workers, halo=halo)
+        index = write_bundle(tiles_folder, offsets, bundle_path)
+    finally:
+        shutil.rmtree(tiles_folder, ignore_errors=True)
+    logger.info(f'{image_path}: {len(index)} tiles bundled into {bundle_path}')
+    return offsets, bundle_path, index
+
+
+def bundle_images(image_paths, out_folder, size: int, skip_empty: bool = False, workers: int = PRE_PROCESS_WORKERS,
+                  on_bundle=None, halo: int = 0):
+    """
+    Splits several images over one process pool (like split_images) and packs the tiles of each image into
+    its bundle as soon as its last tile row is done, so the first bundles are uploaded while the other
+    images are still being tiled. Images that fail are logged and left out of the result.
+
+    Args:
+        image_paths: list of str, paths to source images
+        out_folder: str, output directory for the bundles
+        size: int, size of split squares in pixels
+        skip_empty: bool, whether to skip empty image sections
+        workers: int, number of worker processes (1 = serial)
+        on_bundle: callable, called with the path of every bundle as soon as it is written
+        halo: int, overlap margin in pixels added around every tile
+
+    Returns:
+        dict: image name -> (offsets dict as returned by split_image, bundle path, bundle index)
+    """
+    tiles_folder = os.path.join(out_folder, ".bundle_tiles")
+    Path(tiles_folder).mkdir(parents=True, exist_ok=True)
+    bundles = {}
+    errors = {}
+
+    def finish(image_path, offsets):
+        image_name = Path(image_path).name
+        bundle_path = os.path.join(out_folder, f"{image_name}.bundle")
+        try:
+            if skip_empty and workers > 1:
+                report_skipped(image_path, size, offsets)
+            index = write_bundle(tiles_folder, offsets, bundle_path)
+        except Exception as e:
+            errors[image_name] = e
+            return
+        finally:
+            for crop_filename in offsets:
+                try:
+                    os.remove(os.path.join(tiles_folder, crop_filename))
+                except FileNotFoundError:
+                    pass
+        bundles[image_name] = (offsets, bundle_path, index)
+        logger.info(f'{image_path}: {len(index)} tiles bundled into {bundle_path}')
+        if on_bundle:
+            on_bundle(bundle_path)
+
+    try:
+        if workers > 1:
+            _, split_errors = _split_parallel(image_paths, tiles_folder, size, skip_empty, workers, halo=halo,
+                                              on_image=finish)
+            errors.update(split_errors)
+        else:
+            for image_path in image_paths:
                 try:
-                    upload_to_s3(SPLIT_FOLDER, OFSETS_FOLDER,BUCKET_NAME, AWS_REGION)
-                    log_to_cloudwatch(logs_client=logs_client,message=f"upload to s3 sucssesfully")
+                    offsets = split_image(image_path, tiles_folder, size, skip_empty, halo=halo)
                 except Exception as e:
-                        logger.error(f"faild to upload to s3: {str(e)}")   
-                        log_to_cloudwatch(logs_client=logs_client,message=f"faild to upload to s3: {str(e)}")
-            now = datetime.now()
-            tomorrow = datetime.now() + timedelta(days=1)
-            next_run = tomorrow.replace(hour=RUN_H, minute=0, second=0, microsecond=0) #TODO - take this to the config.
-            sleep_seconds = (next_run - now).total_seconds()
-            log_to_cloudwatch(logs_client=logs_client,message=f"going to sleep {sleep_seconds}")
-            logger.info(f"going to sleep {sleep_seconds}")
-            time.sleep(sleep_seconds)
+                    errors[Path(image_path).name] = e
+                    continue
+                finish(image_path, offsets)
+    finally:
+        shutil.rmtree(tiles_folder, ignore_errors=True)
+    for image_name, e in errors.items():
+        logger.error(f"got this exaption: {str(e)}")
+        log_to_cloudwatch(logs_client=logs_client,message=f"got this exaption: {str(e)}")
+    return bundles
 
-        time.sleep(5*60)
+def split_images(image_paths, out_folder, size: int, skip_empty: bool = False, workers: int = PRE_PROCESS_WORKERS,
+                 on_tile=None, halo: int = 0):
+    """
+    Splits several images, fanning out across images and tile rows when workers > 1.
+    Images that fail are logged and left out of the result.
 
+    Args:
+        image_paths: list of str, paths to source images
+        out_folder: str, output directory for split images
+        size: int, size of split squares in pixels
+        skip_empty: bool, whether to skip empty image sections
+        workers: int, number of worker processes (1 = serial)
+        on_tile: callable, called with the path of every tile as soon as it is written
+        halo: int, overlap margin in pixels added around every tile
 
+    Returns:
+        dict: Mapping of image names to their offsets dicts, same as the serial split_image output
+    """
+    if not Path(out_folder).exists():
+        Path(out_folder).mkdir(parents=True, exist_ok=True)
+
+    if workers > 1:
+        offsets_dict, errors = _split_parallel(image_paths, out_folder, size, skip_empty, workers, on_tile, halo)
+        for image_path in image_paths:
+            if Path(image_path).name in offsets_dict:
+                if skip_empty:
+                    report_skipped(image_path, size, offsets_dict[Path(image_path).name])
+                logger.info(f'{image_path} splited images have been saved to {out_folder}')
+                log_to_cloudwatch(logs_client=logs_client,message=f'{image_path} splited images have been saved to {out_folder}')
+    else:
+        offsets_dict, errors = {}, {}
+        for image_path in image_paths:
+            try:
+                offsets_dict[Path(image_path).name] = split_image(image_path, out_folder, size, skip_empty, on_tile=on_tile, halo=halo)
+            except Exception as e:
+                errors[Path(image_path).name] = e
+    for image_name, e in errors.items():
+        logger.error(f"got this exaption: {str(e)}")
+        log_to_cloudwatch(logs_client=logs_client,message=f"got this exaption: {str(e)}")
+    return offsets_dict
+
+def local_outputs(offsets):
+    """
+    Lists the local files (the bundle, or the tile PNGs) that hold the tiles of an image.
+
+    Args:
+        offsets: dict, offsets of one image, as written to the offsets JSON
+
+    Returns:
+        list: file names inside the split folder
+    """
+    bundle = offsets.get(META_KEY, {}).get('bundle')
+    return [bundle['file']] if bundle else [name for name in offsets.keys() if name != META_KEY]
+
+
+def resume_source(ledger, file_name, sha256, current_date):
+    """
+    Checks the ledger for work already done on a source file.
+    A source split by an earlier (crashed) run is resumed when each of its tiles is still on disk
+    or already uploaded under today's prefix, otherwise it has to be split again.
+
+    Args:
+        ledger: ProcessingLedger
+        file_name: str, name of the input file
+        sha256: str, content hash of the input file
+        current_date: str, date of the run (YYYY-MM-DD)
+
+    Returns:
+        tuple: ('done', None) when the same content was fully processed before,
+               ('resume', offsets) when the split can be reused, (None, None) otherwise
+    """
+    record = ledger.source(file_name, sha256)
+    if record is None:
+        return None, None
+    if record['status'] == 'done':
+        return 'done', None
+    for name in local_outputs(record['offsets']):
+        if not os.path.exists(os.path.join(SPLIT_FOLDER, name)) and \
+                not ledger.is_uploaded(name, s3_key=f"images/{current_date}/{name}"):
+            return None, None
+    return 'resume', record['offsets']
+
+
+def move_to_processed(file_name):
+    """
+    Moves an input file to the processed folder.
+    """
+    file_path = os.path.join(INPUT_FOLDER_PATH, file_name)
+    try:
+        # Create preprocessed folder path
+        preprocessed_path = os.path.join(INPUT_PROCESSED_FOLDER_PATH, file_name)
+        # Copy the original file to preprocessed folder
+        shutil.copy2(file_path, preprocessed_path)
+        # Remove the original file
+        os.remove(file_path)
+    except Exception as e:
+        logger.error(f"got this exaption: {str(e)}")
+        log_to_cloudwatch(logs_client=logs_client,message=f"got this exaption: {str(e)}")
+
+
+def process_batch(file_paths, current_date, ledger=None, json_name=None, workers=PRE_PROCESS_WORKERS):
+    """
+    Tiles a batch of input files, streams the tiles to S3 and uploads the offsets JSON of the batch
+    once every tile is confirmed. With a ledger, sources already done are skipped and sources split
+    by a crashed run are resumed instead of split again.
+
+    Args:
+        file_paths: list of str, input files
+        current_date: str, date of the run (YYYY-MM-DD), used for the S3 prefix and the JSON name
+        ledger: ProcessingLedger, optional
+        json_name: str, name of the offsets JSON, defaults to "<current_date>.json".
+            Other names must start with "<current_date>_" (the model reads the date from it)
+        workers: int, tiling processes of the batch
+
+    Returns:
+        dict: offsets of the batch, per input file name
+    """
+    uploader = S3Uploader(BUCKET_NAME, AWS_REGION)
+    offsets_dict = {}
+    hashes = {}
+    finished = []
+    # Tiles are read straight from the TIFs and uploaded while the next ones are encoded.
+    with TileUploadPipeline(uploader, current_date, delete_uploaded=DELETE_UPLOADED_TILES, ledger=ledger) as pipeline:
+        todo = []
+        for file_path in file_paths:
+            file_name = Path(file_path).name
+            if ledger is not None:
+                hashes[file_name] = file_hash(file_path)
+                state, offsets = resume_source(ledger, file_name, hashes[file_name], current_date)
+                if state == 'done':
+                    logger.info(f"{file_name} was already processed, skipping")
+                    log_to_cloudwatch(logs_client=logs_client,message=f"{file_name} was already processed, skipping")
+                    finished.append(file_name)
+                    continue
+                if state == 'resume':
+                    logger.info(f"{file_name} was split by an earlier run, resuming its upload")
+                    for name in local_outputs(offsets):
+                        if os.path.exists(os.path.join(SPLIT_FOLDER, name)):
+                            pipeline.put(os.path.join(SPLIT_FOLDER, name))
+                    offsets_dict[file_name] = offsets
+                    continue
+            todo.append(file_path)
+
+        if TILE_OUTPUT == 'bundle':
+            # every TIF on one process pool, each bundle is uploaded as soon as its TIF is tiled
+            bundles = bundle_images(todo, SPLIT_FOLDER, IMAGE_SIZE, skip_empty=SKIP_EMPTY_TILES,
+                                    workers=workers, on_bundle=pipeline.put, halo=TILE_HALO) if todo else {}
+            split_offsets = {}
+            for file_path in todo:
+                if Path(file_path).name in bundles:
+                    offsets, bundle_path, index = bundles[Path(file_path).name]
+                    offsets[META_KEY] = {'bundle': {'file': Path(bundle_path).name, 'index': index}}
+                    split_offsets[Path(file_path).name] = offsets
+        else:
+            split_offsets = split_images(todo,out_folder=SPLIT_FOLDER,size=IMAGE_SIZE,
+                                         skip_empty=SKIP_EMPTY_TILES,workers=workers,
+                                         on_tile=pipeline.put,halo=TILE_HALO)
+        for offsets in split_offsets.values():
+            # the model needs the tile grid to merge the polygons crossing tile edges, and the halo to crop it
+            offsets.setdefault(META_KEY, {})['tile_size'] = IMAGE_SIZE
+            offsets[META_KEY]['halo'] = TILE_HALO
+        if ledger is not None:
+            for file_name, offsets in split_offsets.items():
+                ledger.record_source(file_name, hashes[file_name], 'split', current_date, offsets)
+        offsets_dict.update(split_offsets)
+
+    for file_name in finished:
+        move_to_processed(file_name)
+    if not offsets_dict:
+        return offsets_dict
+
+    json_name = json_name if json_name else f"{current_date}.json"
+    json_path = os.path.join(OFSETS_FOLDER, json_name)
+    with open(json_path, "w") as json_file:
+        json.dump(offsets_dict, json_file, indent=4)  # `indent` makes the JSON more readable
+    # The offsets trigger the model, so they only go up once every tile is confirmed in S3.
+    if pipeline.report['failed']:
+        logger.error(f"faild to upload {len(pipeline.report['failed'])} tiles, offsets not uploaded")
+        log_to_cloudwatch(logs_client=logs_client,message=f"faild to upload {len(pipeline.report['failed'])} tiles, offsets not uploaded")
+    elif uploader.upload_offsets(OFSETS_FOLDER, json_name):
+        log_to_cloudwatch(logs_client=logs_client,message=f"upload to s3 sucssesfully")
+        # the sources leave the input folder only once done, a failed upload is retried from the input folder
+        for file_name, offsets in offsets_dict.items():
+            if ledger is not None:
+                ledger.record_source(file_name, hashes[file_name], 'done', current_date, offsets)
+            move_to_processed(file_name)
+    else:
+        logger.error(f"faild to upload {json_name} to s3")
+        log_to_cloudwatch(logs_client=logs_client,message=f"faild to upload {json_name} to s3")
+    return offsets_dict
+
+def ingest_file(file_path, ledger=None):
+    """
+    Processes a single input file as its own batch (watch mode).
+    Its offsets JSON is named "<date>_<file>.json" so files arriving the same day don't overwrite each other.
+    Up to INGEST_MAX_CONCURRENT files run at the same time, they share the PRE_PROCESS_WORKERS cores.
+    """
+    current_date = datetime.now().strftime("%Y-%m-%d")  # Format: YYYY-MM-DD
+    return process_batch([file_path], current_date, ledger, json_name=f"{current_date}_{Path(file_path).stem}.json",
+                         workers=max(1, PRE_PROCESS_WORKERS // INGEST_MAX_CONCURRENT))
+
+
+if __name__ == "__main__":
+    ledger = ProcessingLedger()
+    if INGEST_MODE == 'watch':
+        log_to_cloudwatch(logs_client=logs_client,message=f"watching {INPUT_FOLDER_PATH} for new files")
+        IngestWatcher(INPUT_FOLDER_PATH, lambda file_path: ingest_file(file_path, ledger)).run()
+    else:
+        while True: #runs every day.
+            israel_tz = pytz.timezone(TIME_ZONE)
+            israel_time = datetime.now(israel_tz)
+            if israel_time.hour == RUN_H or DEBUG:# and israel_time.minute == 00:
+                if len(os.listdir(INPUT_FOLDER_PATH)):
+                    file_paths = [os.path.join(INPUT_FOLDER_PATH, file_name) for file_name in os.listdir(INPUT_FOLDER_PATH)]
+                    # Generate the file name with the current date
+                    current_date = datetime.now().strftime("%Y-%m-%d")  # Format: YYYY-MM-DD
+                    process_batch(file_paths, current_date, ledger)
+                now = datetime.now()
+                tomorrow = datetime.now() + timedelta(days=1)
+                next_run = tomorrow.replace(hour=RUN_H, minute=0, second=0, microsecond=0) #TODO - take this to the config.
+                sleep_seconds = (next_run - now).total_seconds()
+                log_to_cloudwatch(logs_client=logs_client,message=f"going to sleep {sleep_seconds}")
+                logger.info(f"going to sleep {sleep_seconds}")
+                time.sleep(sleep_seconds)
 
+            time.sleep(5*60)
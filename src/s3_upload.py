@@ -3,7 +3,13 @@ import os
 from pathlib import Path
 import json
 import sys
+import time
+import queue
+import threading
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from botocore.config import Config
+from boto3.s3.transfer import TransferConfig
 from botocore.exceptions import ClientError # AWS exceptions from botocore.exceptions import ClientError # AWS exceptions 
 # Add project root to path
 import dotenv
@@ -14,16 +20,30 @@ project_root = str(Path(__file__).parent.parent)
 sys.path.insert(0, project_root)
 
 from src.logger import Logger
+from src.ledger import file_hash
 from config.config_pre_process import SPLIT_FOLDER, OFSETS_FOLDER
 from config.config_aws import BUCKET_NAME, AWS_REGION
+from config.config_aws import UPLOAD_WORKERS, S3_MAX_POOL_CONNECTIONS, MULTIPART_THRESHOLD_MB, MULTIPART_CHUNKSIZE_MB, MULTIPART_CONCURRENCY, UPLOAD_QUEUE_SIZE
 logger = Logger(logger_name='pre-process',logs_dir=os.path.join(project_root,'logs'),log_mode='DEBUG')
 
+MB = 1024 * 1024
+
 class S3Uploader:
-    def __init__(self, bucket_name, aws_region='us-east-1'):
-        """Initialize S3 client and bucket configuration."""
+    def __init__(self, bucket_name, aws_region='us-east-1', max_pool_connections=S3_MAX_POOL_CONNECTIONS,
+                 multipart_threshold_mb=MULTIPART_THRESHOLD_MB, multipart_chunksize_mb=MULTIPART_CHUNKSIZE_MB,
+                 multipart_concurrency=MULTIPART_CONCURRENCY):
+        """
+        Initialize S3 client and bucket configuration.
+        The client is shared by all upload threads, its connection pool is sized by max_pool_connections.
+        """
         self.s3_client = boto3.client('s3', region_name=aws_region,
+                                      config=Config(max_pool_connections=max_pool_connections),
                                       aws_access_key_id=os.getenv('AWS_ACCESS_KEY_ID'),aws_secret_access_key=os.getenv('AWS_SECRET_ACCESS_KEY'))
+        self.transfer_config = TransferConfig(multipart_threshold=multipart_threshold_mb * MB,
+                                              multipart_chunksize=multipart_chunksize_mb * MB,
+                                              max_concurrency=multipart_concurrency)
         self.bucket_name = bucket_name
+        self.last_report = None
 
     def upload_file(self, file_path, s3_path):
         """
@@ -37,19 +57,68 @@ class S3Uploader:
             bool: True if upload successful, False otherwise
         """
         try:
-            self.s3_client.upload_file(file_path, self.bucket_name, s3_path)
+            self.s3_client.upload_file(file_path, self.bucket_name, s3_path, Config=self.transfer_config)
             logger.info(f"Successfully uploaded {file_path} to s3://{self.bucket_name}/{s3_path}")
             return True
         except Exception as e:
             logger.error(f"Error uploading {file_path}: {str(e)}")
             return False
 
-    def upload_images(self, images_folder):
+    def upload_files(self, uploads, workers=UPLOAD_WORKERS, ledger=None):
+        """
+        Uploads many files concurrently over a bounded thread pool.
+        
+        Args:
+            uploads: list of (local path, S3 path) tuples
+            workers: int, number of files uploaded at the same time
+            ledger: ProcessingLedger, if given files already uploaded with the same name and content are skipped
+            
+        Returns:
+            dict: report with the uploaded count, the skipped count, the failed local paths, bytes sent, seconds and MB/s
+        """
+        start = time.perf_counter()
+        skipped = 0
+        if ledger is not None:
+            hashes = {local_path: file_hash(local_path) for local_path, _ in uploads}
+            pending = [(local_path, s3_path) for local_path, s3_path in uploads
+                       if not ledger.is_uploaded(os.path.basename(local_path), hashes[local_path])]
+            skipped = len(uploads) - len(pending)
+            uploads = pending
+
+        def upload(local_path, s3_path):
+            ok = self.upload_file(local_path, s3_path)
+            if ok and ledger is not None:
+                ledger.record_upload(os.path.basename(local_path), hashes[local_path], s3_path)
+            return ok
+
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+            results = list(executor.map(lambda item: upload(*item), uploads))
+        seconds = time.perf_counter() - start
+
+        failed = [local_path for (local_path, _), ok in zip(uploads, results) if not ok]
+        sent_bytes = sum(os.path.getsize(local_path) for (local_path, _), ok in zip(uploads, results) if ok)
+        report = {
+            'uploaded': len(uploads) - len(failed),
+            'skipped': skipped,
+            'failed': failed,
+            'bytes': sent_bytes,
+            'seconds': seconds,
+            'mb_per_s': sent_bytes / MB / seconds if seconds > 0 else 0.0
+        }
+        logger.info(f"Uploaded {report['uploaded']}/{len(uploads)} files, {sent_bytes / MB:.1f}MB "
+                    f"in {seconds:.1f}s ({report['mb_per_s']:.1f}MB/s), {skipped} already uploaded")
+        for local_path in failed:
+            logger.error(f"Failed to upload {local_path}")
+        return report
+
+    def upload_images(self, images_folder, workers=UPLOAD_WORKERS, ledger=None):
         """
         Uploads all PNG images from a folder to S3, organizing by date.
         
         Args:
             images_folder: str, local folder containing images
+            workers: int, number of concurrent uploads (1 = one file at a time)
+            ledger: ProcessingLedger, if given tiles uploaded by earlier runs are not sent again
             
         Returns:
             bool: True if all uploads successful, False otherwise
@@ -60,26 +129,23 @@ class S3Uploader:
             logger.error(f"Images folder {images_folder} does not exist")
             return False
 
-        success = True
         # Create a subfolder with current date
         current_date = datetime.now().strftime("%Y-%m-%d")
         base_s3_path = f"images/{current_date}/"
 
-        for image_name in os.listdir(images_folder):
-            if image_name.endswith('.png'):
-                local_path = os.path.join(images_folder, image_name)
-                s3_path = base_s3_path + image_name
-                if not self.upload_file(local_path, s3_path):
-                    success = False
+        uploads = [(os.path.join(images_folder, image_name), base_s3_path + image_name)
+                   for image_name in os.listdir(images_folder) if image_name.endswith('.png')]
+        self.last_report = self.upload_files(uploads, workers=workers, ledger=ledger)
 
-        return success
+        return not self.last_report['failed']
 
-    def upload_offsets(self, offsets_folder):
+    def upload_offsets(self, offsets_folder, json_name=None):
         """
         Uploads the latest JSON file containing image offsets to S3.
         
         Args:
             offsets_folder: str, folder containing offset JSON files
+            json_name: str, name of the JSON file to upload, defaults to the latest one
             
         Returns:
             bool: True if upload successful, False otherwise
@@ -96,11 +162,115 @@ class S3Uploader:
             logger.error("No JSON files found in offsets folder")
             return False
 
-        latest_json = max(json_files)
+        latest_json = json_name if json_name else max(json_files)
         local_path = os.path.join(offsets_folder, latest_json)
         s3_path = f"offsets/{latest_json}"
 
         return self.upload_file(local_path, s3_path)
+
+class TileUploadPipeline:
+    """
+    Bounded producer/consumer queue between the tiler and S3.
+    Tiles are put on the queue as soon as they are written and upload threads drain it, so encoding
+    and uploading overlap. put() blocks while the queue is full, which keeps the number of tiles
+    waiting on disk (and in flight) flat.
+
+    With a ledger, tiles already uploaded to the same key with the same content are skipped.
+
+    Usage:
+        with TileUploadPipeline(uploader, current_date) as pipeline:
+            split_images(..., on_tile=pipeline.put)
+        if not pipeline.report['failed']: upload the offsets JSON
+    """
+
+    def __init__(self, uploader, current_date, workers=UPLOAD_WORKERS, queue_size=UPLOAD_QUEUE_SIZE,
+                 delete_uploaded=False, ledger=None):
+        self.uploader = uploader
+        self.ledger = ledger
+        self.base_s3_path = f"images/{current_date}/"
+        self.delete_uploaded = delete_uploaded
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.threads = [threading.Thread(target=self._consume, daemon=True) for _ in range(max(1, workers))]
+        self.lock = threading.Lock()
+        self.uploaded = 0
+        self.skipped = 0
+        self.failed = []
+        self.sent_bytes = 0
+        self.start_time = None
+        self.report = None
+
+    def start(self):
+        self.start_time = time.perf_counter()
+        for thread in self.threads:
+            thread.start()
+        return self
+
+    def put(self, local_path):
+        """Queues one tile for upload, blocks while the queue is full."""
+        self.queue.put(local_path)
+
+    def _consume(self):
+        while True:
+            local_path = self.queue.get()
+            if local_path is None:
+                break
+            name = os.path.basename(local_path)
+            s3_path = self.base_s3_path + name
+            skipped = False
+            try:
+                size = os.path.getsize(local_path)
+                sha256 = file_hash(local_path) if self.ledger is not None else None
+                skipped = sha256 is not None and self.ledger.is_uploaded(name, sha256, s3_path)
+                ok = skipped or self.uploader.upload_file(local_path, s3_path)
+                if ok and not skipped and self.ledger is not None:
+                    self.ledger.record_upload(name, sha256, s3_path)
+                if ok and self.delete_uploaded:
+                    os.remove(local_path)
+            except Exception as e:
+                # any error (file, ledger, ...) fails this tile only, the thread keeps draining the queue
+                # so put() never blocks on a queue nobody consumes
+                logger.error(f"Error uploading {local_path}: {str(e)}")
+                ok = skipped = False
+            with self.lock:
+                if skipped:
+                    self.skipped += 1
+                elif ok:
+                    self.uploaded += 1
+                    self.sent_bytes += size
+                else:
+                    self.failed.append(local_path)
+
+    def close(self):
+        """
+        Waits until every queued tile is uploaded.
+
+        Returns:
+            dict: same report as S3Uploader.upload_files
+        """
+        for _ in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        seconds = time.perf_counter() - self.start_time
+        self.report = {
+            'uploaded': self.uploaded,
+            'skipped': self.skipped,
+            'failed': self.failed,
+            'bytes': self.sent_bytes,
+            'seconds': seconds,
+            'mb_per_s': self.sent_bytes / MB / seconds if seconds > 0 else 0.0
+        }
+        logger.info(f"Streamed {self.uploaded} tiles, {self.sent_bytes / MB:.1f}MB in {seconds:.1f}s "
+                    f"({self.report['mb_per_s']:.1f}MB/s), {self.skipped} already uploaded, {len(self.failed)} failed")
+        return self.report
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
 def upload_to_s3(SPLIT_FOLDER, OFSETS_FOLDER,BUCKET_NAME, AWS_REGION):
     # Configure these values
 
@@ -32,7 +32,7 @@ def lambda_handler(event, context):
     s3.download_file(bucket, input_key, tif_file_path)
     
     # Convert .tif to .png
-    tif_to_png(tif_file_path, png_file_path)
+    tif_to_png(tif_file_path, temp_dir, os.path.basename(png_file_path))  # streamed in row blocks, see BLOCK_WISE_CONVERSION
     
     # Split .png into smaller tiles
     offsets = split_image(png_file_path, split_folder, size=1600, skip_empty=True)
@@ -0,0 +1,133 @@
+import pytest
+import os
+import shutil
+import threading
+import time
+from pathlib import Path
+
+import sys
+project_root = str(Path(__file__).parent.parent)
+sys.path.insert(0, project_root)
+
+from src.ingest import IngestWatcher
+
+@pytest.fixture
+def watch_folder():
+    """Create an empty input folder"""
+    folder = Path("test_ingest_data")
+    folder.mkdir(parents=True, exist_ok=True)
+
+    yield folder
+
+    shutil.rmtree(folder)
+
+def make_watcher(handled):
+    done = threading.Event()
+    def handle_file(path):
+        handled.append(path)
+        done.set()
+    return IngestWatcher('test_ingest_data', handle_file, debounce_seconds=0, max_concurrent=1), done
+
+def test_stable_file_is_handed_over_once(watch_folder):
+    """Test that a file is processed once its size and mtime stop changing, and only once"""
+    handled = []
+    watcher, done = make_watcher(handled)
+    path = str(watch_folder / "image.tif")
+    Path(path).write_bytes(b"x" * 100)
+    watcher.touch(path)
+
+    assert watcher.poll() == []  # first check only records the signature
+    assert watcher.poll() == [path]
+    assert done.wait(5)
+    assert watcher.poll() == []
+    watcher.executor.shutdown(wait=True)
+
+    assert handled == [path]
+
+def test_growing_file_is_not_handed_over(watch_folder):
+    """Test that a file still being written is held back"""
+    handled = []
+    watcher, _ = make_watcher(handled)
+    path = watch_folder / "image.tif"
+    path.write_bytes(b"x" * 100)
+    watcher.touch(str(path))
+
+    assert watcher.poll() == []
+    with open(path, 'ab') as f:
+        f.write(b"x" * 100)
+    assert watcher.poll() == []
+    assert watcher.poll() == [str(path)]
+    watcher.executor.shutdown(wait=True)
+
+def test_partial_and_hidden_files_are_ignored(watch_folder):
+    """Test that temporary copy files are never picked up"""
+    handled = []
+    watcher, _ = make_watcher(handled)
+    for name in ("image.tif.part", ".image.tif"):
+        (watch_folder / name).write_bytes(b"x")
+        watcher.touch(str(watch_folder / name))
+
+    assert watcher.poll() == []
+    assert watcher.poll() == []
+    watcher.executor.shutdown(wait=True)
+    assert handled == []
+
+def test_file_left_in_folder_is_retried(watch_folder):
+    """Test that a file whose run failed is handed over again, and a processed (moved) one is not"""
+    calls = []
+    done = threading.Event()
+    def handle_file(path):
+        calls.append(path)
+        if len(calls) == 1:
+            done.set()
+            raise RuntimeError("upload failed")
+        os.remove(path)  # the pipeline moves a done file out of the input folder
+        done.set()
+    watcher = IngestWatcher('test_ingest_data', handle_file, debounce_seconds=0, max_concurrent=1, retry_seconds=0)
+    path = str(watch_folder / "image.tif")
+    Path(path).write_bytes(b"x" * 100)
+    watcher.touch(path)
+
+    assert watcher.poll() == []
+    assert watcher.poll() == [path]
+    assert done.wait(5)
+    while watcher.in_flight:  # the retry is registered when the run ends
+        time.sleep(0.01)
+    done.clear()
+
+    assert watcher.poll() == []  # the retry checks the signature again
+    assert watcher.poll() == [path]
+    assert done.wait(5)
+    watcher.executor.shutdown(wait=True)
+    assert watcher.poll() == [] and watcher.pending == {}
+    assert calls == [path, path]
+
+def test_file_failing_every_run_backs_off_then_is_quarantined(watch_folder, tmp_path):
+    """Test that the retries of a file that always fails come later and later, then the file is moved away"""
+    calls = []
+    def handle_file(path):
+        calls.append(path)
+        raise RuntimeError("corrupt TIF")
+    watcher = IngestWatcher('test_ingest_data', handle_file, debounce_seconds=0, max_concurrent=1, retry_seconds=100,
+                            max_retries=2, quarantine_folder=tmp_path / "quarantine")
+    path = str(watch_folder / "image.tif")
+    Path(path).write_bytes(b"x" * 100)
+
+    delays = []
+    for run in range(3):
+        watcher._run(path)
+        if run < 2:
+            delays.append(watcher.pending[path][0] - time.monotonic())
+            del watcher.pending[path]
+
+    assert calls == [path] * 3
+    assert [round(delay, -1) for delay in delays] == [100, 200]
+    assert not os.path.exists(path) and watcher.pending == {} and watcher.failures == {}
+    assert os.listdir(tmp_path / "quarantine") == ["image.tif"]
+
+    # a file copied back starts over
+    shutil.copy(tmp_path / "quarantine" / "image.tif", path)
+    watcher.touch(path)
+    watcher._run(path)
+    assert watcher.failures == {path: 1} and os.path.exists(path)
+    watcher.executor.shutdown(wait=True)
@@ -11,13 +11,17 @@ os.environ['aws_secret_access_key'] = 'test_secret'
 project_root = str(Path(__file__).parent.parent)
 sys.path.append(project_root)
 sys.path.append(os.path.join(project_root, 'src', 'final_activator'))
+sys.path.append(os.path.join(project_root, 'src'))  # log_shipper, copied into the package on deploy
 
 import pytest
+import io
 import json
 from unittest.mock import MagicMock, patch
 
-from src.final_activator.lambda_function import lambda_handler
-from src.final_activator.lambada_custom_logger import log_to_cloudwatch
+from src.final_activator.lambda_function import lambda_handler, split_tif, plan_chunks, tiles_per_invocation, OffsetsReader
+from src.final_activator.config_activator import META_KEY
+from src.final_activator.lambada_custom_logger import log_to_cloudwatch, flush_logs
+from src.log_shipper import CloudWatchShipper
 
 @pytest.fixture
 def sample_s3_event():
@@ -70,7 +74,7 @@ def test_lambda_handler_successful_processing(sample_s3_event,
     """Test successful processing of offsets file"""
     # Mock S3 get_object response
     mock_s3_client.get_object.return_value = {
-        'Body': MagicMock(read=lambda: json.dumps(sample_offsets_data).encode('UTF-8'))
+        'Body': io.BytesIO(json.dumps(sample_offsets_data).encode('UTF-8'))
     }
 
     # Execute lambda handler
@@ -86,19 +90,66 @@ def test_lambda_handler_successful_processing(sample_s3_event,
         Key='offsets/2024-01-28.json'
     )
 
-    # Verify put_object calls (one for each image in the offsets data)
-    assert mock_s3_client.put_object.call_count == len(sample_offsets_data)
+    # Verify put_object calls (both small images fit in one invocation)
+    assert mock_s3_client.put_object.call_count == 1
 
     # Verify the format of uploaded data
-    calls = mock_s3_client.put_object.call_args_list
-    for i, (image_name, _) in enumerate(sample_offsets_data.items()):
-        call = calls[i]
-        args, kwargs = call
-        assert kwargs['Bucket'] == 'test-bucket'
-        assert kwargs['Key'].startswith('small_offsets/2024-01-28/offsets_')
-        uploaded_data = json.loads(kwargs['Body'].decode('UTF-8'))
-        assert len(uploaded_data) == 1  # Should contain only one image data
-        assert list(uploaded_data.keys())[0] in sample_offsets_data  # Should be one of our original images
+    args, kwargs = mock_s3_client.put_object.call_args
+    assert kwargs['Bucket'] == 'test-bucket'
+    assert kwargs['Key'] == 'small_offsets/2024-01-28/offsets_0.json'
+    uploaded_data = json.loads(kwargs['Body'].decode('UTF-8'))
+    assert uploaded_data == json.loads(json.dumps(sample_offsets_data))
+
+def large_offsets(tiles, name='big.tif', bundle=False):
+    offsets = {f'{name}_{i * 1600}_0.png': [i * 1600, 0] for i in range(tiles)}
+    offsets[META_KEY] = {'tile_size': 1600}
+    if bundle:
+        offsets[META_KEY]['bundle'] = {'file': f'{name}.bundle', 'index': {tile: [i * 10, 10] for i, tile in enumerate(offsets) if tile != META_KEY}}
+    return offsets
+
+def test_split_tif_balanced_parts():
+    """Test that a TIF over the per-invocation budget is split into balanced, ordered parts"""
+    offsets = large_offsets(10, bundle=True)
+    chunks = split_tif(offsets, 4)
+
+    assert [len(chunk) - 1 for chunk in chunks] == [4, 3, 3]
+    assert [name for chunk in chunks for name in chunk if name != META_KEY] == [name for name in offsets if name != META_KEY]
+    for part, chunk in enumerate(chunks):
+        meta = chunk[META_KEY]
+        assert meta['part'] == str(part) and meta['total_tiles'] == 10 and meta['tile_size'] == 1600
+        assert list(meta['bundle']['index']) == [name for name in chunk if name != META_KEY]
+    # the parts of one split share a generation, a new split of the same TIF gets another one
+    assert len({chunk[META_KEY]['generation'] for chunk in chunks}) == 1
+    assert split_tif(offsets, 4)[0][META_KEY]['generation'] != chunks[0][META_KEY]['generation']
+    assert split_tif(offsets, 10) == [offsets]
+
+def test_tiles_per_invocation_counts_the_workers():
+    """Test that the workers share the time of an invocation but each takes its own memory"""
+    one, two = tiles_per_invocation(1600, workers=1), tiles_per_invocation(1600, workers=2)
+    assert two == 2 * one or two == 2 * one + 1
+    # larger tiles take longer and more worker memory
+    assert tiles_per_invocation(3200, workers=2) < two
+    # once the workers fill the memory there is room for a single tile
+    assert tiles_per_invocation(1600, workers=100) == 1
+    assert tiles_per_invocation(8000, workers=2) == 1
+
+def test_plan_chunks_packs_small_and_splits_large():
+    """Test that every tile lands in exactly one file and no file is over budget"""
+    max_tiles = tiles_per_invocation(1600)
+    offsets_dict = {'big.tif': large_offsets(2 * max_tiles + 1, 'big.tif')}
+    for i in range(6):
+        offsets_dict[f'small{i}.tif'] = large_offsets(max_tiles // 3, f'small{i}.tif')
+
+    plan = list(plan_chunks(offsets_dict.items()))
+
+    loads = [load for load, _ in plan]
+    assert all(load <= 1.0 + 1e-9 for load in loads)
+    assert sum('big.tif' in chunk_offsets for _, chunk_offsets in plan) == 3
+    assert len(plan) == 3 + 2  # the parts of big.tif are written right away, the small TIFs packed 3 per file
+    tiles = [name for _, chunk_offsets in plan for offsets in chunk_offsets.values() for name in offsets if name != META_KEY]
+    expected = [name for offsets in offsets_dict.values() for name in offsets if name != META_KEY]
+    assert sorted(tiles) == sorted(expected)
+    assert max(loads) - min(loads) < 0.5
 
 def test_lambda_handler_s3_error(sample_s3_event, mock_s3_client, mock_logger):
     """Test handling of S3 get_object error"""
@@ -114,8 +165,10 @@ def test_lambda_handler_s3_error(sample_s3_event, mock_s3_client, mock_logger):
 def test_log_to_cloudwatch_no_aws_calls():
     """Test log_to_cloudwatch function with mocked AWS client"""
     mock_logs_client = MagicMock()
-    response = log_to_cloudwatch(mock_logs_client, "Test message")
-    
+    assert log_to_cloudwatch(mock_logs_client, "Test message") is True
+    mock_logs_client.put_log_events.assert_not_called()  # queued, not sent inline
+    flush_logs()
+
     # Verify the logs_client was called with correct parameters
     mock_logs_client.put_log_events.assert_called_once()
     call_args = mock_logs_client.put_log_events.call_args[1]
@@ -125,6 +178,61 @@ def test_log_to_cloudwatch_no_aws_calls():
     assert len(call_args['logEvents']) == 1
     assert call_args['logEvents'][0]['message'] == "Test message"
 
+def test_cloudwatch_shipper_batches_within_limits():
+    """Test that queued events are sent in as few batches as the API limits allow"""
+    mock_logs_client = MagicMock()
+    shipper = CloudWatchShipper(mock_logs_client, 'group', 'stream', max_queued=30000)
+    for i in range(25000):
+        shipper.put_nowait(f"message {i}")
+    shipper.put_nowait("x" * 600000)
+    shipper.put_nowait("y" * 600000)
+
+    assert shipper.flush() == 25002
+
+    batches = [call[1]['logEvents'] for call in mock_logs_client.put_log_events.call_args_list]
+    assert sum(len(batch) for batch in batches) == 25002
+    for batch in batches:
+        assert len(batch) <= 10000
+        assert sum(len(event['message']) + 26 for event in batch) <= 1048576
+    assert shipper.sent == 25002 and shipper.dropped == 0
+
+def test_cloudwatch_shipper_counts_dropped_events():
+    """Test that a full buffer drops events instead of blocking, and failed batches are counted"""
+    mock_logs_client = MagicMock()
+    mock_logs_client.put_log_events.side_effect = Exception("CloudWatch Error")
+    shipper = CloudWatchShipper(mock_logs_client, 'group', 'stream', max_queued=3)
+
+    results = [shipper.put_nowait(f"message {i}") for i in range(5)]
+    assert results == [True, True, True, False, False]
+    assert shipper.flush() == 0
+    assert shipper.sent == 0 and shipper.dropped == 5
+
+def test_offsets_reader_matches_json_loads():
+    """Test that parsing the offsets file in small streamed chunks gives the same TIFs as json.loads"""
+    offsets_dict = {f'image{i}_é.tif': large_offsets(i, f'image{i}_é.tif', bundle=True) for i in range(5)}
+    data = json.dumps(offsets_dict, indent=4, ensure_ascii=False).encode('UTF-8')
+
+    for chunk_size in (1, 7, 1024):
+        assert dict(OffsetsReader(io.BytesIO(data), chunk_size=chunk_size)) == json.loads(data)
+    assert list(OffsetsReader(io.BytesIO(b' { } '))) == []
+    with pytest.raises(ValueError):
+        list(OffsetsReader(io.BytesIO(data[:len(data) // 2]), chunk_size=7))
+
+def test_lambda_handler_writes_every_chunk(sample_s3_event, mock_s3_client, mock_logger):
+    """Test that the concurrent writes cover every file once, with the latency reported from the event time"""
+    offsets_dict = {f'image{i}.tif': large_offsets(tiles_per_invocation(1600), f'image{i}.tif') for i in range(50)}
+    mock_s3_client.get_object.return_value = {'Body': io.BytesIO(json.dumps(offsets_dict).encode('UTF-8'))}
+    sample_s3_event['Records'][0]['eventTime'] = '2024-01-28T12:00:00.000Z'
+
+    lambda_handler(sample_s3_event, None)
+
+    keys = sorted(call[1]['Key'] for call in mock_s3_client.put_object.call_args_list)
+    assert keys == sorted(f'small_offsets/2024-01-28/offsets_{i}.json' for i in range(50))
+    written = {}
+    for call in mock_s3_client.put_object.call_args_list:
+        written.update(json.loads(call[1]['Body']))
+    assert written == json.loads(json.dumps(offsets_dict))
+
 @pytest.fixture
 def invalid_s3_event():
     """Create an invalid S3 event"""
@@ -146,7 +254,7 @@ def test_lambda_handler_empty_offsets(sample_s3_event, mock_s3_client, mock_logg
     """Test handling of empty offsets data"""
     # Mock S3 get_object to return empty dict
     mock_s3_client.get_object.return_value = {
-        'Body': MagicMock(read=lambda: json.dumps({}).encode('UTF-8'))
+        'Body': io.BytesIO(json.dumps({}).encode('UTF-8'))
     }
 
     # Execute lambda handler
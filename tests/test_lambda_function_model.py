@@ -0,0 +1,270 @@
+import io
+import json
+import os
+import sys
+from pathlib import Path
+
+# Set environment variables before imports
+os.environ['aws_access_key_id'] = 'test_key'
+os.environ['aws_secret_access_key'] = 'test_secret'
+
+# Set up path
+project_root = str(Path(__file__).parent.parent)
+sys.path.append(project_root)
+
+import pytest
+
+# the model runs in its own image (src/model_image/requirements_model.txt), skip without it
+pytest.importorskip("detectree")
+
+import geopandas as gpd
+import numpy as np
+import rasterio
+import shapely
+from PIL import Image
+from botocore.exceptions import ClientError
+from unittest.mock import MagicMock, patch
+
+# the model package is also called src: its modules are found next to the pre-process ones
+import src
+src.__path__.append(os.path.join(project_root, 'src', 'model_image', 'src'))
+
+with patch('boto3.client', return_value=MagicMock()):
+    import src.lambda_function as model_lambda
+from src.model_functions import claim_merge, read_partials, partial_key, write_partial, merged_key, continuation_key
+from src.config_model import META_KEY, OUTPUT_MULTIPART_THRESHOLD_MB, OUTPUT_MULTIPART_CHUNK_MB
+from shapely.geometry import box
+
+TILE_SIZE = 40
+RUN_ID = '2024-01-28'
+
+class FakeS3:
+    """The S3 calls of the model Lambda, on a dict"""
+
+    def __init__(self, objects=None):
+        self.objects = dict(objects or {})
+        self.missing = set()  # listed but gone when read, like a partial deleted by a finishing merge
+        self.configs = {}  # transfer config of every upload_fileobj
+
+    @staticmethod
+    def not_found(operation):
+        return ClientError({'Error': {'Code': 'NoSuchKey'}}, operation)
+
+    def get_object(self, Bucket, Key, Range=None):
+        if Key not in self.objects or Key in self.missing:
+            raise self.not_found('GetObject')
+        return {'Body': io.BytesIO(self.objects[Key]), 'ContentLength': len(self.objects[Key])}
+
+    def head_object(self, Bucket, Key):
+        if Key not in self.objects:
+            raise ClientError({'Error': {'Code': '404'}}, 'HeadObject')
+        return {}
+
+    def put_object(self, Bucket, Key, Body, IfNoneMatch=None):
+        if IfNoneMatch == '*' and Key in self.objects:
+            raise ClientError({'Error': {'Code': 'PreconditionFailed'}}, 'PutObject')
+        self.objects[Key] = Body if isinstance(Body, bytes) else Body.read()
+
+    def upload_fileobj(self, f, Bucket, Key, Config=None):
+        self.objects[Key] = f.read()
+        self.configs[Key] = Config
+
+    def delete_object(self, Bucket, Key):
+        self.objects.pop(Key, None)
+
+    def delete_objects(self, Bucket, Delete):
+        for item in Delete['Objects']:
+            self.objects.pop(item['Key'], None)
+
+    def get_paginator(self, name):
+        objects = self.objects
+
+        class Paginator:
+            def paginate(self, Bucket, Prefix):
+                return [{'Contents': [{'Key': key} for key in sorted(objects) if key.startswith(Prefix)]}]
+        return Paginator()
+
+    def keys(self, prefix):
+        return sorted(key for key in self.objects if key.startswith(prefix))
+
+class GreenModel:
+    """Stands in for the classifier: canopy where green dominates"""
+
+    def predict_img(self, path):
+        with rasterio.open(path) as src:
+            red, green, _ = src.read([1, 2, 3]).astype(int)
+        return (green > red + 30).astype(np.uint8)
+
+class CountdownContext:
+    """Lambda context whose time runs out after tiles_per_invocation tiles (the Deadline checks before every tile but the first)"""
+
+    def __init__(self, tiles_per_invocation):
+        self.calls = 0
+        self.tiles_per_invocation = tiles_per_invocation
+
+    def get_remaining_time_in_millis(self):
+        self.calls += 1
+        return 900000 if self.calls < self.tiles_per_invocation else 0
+
+def make_tiles(count, seed=0):
+    """PNG tiles with crowns, some of them cut by the tile edges"""
+    rng = np.random.default_rng(seed)
+    tiles = {}
+    for k in range(count):
+        image = np.full((TILE_SIZE, TILE_SIZE, 3), (120, 110, 100), dtype=np.uint8)
+        for _ in range(3):
+            row, col = rng.integers(0, TILE_SIZE - 8, 2)
+            image[row:row + 12, col:col + 12] = (40, 140, 40)
+        buffer = io.BytesIO()
+        Image.fromarray(image).save(buffer, format='PNG')
+        tiles[f'a.tif_{k * TILE_SIZE}_0.png'] = buffer.getvalue()
+    return tiles
+
+def make_s3(tiles):
+    return FakeS3({f'images/{RUN_ID}/{name}': data for name, data in tiles.items()})
+
+def invoke(s3, json_key, context=None):
+    event = {'Records': [{'s3': {'bucket': {'name': 'bucket'}, 'object': {'key': json_key}}}]}
+    with patch('boto3.client', side_effect=lambda name, **kwargs: s3 if name == 's3' else MagicMock()), \
+            patch.object(model_lambda, 'get_model', return_value=(GreenModel(), 0.0, 'green')), \
+            patch.object(model_lambda, 'make_tile_cache', return_value=None):
+        return model_lambda.lambda_handler(event, context)
+
+def put_offsets(s3, json_key, tiles, meta):
+    offsets = {name: [int(name.split('_')[-2]), 0] for name in tiles}
+    offsets[META_KEY] = meta
+    s3.put_object(Bucket='bucket', Key=json_key, Body=json.dumps({'a.tif': offsets}).encode('UTF-8'))
+
+def outputs(s3):
+    return {key: s3.objects[key] for key in s3.keys(f'output/{RUN_ID}/') if key.endswith(('.shp', '.shx'))}
+
+def has_polygons(output):
+    return len(output[f'output/{RUN_ID}/a.tif_shapefile.shp']) > 100  # more than the shapefile header
+
+def test_deadline_continuations_give_the_single_invocation_result():
+    """Test that 7 tiles processed 2 per invocation (4 invocations) give the same output as one invocation"""
+    tiles = make_tiles(7)
+    meta = {'tile_size': TILE_SIZE, 'halo': 0}
+
+    single = make_s3(tiles)
+    put_offsets(single, f'small_offsets/{RUN_ID}/offsets_0.json', tiles, meta)
+    invoke(single, f'small_offsets/{RUN_ID}/offsets_0.json')
+
+    split = make_s3(tiles)
+    json_key = f'small_offsets/{RUN_ID}/offsets_0.json'
+    put_offsets(split, json_key, tiles, meta)
+    invocations = 0
+    while json_key in split.objects:
+        invoke(split, json_key, CountdownContext(2))
+        invocations += 1
+        json_key = continuation_key(json_key)
+
+    assert invocations == 4
+    assert has_polygons(outputs(single))
+    assert outputs(split) == outputs(single)
+    # the partials are deleted, the merged marker stays
+    partials = split.keys(f'partials/{RUN_ID}/a.tif/')
+    assert len(partials) == 1 and partials[0].endswith('/merged')
+
+def test_parts_finishing_together_are_merged_once():
+    """Test that only one invocation merges a generation, and a part retried after the merge is skipped"""
+    tiles = make_tiles(4)
+    names = list(tiles)
+    s3 = make_s3(tiles)
+    for part in range(2):
+        meta = {'tile_size': TILE_SIZE, 'halo': 0, 'part': str(part), 'total_tiles': 4, 'generation': 'g1'}
+        put_offsets(s3, f'small_offsets/{RUN_ID}/offsets_{part}.json', {name: None for name in names[2 * part:2 * part + 2]}, meta)
+
+    invoke(s3, f'small_offsets/{RUN_ID}/offsets_0.json')
+    assert not outputs(s3)
+    # the invocation of the other part saw every partial too and claimed the merge first
+    assert claim_merge(s3, 'bucket', RUN_ID, 'a.tif', 'g1')
+    assert not claim_merge(s3, 'bucket', RUN_ID, 'a.tif', 'g1')
+    with patch.object(model_lambda, 'is_merged', return_value=False):  # not claimed yet when this part started
+        invoke(s3, f'small_offsets/{RUN_ID}/offsets_1.json')
+    assert not outputs(s3)
+    assert len(s3.keys(f'partials/{RUN_ID}/a.tif/g1/')) == 3  # both partials, left to the winner
+
+    # without the concurrent claim the last part merges
+    s3.delete_object('bucket', merged_key(RUN_ID, 'a.tif', 'g1'))
+    invoke(s3, f'small_offsets/{RUN_ID}/offsets_1.json')
+    merged_output = outputs(s3)
+    assert has_polygons(merged_output)
+    assert s3.keys(f'partials/{RUN_ID}/a.tif/g1/') == [merged_key(RUN_ID, 'a.tif', 'g1')]
+
+    # an S3 retry of a part after the merge leaves no orphaned partial
+    invoke(s3, f'small_offsets/{RUN_ID}/offsets_0.json')
+    assert s3.keys(f'partials/{RUN_ID}/a.tif/g1/') == [merged_key(RUN_ID, 'a.tif', 'g1')]
+    assert outputs(s3) == merged_output
+
+@pytest.mark.parametrize("json_key, expected", [
+    ('small_offsets/2024-01-28/offsets_3.json', 'small_offsets/2024-01-28/offsets_3_c1.json'),
+    ('small_offsets/2024-01-28/offsets_3_c1.json', 'small_offsets/2024-01-28/offsets_3_c2.json'),
+    ('small_offsets/2024-01-28/offsets_3_c9.json', 'small_offsets/2024-01-28/offsets_3_c10.json'),
+    ('small_offsets/2024-01-28_image/offsets_0_c10.json', 'small_offsets/2024-01-28_image/offsets_0_c11.json'),
+])
+def test_continuation_key(json_key, expected):
+    """Test that each continuation of an offsets file gets the next number, past one digit too"""
+    assert continuation_key(json_key) == expected
+
+def test_read_partials_in_numeric_part_order():
+    """Test that the parts are read in numeric order (2 before 10), not in S3's lexicographic order"""
+    s3 = FakeS3()
+    parts = [('10', 0), ('2', 1), ('1', 0), ('2', 0)]
+    offsets = {f'{part}_{continuation}.png': [0, 0] for part, continuation in parts}
+    for part, continuation in parts:
+        png_name = f'{part}_{continuation}.png'
+        write_partial(s3, 'bucket', partial_key(RUN_ID, 'a.tif', 'g1', part, continuation),
+                      {png_name: [box(0, 0, 1, 1)]}, offsets, tiles=2)
+    # another generation of the same TIF is not read
+    write_partial(s3, 'bucket', partial_key(RUN_ID, 'a.tif', 'g0', '0', 0), {'old.png': []}, {'old.png': [0, 0]},
+                  tiles=5)
+
+    tiles, tile_polygons, tile_offsets = read_partials(s3, 'bucket', RUN_ID, 'a.tif', 'g1')
+
+    assert tiles == 8
+    assert list(tile_polygons) == ['1_0.png', '2_0.png', '2_1.png', '10_0.png']
+    assert list(tile_offsets) == list(tile_polygons)
+    assert all(polygons[0].equals(box(0, 0, 1, 1)) for polygons in tile_polygons.values())
+
+def test_read_partials_skips_deleted_partials():
+    """Test that a partial deleted between the listing and the read is left out instead of failing"""
+    s3 = FakeS3()
+    for part in range(3):
+        write_partial(s3, 'bucket', partial_key(RUN_ID, 'a.tif', 'g1', str(part), 0), {f'{part}.png': []},
+                      {f'{part}.png': [0, 0]}, tiles=1)
+    s3.missing.add(partial_key(RUN_ID, 'a.tif', 'g1', '1', 0))
+
+    tiles, tile_polygons, _ = read_partials(s3, 'bucket', RUN_ID, 'a.tif', 'g1')
+
+    assert tiles == 2
+    assert list(tile_polygons) == ['0.png', '2.png']
+
+@pytest.mark.parametrize("output_format", ['parquet', 'fgb', 'shp'])
+def test_upload_polygons_round_trip(output_format, tmp_path):
+    """Test that the polygons read back from each output format are the uploaded ones"""
+    polygons = [box(10, 20, 30, 40), box(50, 20, 55, 60), box(0, 0, 1, 1)]
+    s3 = FakeS3()
+    output_key = f'output/{RUN_ID}/a.tif{model_lambda.OUTPUT_SUFFIXES[output_format]}'
+
+    keys = model_lambda.upload_polygons(s3, 'bucket', polygons, output_key, output_format)
+
+    assert output_key in keys
+    for key in keys:
+        (tmp_path / os.path.basename(key)).write_bytes(s3.objects[key])
+    path = tmp_path / os.path.basename(output_key)
+    read_back = list((gpd.read_parquet(path) if output_format == 'parquet' else gpd.read_file(path)).geometry)
+    # FlatGeobuf returns the features in the order of its spatial index
+    assert sorted(polygon.wkb for polygon in shapely.normalize(read_back)) == \
+        sorted(polygon.wkb for polygon in shapely.normalize(polygons))
+    if output_format != 'shp':
+        # a single object, multipart above the threshold in parts S3 accepts (5MB at least)
+        config = s3.configs[output_key]
+        assert config.multipart_threshold == OUTPUT_MULTIPART_THRESHOLD_MB * 1024 * 1024
+        assert config.multipart_chunksize == OUTPUT_MULTIPART_CHUNK_MB * 1024 * 1024
+        assert 5 * 1024 * 1024 <= config.multipart_chunksize <= config.multipart_threshold
+
+def test_serialize_polygons_unknown_format():
+    """Test that an unknown OUTPUT_FORMAT fails instead of uploading nothing"""
+    with pytest.raises(ValueError):
+        model_lambda.serialize_polygons([box(0, 0, 1, 1)], 'gpkg')
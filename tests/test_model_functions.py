@@ -0,0 +1,315 @@
+import io
+import os
+import sys
+from pathlib import Path
+
+os.environ['aws_access_key_id'] = 'test_key'
+os.environ['aws_secret_access_key'] = 'test_secret'
+
+# Set up path
+project_root = str(Path(__file__).parent.parent)
+sys.path.append(project_root)
+
+import pytest
+
+# the model runs in its own image (src/model_image/requirements_model.txt), skip without it
+pytest.importorskip("detectree")
+
+import numpy as np
+import rasterio
+from affine import Affine
+from PIL import Image
+from shapely.affinity import affine_transform
+from shapely.geometry import box, Polygon
+from shapely.ops import unary_union
+
+# the model package is also called src: its modules are found next to the pre-process ones
+import src
+src.__path__.append(os.path.join(project_root, 'src', 'model_image', 'src'))
+
+from src.model_functions import merge_seams
+from src.model_functions import prediction_polygons, POLYGON_ENGINES, create_polygons, create_polygons_shapes
+from src.model_functions import tile_cache_key, LocalTileCache, process_image, process_tiles
+import src.model_functions as model_functions
+
+IDENTITY = Affine(1.0, 0.0, 0.0, 0.0, 1.0, 0.0)
+TILE_SIZE = 10
+
+def test_merge_seams_joins_crown_cut_by_tile_edge():
+    """Test that the two pieces of a crown crossing the edge of two tiles come out as one polygon"""
+    # pixel-center coordinates: the first tile covers x -0.5..9.5, the second 9.5..19.5
+    tile_polygons = {'a_0_0.png': [box(1, 1, 3, 3), box(6, 3, 9.5, 6)],
+                     'a_10_0.png': [box(9.5, 3, 13, 6)]}
+    offsets = {'a_0_0.png': [0, 0], 'a_10_0.png': [10, 0]}
+
+    merged = merge_seams(tile_polygons, offsets, TILE_SIZE, IDENTITY)
+
+    assert len(merged) == 2
+    assert merged[0].equals(box(1, 1, 3, 3))
+    assert merged[1].equals(box(6, 3, 13, 6))
+
+def test_merge_seams_keeps_separate_pieces_apart():
+    """Test that edge polygons of neighbouring tiles that don't touch are not merged"""
+    tile_polygons = {'a_0_0.png': [box(7, 0, 9.5, 1.5)],
+                     'a_10_0.png': [box(9.5, 7.5, 12, 9)]}
+    offsets = {'a_0_0.png': [0, 0], 'a_10_0.png': [10, 0]}
+
+    merged = merge_seams(tile_polygons, offsets, TILE_SIZE, IDENTITY)
+
+    assert len(merged) == 2
+    assert merged[0].equals(box(7, 0, 9.5, 1.5))
+    assert merged[1].equals(box(9.5, 7.5, 12, 9))
+    # without a tile grid the tiles are only concatenated
+    assert merge_seams(tile_polygons, offsets, None, IDENTITY) == [box(7, 0, 9.5, 1.5), box(9.5, 7.5, 12, 9)]
+
+def test_merge_seams_joins_crown_on_a_corner_of_four_tiles():
+    """Test that the four pieces of a crown on a tile corner merge into one, in world coordinates, other crowns kept"""
+    transform = Affine(0.5, 0.0, 1000.0, 0.0, -0.5, 2000.0)
+    to_world = [transform.a, transform.b, transform.d, transform.e, transform.xoff, transform.yoff]
+    pieces = {'a_0_0.png': [box(2, 2, 3, 3), box(7, 7, 9.5, 9.5)], 'a_10_0.png': [box(9.5, 7, 12, 9.5)],
+              'a_0_10.png': [box(7, 9.5, 9.5, 12)], 'a_10_10.png': [box(9.5, 9.5, 12, 12), box(16, 16, 18, 18)]}
+    tile_polygons = {png_name: [affine_transform(polygon, to_world) for polygon in polygons]
+                     for png_name, polygons in pieces.items()}
+    offsets = {'a_0_0.png': [0, 0], 'a_10_0.png': [10, 0], 'a_0_10.png': [0, 10], 'a_10_10.png': [10, 10]}
+
+    merged = merge_seams(tile_polygons, offsets, TILE_SIZE, transform)
+
+    expected = [box(2, 2, 3, 3), box(7, 7, 12, 12), box(16, 16, 18, 18)]
+    assert len(merged) == 3
+    for polygon, pixel_polygon in zip(merged, expected):
+        assert polygon.equals(affine_transform(pixel_polygon, to_world))
+
+@pytest.mark.parametrize("polygon_engine", sorted(POLYGON_ENGINES))
+def test_prediction_polygons_empty_and_full_masks(polygon_engine, monkeypatch):
+    """Test the fast paths: no canopy gives no polygon, all canopy the whole tile, without tracing the mask"""
+    def no_tracing(mask, **kwargs):
+        raise AssertionError("the mask was traced")
+
+    with monkeypatch.context() as patched:
+        patched.setitem(POLYGON_ENGINES, polygon_engine, no_tracing)
+        assert prediction_polygons(np.zeros((8, 6), dtype=np.uint8), 0, polygon_engine) == []
+        # any non zero prediction is canopy, whatever its dtype
+        full = prediction_polygons(np.full((8, 6), 3, dtype=np.int64), 0, polygon_engine)
+    assert len(full) == 1 and full[0].equals(box(-0.5, -0.5, 5.5, 7.5))
+
+    # a partly covered mask goes through the engine, inside the same tile extent
+    partial = np.zeros((8, 6), dtype=np.uint8)
+    partial[1:7, 1:5] = 1
+    polygons = prediction_polygons(partial, 0, polygon_engine, min_area=0, join_mitre_leange=0)
+    assert polygons and all(box(-0.5, -0.5, 5.5, 7.5).buffer(1e-9).contains(polygon) for polygon in polygons)
+
+def test_tile_cache_key_changes_with_each_input():
+    """Test that the cache key changes with the tile, the model, the parameters and the cache version"""
+    params = {'min_area': 20.0, 'halo': 0}
+    key = tile_cache_key('tile', 'model', params)
+
+    assert tile_cache_key('tile', 'model', {'halo': 0, 'min_area': 20.0}) == key
+    assert tile_cache_key('other tile', 'model', params) != key
+    assert tile_cache_key('tile', 'other model', params) != key
+    assert tile_cache_key('tile', 'model', {'min_area': 10.0, 'halo': 0}) != key
+    with pytest.MonkeyPatch.context() as monkeypatch:
+        monkeypatch.setattr(model_functions, 'TILE_CACHE_VERSION', model_functions.TILE_CACHE_VERSION + 1)
+        assert tile_cache_key('tile', 'model', params) != key
+
+def test_local_tile_cache_evicts_least_recently_used(tmp_path):
+    """Test that past max_bytes the results read or written longest ago are deleted first"""
+    cache = LocalTileCache(tmp_path, 'model', max_bytes=10 ** 6)
+    polygons = [box(0, 0, 1, 1)]
+    for age, key in enumerate(['c', 'b', 'a']):
+        cache.put(key, polygons)
+        os.utime(tmp_path / key, (1000 - age, 1000 - age))  # 'a' is the oldest
+    size = (tmp_path / 'a').stat().st_size
+
+    assert cache.get('a')[0].equals(box(0, 0, 1, 1))  # the read makes 'a' the most recent
+    assert cache.get('missing') is None
+    cache.max_bytes = 2 * size
+    cache.evict()
+
+    assert sorted(os.listdir(tmp_path)) == ['a', 'c']
+    assert cache.get('b') is None
+
+class CountingModel:
+    """Predicts the same mask for every tile and counts the calls"""
+
+    def __init__(self):
+        self.calls = 0
+
+    def predict_img(self, path):
+        self.calls += 1
+        mask = np.zeros((TILE_SIZE, TILE_SIZE), dtype=np.uint8)
+        mask[2:7, 2:7] = 1
+        return mask
+
+class BrokenCache:
+    model_sha256 = 'model'
+
+    def get(self, key):
+        raise OSError('read failed')
+
+    def put(self, key, polygons):
+        raise OSError('write failed')
+
+def test_process_image_cache_hit_skips_the_model(tmp_path):
+    """Test that a cached tile gives the same polygons without running the model, and a failing cache is ignored"""
+    model = CountingModel()
+    offsets = {'a_20_0.png': [20, 0]}
+    kwargs = dict(png_name='a_20_0.png', transform=IDENTITY, temp_image_path='unused.png', offsets=offsets,
+                  model=model, prescreen=False, tile_sha256='tile')
+
+    cache = LocalTileCache(tmp_path, 'model')
+    first = process_image(cache=cache, **kwargs)
+    second = process_image(cache=cache, **kwargs)
+
+    assert model.calls == 1
+    assert len(first) == 1 and len(second) == 1 and second[0].equals(first[0])
+    # other parameters are another entry
+    process_image(cache=cache, min_area=1.0, **kwargs)
+    assert model.calls == 2
+
+    broken = process_image(cache=BrokenCache(), **kwargs)
+    assert model.calls == 3
+    assert broken[0].equals(first[0])
+
+class GreenModel:
+    """Stands in for the classifier: canopy where green dominates. A red tile kills the worker process"""
+
+    def __init__(self):
+        self.parent = os.getpid()
+
+    def predict_img(self, path):
+        with rasterio.open(path) as src:
+            red, green, _ = src.read([1, 2, 3]).astype(int)
+        if red.min() > 200 and os.getpid() != self.parent:
+            os._exit(3)  # like the out of memory killer
+        return (green > red + 30).astype(np.uint8)
+
+def png_tile(seed, red=False):
+    rng = np.random.default_rng(seed)
+    image = np.full((TILE_SIZE * 4, TILE_SIZE * 4, 3), (250, 0, 0) if red else (120, 110, 100), dtype=np.uint8)
+    if not red:
+        for _ in range(3):
+            row, col = rng.integers(0, TILE_SIZE * 4 - 10, 2)
+            image[row:row + 10, col:col + 10] = (40, 140, 40)
+    buffer = io.BytesIO()
+    Image.fromarray(image).save(buffer, format='PNG')
+    return buffer.getvalue()
+
+def run_tiles(tiles, workers):
+    offsets = {png_name: [k * TILE_SIZE * 4, 0] for k, (png_name, _, _) in enumerate(tiles)}
+    results = process_tiles(tiles, GreenModel(), IDENTITY, offsets, workers=workers, threads_per_worker=1)
+    return {png_name: (polygons, error) for png_name, polygons, error, _ in results}
+
+def test_process_tiles_workers_give_the_serial_result():
+    """Test that the forked workers give the same polygons per tile as the serial run, download errors included"""
+    tiles = [(f'a_{k}_0.png', png_tile(k), None) for k in range(6)]
+    tiles.append(('a_6_0.png', None, OSError('download failed')))
+
+    serial = run_tiles(tiles, workers=1)
+    parallel = run_tiles(tiles, workers=3)
+
+    assert sorted(parallel) == sorted(serial)
+    for png_name, (polygons, error) in serial.items():
+        parallel_polygons, parallel_error = parallel[png_name]
+        if error is not None:
+            assert isinstance(parallel_error, OSError)
+            continue
+        assert polygons and parallel_error is None
+        assert [polygon.wkb for polygon in parallel_polygons] == [polygon.wkb for polygon in polygons]
+
+def test_process_tiles_replaces_a_dead_worker():
+    """Test that a worker dying on a tile fails only that tile, and the pool carries on with a new worker"""
+    tiles = [(f'a_{k}_0.png', png_tile(k, red=k in (1, 4)), None) for k in range(8)]
+
+    results = run_tiles(tiles, workers=2)
+
+    assert sorted(results) == sorted(png_name for png_name, _, _ in tiles)
+    for k in range(8):
+        polygons, error = results[f'a_{k}_0.png']
+        if k in (1, 4):
+            assert polygons is None and 'exited with code 3' in str(error)
+        else:
+            assert error is None and polygons
+
+def crowns_mask():
+    """A crown with a hole, holes touching at their corners around a canopy pixel, a round crown and a speck"""
+    mask = np.zeros((30, 30), dtype=np.uint8)
+    mask[2:8, 2:8] = [[1, 1, 1, 1, 1, 1],
+                      [1, 1, 1, 0, 1, 1],
+                      [1, 0, 0, 1, 0, 1],
+                      [1, 1, 1, 0, 1, 1],
+                      [1, 1, 1, 1, 1, 1],
+                      [1, 1, 1, 1, 1, 1]]
+    mask[12:24, 4:16] = 1
+    mask[16:19, 8:11] = 0
+    rows, columns = np.mgrid[:30, :30]
+    mask[(rows - 15) ** 2 + (columns - 23) ** 2 <= 30] = 1
+    mask[26, 26] = 1
+    return mask
+
+def footprint(polygons):
+    return unary_union([Polygon(polygon.exterior) for polygon in polygons])
+
+def test_create_polygons_shapes_keeps_holes_and_repairs_corner_touching_holes():
+    """Test that the traced polygons cover exactly the canopy pixels, holes included, and are valid"""
+    mask = crowns_mask()
+    exact = dict(join_mitre_leange=0, min_area=0, simplification_tolerance=0)
+
+    polygons = create_polygons_shapes(mask, **exact)
+
+    assert all(polygon.is_valid for polygon in polygons)
+    assert sum(polygon.area for polygon in polygons) == mask.sum()
+    crown = [polygon for polygon in polygons if Polygon(polygon.exterior).equals(box(3.5, 11.5, 15.5, 23.5))]
+    assert len(crown) == 1 and [Polygon(hole).area for hole in crown[0].interiors] == [9.0]
+    # the holes touching at a corner cut the pixel they surround off its crown, buffer(0) splits it out
+    assert any(polygon.equals(box(4.5, 3.5, 5.5, 4.5)) for polygon in polygons)
+    # the outlines are the ones of the contours engine (which fills the holes), up to the half pixel corners
+    contours = footprint(create_polygons(mask, **exact))
+    assert footprint(polygons).symmetric_difference(contours).area < 0.05 * contours.area
+
+def test_create_polygons_shapes_filters_like_contours():
+    """Test the default joining, min_area filtering and simplification against the contours engine"""
+    mask = crowns_mask()
+
+    polygons = create_polygons_shapes(mask)
+    contours = create_polygons(mask)
+
+    # the speck is under min_area, the round crown is joined to the crown next to it
+    assert len(polygons) == len(contours) == 2
+    assert all(polygon.is_valid and polygon.area >= 20.0 for polygon in polygons)
+    assert not any(polygon.intersects(box(25, 25, 27, 27)) for polygon in polygons)
+    assert footprint(polygons).symmetric_difference(footprint(contours)).area < 0.2 * footprint(contours).area
+    # simplification drops the staircase vertices of the round crown
+    unsimplified = create_polygons_shapes(mask, simplification_tolerance=0)
+    assert sum(len(polygon.exterior.coords) for polygon in polygons) < sum(len(polygon.exterior.coords) for polygon in unsimplified)
+
+@pytest.mark.parametrize("polygon_engine", sorted(POLYGON_ENGINES))
+def test_prediction_polygons_crop_the_halo(polygon_engine):
+    """Test that only the core of a haloed prediction is traced, canopy in the halo alone gives nothing"""
+    cropped = prediction_polygons(np.ones((10, 10), dtype=np.uint8), 2, polygon_engine)
+    assert len(cropped) == 1 and cropped[0].equals(box(-0.5, -0.5, 5.5, 5.5))
+
+    halo_only = np.zeros((10, 10), dtype=np.uint8)
+    halo_only[:2] = 1
+    halo_only[:, -2:] = 1
+    assert prediction_polygons(halo_only, 2, polygon_engine) == []
+
+class FixedModel:
+    """Predicts the given mask for any tile"""
+
+    def __init__(self, prediction):
+        self.prediction = prediction
+
+    def predict_img(self, path):
+        return self.prediction
+
+def test_process_image_places_the_core_of_a_haloed_tile_at_its_offset():
+    """Test that the polygons of a haloed tile are georeferenced from the tile offset, not the halo corner"""
+    halo = 2
+    prediction = np.zeros((TILE_SIZE + 2 * halo, TILE_SIZE + 2 * halo), dtype=np.uint8)
+    prediction[halo + 3:halo + 6, halo + 3:halo + 6] = 1  # core pixels 3..5
+    prediction[0, :] = 1  # only in the halo
+
+    polygons = process_image('a_20_10.png', IDENTITY, 'unused.png', {'a_20_10.png': [20, 10]}, FixedModel(prediction),
+                             polygon_engine='shapes', join_mitre_leange=0, min_area=0, halo=halo, prescreen=False)
+
+    assert len(polygons) == 1 and polygons[0].equals(box(22.5, 12.5, 25.5, 15.5))
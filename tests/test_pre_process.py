@@ -1,5 +1,6 @@
 import pytest
 import os
+import json
 import numpy as np
 from PIL import Image
 import rasterio
@@ -7,11 +8,15 @@ from rasterio.transform import from_origin
 import shutil
 from pathlib import Path
 
+from unittest.mock import MagicMock, patch
+
 import sys
 project_root = str(Path(__file__).parent.parent)
 sys.path.insert(0, project_root)
 
-from src.pre_process import tif_to_png, split_image
+import src.pre_process as pre_process
+from src.ledger import ProcessingLedger
+from src.pre_process import tif_to_png, split_image, split_images, iter_tiles, write_png_rows, iter_row_blocks, empty_tile_grid, bundle_image, bundle_images
 
 @pytest.fixture
 def test_directories():
@@ -83,6 +88,53 @@ def test_tif_to_png_successful_conversion(test_directories, sample_tif):
     assert img.format == "PNG"
     assert len(img.getbands()) == 3  # RGB image
 
+def test_tif_to_png_block_wise_matches_full_read(test_directories, sample_tif):
+    """Test that block-wise conversion produces the same pixels as the full read"""
+    output_dir = str(test_directories["output"])
+    assert tif_to_png(sample_tif, output_dir, "full.png", block_wise=False)
+    assert tif_to_png(sample_tif, output_dir, "blocks.png", block_wise=True)
+
+    with Image.open(os.path.join(output_dir, "full.png")) as full, \
+            Image.open(os.path.join(output_dir, "blocks.png")) as blocks:
+        assert np.array_equal(np.array(full), np.array(blocks))
+
+def test_write_png_rows_small_blocks(test_directories, sample_tif):
+    """Test streaming PNG writing with blocks that don't divide the image height"""
+    png_file = os.path.join(str(test_directories["output"]), "rows.png")
+    with rasterio.open(sample_tif) as src:
+        expected = np.dstack(src.read([1, 2, 3]))
+        write_png_rows(png_file, src.width, src.height, iter_row_blocks(src, 7))
+
+    with Image.open(png_file) as img:
+        assert np.array_equal(np.array(img), expected)
+
+def write_tif(path, data):
+    with rasterio.open(path, 'w', driver='GTiff', height=data.shape[1], width=data.shape[2], count=3,
+                       dtype=data.dtype, blockysize=8) as dst:
+        dst.write(data)
+
+@pytest.mark.parametrize("block_wise", [False, True])
+def test_tif_to_png_keeps_16_bit_values(test_directories, block_wise):
+    """Test that a 16 bit TIF becomes a 16 bit PNG with the same values, not 8 bit garbage"""
+    output_dir = str(test_directories["output"])
+    data = np.random.default_rng(0).integers(0, 65535, (3, 37, 29), dtype=np.uint16)
+    tif_path = os.path.join(output_dir, "deep.tif")
+    write_tif(tif_path, data)
+
+    assert tif_to_png(tif_path, output_dir, "deep.png", block_wise=block_wise)
+    with rasterio.open(os.path.join(output_dir, "deep.png")) as png:
+        assert png.dtypes[0] == 'uint16'
+        assert np.array_equal(png.read([1, 2, 3]), data)
+
+def test_tif_to_png_rejects_float_input(test_directories):
+    """Test that band types a PNG can't hold are refused instead of being cast"""
+    output_dir = str(test_directories["output"])
+    tif_path = os.path.join(output_dir, "float.tif")
+    write_tif(tif_path, np.ones((3, 10, 10), dtype=np.float32))
+
+    assert tif_to_png(tif_path, output_dir, "float.png") is False
+    assert not os.path.exists(os.path.join(output_dir, "float.png"))
+
 def test_tif_to_png_invalid_input(test_directories):
     """Test conversion with invalid input file"""
     output_dir = str(test_directories["output"])
@@ -170,3 +222,210 @@ def test_split_image_partial_splits(test_directories, sample_png):
             width, height = img.size
             assert width <= split_size and width > 0
             assert height <= split_size and height > 0
+
+
+def test_iter_tiles_matches_png_crops(test_directories, sample_tif):
+    """Test that tiles read from the TIF match crops of the converted PNG"""
+    output_dir = str(test_directories["output"])
+    tif_to_png(sample_tif, output_dir, "full.png")
+
+    with Image.open(os.path.join(output_dir, "full.png")) as img:
+        for (i, j), tile in iter_tiles(sample_tif, 60):
+            assert tile.shape == (60, 60, 3)
+            crop = np.array(img.crop((i, j, i + 60, j + 60)))
+            assert np.array_equal(tile, crop)
+
+def test_split_image_from_tif(test_directories, sample_tif):
+    """Test splitting a TIF directly, without an intermediate PNG"""
+    output_dir = str(test_directories["split"])
+
+    offsets = split_image(sample_tif, output_dir, 50)
+
+    assert offsets == {
+        "test_image.tif_0_0.png": (0, 0),
+        "test_image.tif_0_50.png": (0, 50),
+        "test_image.tif_50_0.png": (50, 0),
+        "test_image.tif_50_50.png": (50, 50)
+    }
+    for filename in offsets.keys():
+        with Image.open(os.path.join(output_dir, filename)) as img:
+            assert img.size == (50, 50)
+
+def test_split_image_halo_overlaps_neighbours(test_directories, sample_tif):
+    """Test that haloed tiles hold the neighbouring pixels, zero padded outside the image, with the core offsets"""
+    hard_edged = split_image(sample_tif, str(test_directories["output"]), 50)
+    serial = split_image(sample_tif, str(test_directories["split"]), 50, halo=10)
+    parallel = split_image(sample_tif, str(test_directories["output"]), 50, workers=2, halo=10)
+
+    assert list(parallel.items()) == list(serial.items()) == list(hard_edged.items())
+    with rasterio.open(sample_tif) as src:
+        padded = np.pad(np.moveaxis(src.read(), 0, -1), ((10, 10), (10, 10), (0, 0)))
+    for filename, (i, j) in serial.items():
+        with Image.open(os.path.join(str(test_directories["split"]), filename)) as a, \
+                Image.open(os.path.join(str(test_directories["output"]), filename)) as b:
+            assert a.size == (70, 70)
+            assert np.array_equal(np.array(a), padded[j:j + 70, i:i + 70])
+            assert np.array_equal(np.array(a), np.array(b))
+
+def test_split_image_parallel_matches_serial(test_directories, sample_tif):
+    """Test that the process pool returns the same offsets, in the same order, as the serial path"""
+    serial = split_image(sample_tif, str(test_directories["split"]), 30)
+    parallel = split_image(sample_tif, str(test_directories["output"]), 30, workers=2)
+
+    assert list(parallel.items()) == list(serial.items())
+    for filename in serial.keys():
+        with Image.open(os.path.join(str(test_directories["split"]), filename)) as a, \
+                Image.open(os.path.join(str(test_directories["output"]), filename)) as b:
+            assert np.array_equal(np.array(a), np.array(b))
+
+def test_split_images_skips_failed_files(test_directories, sample_tif):
+    """Test fanning out over several files, a broken file is left out of the result"""
+    output_dir = str(test_directories["split"])
+
+    offsets_dict = split_images([sample_tif, "nonexistent.tif"], output_dir, 50, workers=2)
+
+    assert list(offsets_dict.keys()) == ["test_image.tif"]
+    assert offsets_dict["test_image.tif"] == split_image(sample_tif, output_dir, 50)
+
+def _write_tif(path, data, nodata=None):
+    with rasterio.open(path, 'w', driver='GTiff', height=data.shape[1], width=data.shape[2],
+                       count=data.shape[0], dtype=data.dtype, nodata=nodata,
+                       transform=from_origin(0, 0, 1, 1)) as dst:
+        dst.write(data)
+    return str(path)
+
+def test_empty_tile_grid_zero_tiles(test_directories):
+    """Test that all-zero tiles are flagged as empty when the TIF has no mask"""
+    data = np.zeros((3, 100, 100), dtype=np.uint8)
+    data[:, 60:70, 10:20] = 5  # only the tile at (0, 50) has content
+    tif_path = _write_tif(test_directories["input"] / "zeros.tif", data)
+
+    with rasterio.open(tif_path) as src:
+        empty = empty_tile_grid(src, 50)
+
+    assert empty.tolist() == [[True, False], [True, True]]
+
+def test_split_image_skips_nodata_tiles(test_directories):
+    """Test that tiles that are all nodata (but not zero) are skipped, in serial and parallel mode"""
+    data = np.full((3, 100, 100), 7, dtype=np.uint8)
+    data[:, 0:50, 50:100] = 200  # only the tile at (50, 0) holds valid pixels
+    tif_path = _write_tif(test_directories["input"] / "nodata.tif", data, nodata=7)
+
+    serial = split_image(tif_path, str(test_directories["split"]), 50, skip_empty=True)
+    parallel = split_image(tif_path, str(test_directories["output"]), 50, skip_empty=True, workers=2)
+
+    assert serial == {"nodata.tif_50_0.png": (50, 0)}
+    assert parallel == serial
+    assert len(os.listdir(test_directories["split"])) == 1
+
+def test_split_image_on_tile_callback(test_directories, sample_tif):
+    """Test that every written tile is handed to the consumer, in serial and parallel mode"""
+    for workers in (1, 2):
+        produced = []
+        offsets = split_image(sample_tif, str(test_directories["split"]), 30, workers=workers, on_tile=produced.append)
+
+        assert sorted(produced) == sorted(os.path.join(str(test_directories["split"]), name) for name in offsets)
+
+def test_bundle_image_byte_ranges(test_directories, sample_tif):
+    """Test that every index entry of the bundle holds the same PNG split_image writes"""
+    bundle_dir = str(test_directories["output"])
+    offsets, bundle_path, index = bundle_image(sample_tif, bundle_dir, 50)
+
+    assert offsets == split_image(sample_tif, str(test_directories["split"]), 50)
+    assert list(index.keys()) == list(offsets.keys())
+    assert os.listdir(bundle_dir) == ["test_image.tif.bundle"]  # temporary tiles are cleaned up
+    with open(bundle_path, 'rb') as bundle:
+        data = bundle.read()
+    for filename, (start, length) in index.items():
+        with open(os.path.join(str(test_directories["split"]), filename), 'rb') as tile:
+            assert data[start:start + length] == tile.read()
+
+def test_bundle_images_parallel_streams_bundles(test_directories, sample_tif):
+    """Test that the pooled bundling hands over every bundle, identical to bundle_image, and cleans up its tiles"""
+    second_tif = str(test_directories["input"] / "second.tif")
+    shutil.copy(sample_tif, second_tif)
+    expected = {Path(path).name: bundle_image(path, str(test_directories["split"]), 30) for path in (sample_tif, second_tif)}
+    bundle_dir = str(test_directories["output"])
+    handed_over = []
+
+    bundles = bundle_images([sample_tif, second_tif], bundle_dir, 30, workers=2, on_bundle=handed_over.append)
+
+    assert sorted(handed_over) == sorted(bundle_path for _, bundle_path, _ in bundles.values())
+    assert sorted(os.listdir(bundle_dir)) == ["second.tif.bundle", "test_image.tif.bundle"]
+    for image_name, (offsets, bundle_path, index) in bundles.items():
+        expected_offsets, expected_path, expected_index = expected[image_name]
+        assert list(offsets.items()) == list(expected_offsets.items())
+        assert index == expected_index
+        with open(bundle_path, 'rb') as a, open(expected_path, 'rb') as b:
+            assert a.read() == b.read()
+
+def test_split_images_plans_each_grid_when_its_rows_are_queued(test_directories, sample_tif, monkeypatch):
+    """Test that the empty tiles of the next image are looked for while the pool tiles the previous one"""
+    second_tif = str(test_directories["input"] / "second.tif")
+    shutil.copy(sample_tif, second_tif)
+    produced = []
+    tiles_at_grid = []
+    real_empty_tile_grid = pre_process.empty_tile_grid
+
+    def recording_empty_tile_grid(src, size, bands=(1, 2, 3)):
+        tiles_at_grid.append(len(produced))
+        return real_empty_tile_grid(src, size, bands)
+
+    monkeypatch.setattr(pre_process, "empty_tile_grid", recording_empty_tile_grid)
+    offsets_dict = split_images([sample_tif, second_tif], str(test_directories["split"]), 10, skip_empty=True,
+                                workers=2, on_tile=produced.append)
+
+    # 10 rows of the first image are queued before the second grid, at most 2 per worker in flight
+    assert tiles_at_grid[0] == 0 and tiles_at_grid[1] >= 60
+    assert len(produced) == 200 and len(offsets_dict) == 2
+
+@pytest.fixture
+def batch_folders(test_directories, monkeypatch):
+    """Point the pre-process folders at the test directories"""
+    folders = {name: test_directories["output"] / name for name in ["input", "processed", "split", "offsets"]}
+    for folder in folders.values():
+        folder.mkdir(parents=True, exist_ok=True)
+    monkeypatch.setattr(pre_process, "INPUT_FOLDER_PATH", folders["input"])
+    monkeypatch.setattr(pre_process, "INPUT_PROCESSED_FOLDER_PATH", folders["processed"])
+    monkeypatch.setattr(pre_process, "SPLIT_FOLDER", folders["split"])
+    monkeypatch.setattr(pre_process, "OFSETS_FOLDER", folders["offsets"])
+    monkeypatch.setattr(pre_process, "IMAGE_SIZE", 50)
+    monkeypatch.setattr(pre_process, "PRE_PROCESS_WORKERS", 1)
+    return folders
+
+def test_process_batch_ledger_resume_and_skip(test_directories, batch_folders, sample_tif):
+    """Test that a crashed run is resumed without re-splitting and a re-delivered file is skipped"""
+    ledger = ProcessingLedger(test_directories["output"] / "ledger.sqlite3")
+    input_tif = batch_folders["input"] / "test_image.tif"
+    shutil.copy(sample_tif, input_tif)
+    uploaded_keys = []
+
+    def upload_file(file_path, bucket, key, Config=None):
+        if key.startswith("offsets/") and not uploaded_keys.count("allow-offsets"):
+            raise Exception("S3 Error")  # simulates a crash before the offsets went up
+        uploaded_keys.append(key)
+
+    with patch('boto3.client') as mock_boto:
+        mock_boto.return_value.upload_file.side_effect = upload_file
+        first = pre_process.process_batch([str(input_tif)], "2024-01-28", ledger)
+        assert uploaded_keys == ["images/2024-01-28/test_image.tif.bundle"]
+        assert first["test_image.tif"][pre_process.META_KEY]["tile_size"] == pre_process.IMAGE_SIZE
+
+        # the TIF is not done, it stays in the input folder for the next run
+        assert input_tif.exists()
+
+        # restart: the bundle is already uploaded, only the offsets are missing
+        uploaded_keys.append("allow-offsets")
+        with patch.object(pre_process, "bundle_images", side_effect=AssertionError("split again")):
+            second = pre_process.process_batch([str(input_tif)], "2024-01-28", ledger)
+        assert json.loads(json.dumps(second)) == json.loads(json.dumps(first))
+        assert uploaded_keys[-1] == "offsets/2024-01-28.json"
+        assert uploaded_keys.count("images/2024-01-28/test_image.tif.bundle") == 1
+        assert not input_tif.exists()
+
+        # the same TIF delivered again is not processed a second time
+        shutil.copy(sample_tif, input_tif)
+        third = pre_process.process_batch([str(input_tif)], "2024-01-29", ledger)
+        assert third == {}
+        assert not input_tif.exists()
+    ledger.close()
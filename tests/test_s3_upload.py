@@ -0,0 +1,100 @@
+import pytest
+import os
+import shutil
+import sqlite3
+from pathlib import Path
+from unittest.mock import MagicMock, patch
+
+import sys
+project_root = str(Path(__file__).parent.parent)
+sys.path.insert(0, project_root)
+
+from src.s3_upload import S3Uploader, TileUploadPipeline
+
+@pytest.fixture
+def images_folder():
+    """Create a folder with a few fake tiles"""
+    folder = Path("test_upload_data")
+    folder.mkdir(parents=True, exist_ok=True)
+    for i in range(10):
+        (folder / f"tile_{i}.png").write_bytes(b"x" * 1024)
+    (folder / "notes.txt").write_text("not a tile")
+
+    yield folder
+
+    shutil.rmtree(folder)
+
+@pytest.fixture
+def mock_s3_client():
+    """Create a mock S3 client"""
+    with patch('boto3.client') as mock_boto:
+        s3_client = MagicMock()
+        mock_boto.return_value = s3_client
+        yield s3_client
+
+def test_upload_images_concurrent(images_folder, mock_s3_client):
+    """Test that every PNG is uploaded once under the date prefix"""
+    uploader = S3Uploader('test-bucket')
+
+    assert uploader.upload_images(str(images_folder), workers=4) is True
+
+    assert mock_s3_client.upload_file.call_count == 10
+    keys = sorted(call.args[2] for call in mock_s3_client.upload_file.call_args_list)
+    assert all(key.startswith('images/') and key.endswith('.png') for key in keys)
+    assert len(set(keys)) == 10
+    assert uploader.last_report['uploaded'] == 10
+    assert uploader.last_report['bytes'] == 10 * 1024
+    assert uploader.last_report['failed'] == []
+
+def test_upload_images_reports_failures(images_folder, mock_s3_client):
+    """Test that a failed file is reported without stopping the other uploads"""
+    def upload_file(file_path, bucket, key, Config=None):
+        if file_path.endswith('tile_3.png'):
+            raise Exception("S3 Error")
+    mock_s3_client.upload_file.side_effect = upload_file
+    uploader = S3Uploader('test-bucket')
+
+    assert uploader.upload_images(str(images_folder), workers=4) is False
+
+    assert mock_s3_client.upload_file.call_count == 10
+    assert uploader.last_report['uploaded'] == 9
+    assert uploader.last_report['failed'] == [os.path.join(str(images_folder), 'tile_3.png')]
+
+def test_tile_upload_pipeline_streams_and_deletes(images_folder, mock_s3_client):
+    """Test that queued tiles are uploaded under the date prefix and removed once confirmed"""
+    def upload_file(file_path, bucket, key, Config=None):
+        if file_path.endswith('tile_3.png'):
+            raise Exception("S3 Error")
+    mock_s3_client.upload_file.side_effect = upload_file
+    uploader = S3Uploader('test-bucket')
+    tiles = sorted(str(path) for path in images_folder.glob("*.png"))
+
+    with TileUploadPipeline(uploader, '2024-01-28', workers=2, queue_size=2, delete_uploaded=True) as pipeline:
+        for tile in tiles:
+            pipeline.put(tile)
+
+    keys = sorted(call.args[2] for call in mock_s3_client.upload_file.call_args_list)
+    assert keys == sorted(f"images/2024-01-28/{os.path.basename(tile)}" for tile in tiles)
+    assert pipeline.report['uploaded'] == 9
+    assert pipeline.report['failed'] == [os.path.join(str(images_folder), 'tile_3.png')]
+    # only the failed tile is kept on disk
+    assert sorted(path.name for path in images_folder.glob("*.png")) == ['tile_3.png']
+
+def test_tile_upload_pipeline_survives_ledger_errors(images_folder, mock_s3_client):
+    """Test that a ledger error fails its tile only, and the upload threads keep draining the queue"""
+    def record_upload(name, sha256, s3_path):
+        if name in ('tile_1.png', 'tile_2.png'):
+            raise sqlite3.OperationalError("database is locked")
+    ledger = MagicMock()
+    ledger.is_uploaded.return_value = False
+    ledger.record_upload.side_effect = record_upload
+    uploader = S3Uploader('test-bucket')
+    tiles = sorted(str(path) for path in images_folder.glob("*.png"))
+
+    # one thread and a queue of one: a dead consumer would leave put() blocked
+    with TileUploadPipeline(uploader, '2024-01-28', workers=1, queue_size=1, ledger=ledger) as pipeline:
+        for tile in tiles:
+            pipeline.put(tile)
+
+    assert pipeline.report['uploaded'] == 8
+    assert sorted(os.path.basename(path) for path in pipeline.report['failed']) == ['tile_1.png', 'tile_2.png']